@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Broadcast fan-out with many clients, a few of them deliberately slow.
+
+Compares the old serial ``await send_text`` loop with ConnectionManager's
+per-connection queues. Reported time is until every *fast* client has the
+message, which is what a stalled client used to hold hostage.
+
+    python benchmarks/bench_broadcast.py --clients 10000 --slow 5
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from connection_manager import ConnectionManager  # noqa: E402
+
+
+class FakeWebSocket:
+    def __init__(self, delay: float, expected: int, done: asyncio.Event, counter: list):
+        self.delay = delay
+        self.received = 0
+        self.expected = expected
+        self.done = done
+        self.counter = counter
+
+    async def accept(self):
+        pass
+
+    async def close(self, code: int = 1000):
+        pass
+
+    async def send_text(self, frame: str):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+            return
+        await asyncio.sleep(0)
+        self.received += 1
+        if self.received == self.expected:
+            self.counter[0] -= 1
+            if self.counter[0] == 0:
+                self.done.set()
+
+
+def make_clients(args, done, counter):
+    return [
+        FakeWebSocket(args.slow_delay if i < args.slow else 0.0, args.messages, done, counter)
+        for i in range(args.clients)
+    ]
+
+
+async def serial(args):
+    done, counter = asyncio.Event(), [args.clients - args.slow]
+    clients = make_clients(args, done, counter)
+    started = time.perf_counter()
+    for _ in range(args.messages):
+        for ws in clients:
+            await ws.send_text("{}")
+    await done.wait()
+    return time.perf_counter() - started
+
+
+async def queued(args):
+    done, counter = asyncio.Event(), [args.clients - args.slow]
+    clients = make_clients(args, done, counter)
+    manager = ConnectionManager(max_queue=64, send_timeout=60)
+    connections = [await manager.connect(ws, f"user-{i}") for i, ws in enumerate(clients)]
+    started = time.perf_counter()
+    for _ in range(args.messages):
+        await manager.broadcast("{}")
+    await done.wait()
+    elapsed = time.perf_counter() - started
+    stats = manager.stats()
+    for connection in connections:
+        manager.disconnect(connection)
+    return elapsed, stats
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=10000)
+    parser.add_argument("--slow", type=int, default=5)
+    parser.add_argument("--slow-delay", type=float, default=0.5)
+    parser.add_argument("--messages", type=int, default=5)
+    args = parser.parse_args()
+
+    elapsed = await serial(args)
+    print(f"serial send loop   {elapsed * 1000:9.1f} ms until all fast clients delivered")
+    elapsed, stats = await queued(args)
+    print(f"queued fan-out     {elapsed * 1000:9.1f} ms until all fast clients delivered")
+    print(f"  max queue depth={stats['max_queue_depth']} avg send={stats['avg_send_ms']}ms")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
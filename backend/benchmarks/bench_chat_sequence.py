@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Cost of allocating chat sequence numbers from the shared counter.
+
+Simulates WORKERS processes (one ChatSequencer each, all on the same counter
+document) with SENDERS concurrent senders per worker, every sender taking
+MESSAGES seqs back to back. Three allocators are compared:
+
+  per-message  one $inc per message (what ChatSequencer used to do)
+  coalesced    ChatSequencer in shared mode
+  local        the in-process counter (single-worker deployments only)
+
+Reports throughput, per-allocation latency and how many updates reached the
+counter document. Needs a MongoDB at MONGO_URL; it writes to a throwaway
+database and drops it afterwards.
+
+    MONGO_URL=mongodb://localhost:27017 python benchmarks/bench_chat_sequence.py --workers 4 --senders 50
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from motor.motor_asyncio import AsyncIOMotorClient  # noqa: E402
+from pymongo import ReturnDocument  # noqa: E402
+
+from chat_history import LOCAL, SEQ_COUNTER_ID, SHARED, ChatSequencer  # noqa: E402
+
+
+class PerMessageSequencer(ChatSequencer):
+    async def next(self) -> int:
+        self.allocations += 1
+        counter = await self.counters.find_one_and_update(
+            {"_id": SEQ_COUNTER_ID},
+            {"$inc": {"value": 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return counter["value"]
+
+
+async def run(label: str, sequencers, senders: int, messages: int):
+    latencies = []
+
+    async def sender(sequencer):
+        for _ in range(messages):
+            started = time.perf_counter()
+            await sequencer.next()
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(sender(s) for s in sequencers for _ in range(senders)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2]
+    p99 = latencies[max(0, int(len(latencies) * 0.99) - 1)]
+    updates = sum(s.allocations for s in sequencers)
+    print(
+        f"{label:<12} {len(latencies)} seqs in {elapsed:6.2f}s ({len(latencies) / elapsed:8.0f}/s)  "
+        f"p50={p50 * 1000:7.2f}ms p99={p99 * 1000:7.2f}ms  counter updates={updates}"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--senders", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=20)
+    args = parser.parse_args()
+
+    client = AsyncIOMotorClient(os.getenv("MONGO_URL", "mongodb://localhost:27017"))
+    db = client["foxenfy_bench_chat_seq"]
+    try:
+        await db.counters.delete_many({})
+        # The real workers are separate processes; one event loop per pool of
+        # sequencers is close enough, since every allocation is a round trip
+        per_message = [PerMessageSequencer(db, mode=SHARED) for _ in range(args.workers)]
+        await run("per-message", per_message, args.senders, args.messages)
+        coalesced = [ChatSequencer(db, mode=SHARED) for _ in range(args.workers)]
+        await run("coalesced", coalesced, args.senders, args.messages)
+        local = ChatSequencer(db, mode=LOCAL)
+        await local.start()
+        await run("local", [local], args.senders * args.workers, args.messages)
+    finally:
+        await client.drop_database(db.name)
+        client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Connect/disconnect churn against a large ConnectionManager registry.
+
+Registers --connections sockets (several per user, across a few rooms), then
+measures the cost of connecting and disconnecting more sockets while the
+registry is full, plus a room-scoped broadcast.
+
+    python benchmarks/bench_connection_churn.py --connections 50000
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from connection_manager import ConnectionManager  # noqa: E402
+
+
+class FakeWebSocket:
+    async def accept(self):
+        pass
+
+    async def close(self, code: int = 1000):
+        pass
+
+    async def send_text(self, frame: str):
+        pass
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--connections", type=int, default=50000)
+    parser.add_argument("--churn", type=int, default=10000)
+    parser.add_argument("--rooms", type=int, default=10)
+    args = parser.parse_args()
+
+    manager = ConnectionManager(heartbeat_interval=0)
+    rooms = [f"room-{i}" for i in range(args.rooms)]
+
+    started = time.perf_counter()
+    connections = [
+        await manager.connect(FakeWebSocket(), f"user-{i // 3}", ["global", random.choice(rooms)])
+        for i in range(args.connections)
+    ]
+    elapsed = time.perf_counter() - started
+    print(f"registered {args.connections} connections in {elapsed:.2f}s "
+          f"({elapsed / args.connections * 1e6:.1f} us each)")
+
+    started = time.perf_counter()
+    for i in range(args.churn):
+        victim = connections[i]
+        manager.disconnect(victim)
+        connections[i] = await manager.connect(FakeWebSocket(), victim.user_id, victim.rooms)
+    elapsed = time.perf_counter() - started
+    print(f"churned {args.churn} connect/disconnect pairs in {elapsed:.2f}s "
+          f"({elapsed / args.churn * 1e6:.1f} us per pair)")
+
+    started = time.perf_counter()
+    await manager.broadcast("{}", rooms[0])
+    print(f"room broadcast to {len(manager.rooms.get(rooms[0], {}))} members "
+          f"enqueued in {(time.perf_counter() - started) * 1000:.2f}ms")
+
+    for connection in connections:
+        manager.disconnect(connection)
+    print(f"registry empty: {manager.stats()['connections'] == 0}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
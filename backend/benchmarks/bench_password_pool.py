@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Event-loop latency during a burst of concurrent logins.
+
+Runs N bcrypt verifications either inline on the loop (the old behaviour) or
+through PasswordHasher, while a ticker coroutine measures how late the loop
+wakes it up. Inline work shows lag of whole seconds; the pool keeps it flat.
+
+    python benchmarks/bench_password_pool.py --logins 500 --rounds 10
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from password_hasher import PasswordHasher, PasswordPoolSaturated  # noqa: E402
+
+TICK = 0.01
+
+
+async def measure_lag(stop: asyncio.Event, samples: list):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(TICK)
+        samples.append(time.perf_counter() - started - TICK)
+
+
+async def run(label: str, login, logins: int):
+    stop = asyncio.Event()
+    samples = []
+    ticker = asyncio.create_task(measure_lag(stop, samples))
+    await asyncio.sleep(TICK * 2)
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(login() for _ in range(logins)), return_exceptions=True)
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await ticker
+
+    shed = sum(isinstance(r, PasswordPoolSaturated) for r in results)
+    samples.sort()
+    p99 = samples[max(0, int(len(samples) * 0.99) - 1)] if samples else 0.0
+    print(
+        f"{label:<8} {logins} logins in {elapsed:6.2f}s  shed={shed:<4} "
+        f"loop lag p99={p99 * 1000:8.2f}ms max={max(samples, default=0) * 1000:8.2f}ms"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--logins", type=int, default=500)
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    hasher = PasswordHasher(rounds=args.rounds, max_workers=args.workers, max_pending=args.logins)
+    stored = hasher.context.hash("correct horse")
+
+    async def inline_login():
+        return hasher.context.verify("correct horse", stored)
+
+    async def pooled_login():
+        return await hasher.verify("correct horse", stored)
+
+    try:
+        await run("inline", inline_login, args.logins)
+        await run("pooled", pooled_login, args.logins)
+    finally:
+        hasher.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
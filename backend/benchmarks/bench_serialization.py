@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Response and frame encode cost per endpoint, before and after FastJSONResponse.
+
+"before" is what FastAPI did with a plain dict: validate against the
+response_model when one is declared, otherwise walk it with jsonable_encoder,
+then json.dumps. "after" is the FastJSONResponse path: the trusted dict goes
+straight to orjson. The chat rows cover a broadcast frame: encode once, parse
+once per worker, then deliver to every socket in the room.
+
+    python benchmarks/bench_serialization.py --rows 50 --clients 1000
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "foxenfy_bench")
+os.environ.setdefault("JWT_SECRET_KEY", "bench")
+os.environ.setdefault("METRICS_ENABLED", "false")
+os.environ.setdefault("LOG_FORMAT", "text")
+
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+
+import serialization  # noqa: E402
+from server import ChatMessagesPage, SearchResponse, Token  # noqa: E402
+
+
+def stdlib_render(content) -> bytes:
+    # starlette.responses.JSONResponse.render
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode()
+
+
+def song(i: int) -> dict:
+    return {
+        "id": f"vid{i:08d}",
+        "title": f"Track number {i} (Official Video) – Live",
+        "artist": f"Artist {i % 37}",
+        "thumbnail": f"https://i.ytimg.com/vi/vid{i:08d}/mqdefault.jpg",
+        "duration": f"{3 + i % 4}:{i % 60:02d}",
+        "published_at": "2023-05-01T12:00:00Z",
+    }
+
+
+def chat_message(i: int, now: datetime) -> dict:
+    return {
+        "id": str(uuid.uuid4()),
+        "user_id": str(uuid.uuid4()),
+        "username": f"listener_{i % 50}",
+        "avatar": None,
+        "room": "global",
+        "message": "has anyone heard the new album yet? it's " + "really " * (i % 5) + "good",
+        "timestamp": now - timedelta(seconds=i),
+        "seq": 100000 + i,
+    }
+
+
+def payloads(rows: int):
+    now = datetime.utcnow()
+    user = {
+        "id": str(uuid.uuid4()), "username": "listener", "email": "listener@example.com",
+        "role": "user", "avatar": None, "created_at": now, "premium_until": None,
+    }
+    messages = [chat_message(i, now) for i in range(rows)]
+    return [
+        ("POST /api/auth/login", Token, {"access_token": "x" * 180, "token_type": "bearer", "user": user}),
+        ("GET /api/search", SearchResponse, {
+            "songs": [song(i) for i in range(rows)], "query": "lofi", "total": rows,
+            "source": "cache", "next_cursor": "CDIQAA", "degraded": False,
+        }),
+        ("GET /api/chat/messages", ChatMessagesPage, {
+            "messages": messages, "total": rows, "has_more": True,
+            "before": messages[0]["id"], "after": messages[-1]["id"], "source": "buffer",
+        }),
+        ("GET /api/songs/top", None, {
+            "songs": [{"song": song(i), "plays": 100 - i, "last_played_at": now} for i in range(rows)],
+            "total": rows,
+        }),
+    ]
+
+
+def timed(fn, number: int) -> float:
+    started = time.perf_counter()
+    for _ in range(number):
+        fn()
+    return (time.perf_counter() - started) / number
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=50, help="songs/messages per response")
+    parser.add_argument("--clients", type=int, default=1000, help="sockets per chat broadcast")
+    parser.add_argument("--number", type=int, default=2000)
+    args = parser.parse_args()
+
+    backend = "orjson" if serialization.orjson is not None else "json (orjson not installed)"
+    print(f"encoder: {backend}\n")
+    print(f"{'endpoint':26} {'before us':>10} {'after us':>10} {'speedup':>8}")
+    for name, model, payload in payloads(args.rows):
+        if model is not None:
+            def before(model=model, payload=payload):
+                return stdlib_render(model.model_validate(payload).model_dump(mode="json"))
+        else:
+            def before(payload=payload):
+                return stdlib_render(jsonable_encoder(payload))
+        old = timed(before, args.number)
+        new = timed(lambda payload=payload: serialization.dumps(payload), args.number)
+        print(f"{name:26} {old * 1e6:10.1f} {new * 1e6:10.1f} {old / new:7.1f}x")
+
+    # Chat broadcast: serialize + encode the frame, parse it into the
+    # replay buffer, and put it on the wire for every socket in the room
+    message = chat_message(0, datetime.utcnow())
+    clients = range(args.clients)
+
+    def frame_before():
+        frame = json.dumps({**message, "timestamp": message["timestamp"].isoformat()})
+        json.loads(frame)
+        for _ in clients:
+            frame.encode()
+
+    def frame_after():
+        frame = serialization.dumps_text(message)
+        serialization.loads(frame)
+        frame.encode()
+
+    number = max(1, args.number // 10)
+    old = timed(frame_before, number)
+    new = timed(frame_after, number)
+    print(f"{'chat frame x' + str(args.clients) + ' sockets':26} {old * 1e6:10.1f} {new * 1e6:10.1f} {old / new:7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Compare a fresh httpx.AsyncClient per request against the pooled UpstreamClient.
+
+Start the stub first:  python youtube_stub.py --port 8002
+Then run (from backend/):  python benchmarks/bench_upstream_pool.py --requests 500
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from upstream import UpstreamClient  # noqa: E402
+
+
+def summarize(label: str, latencies, elapsed: float):
+    latencies = sorted(latencies)
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    print(
+        f"{label:<22} {len(latencies) / elapsed:8.1f} req/s  "
+        f"p50={statistics.median(latencies) * 1000:6.2f}ms  p99={p99 * 1000:6.2f}ms"
+    )
+
+
+async def run(label, call, total: int, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(i):
+        async with semaphore:
+            started = time.perf_counter()
+            await call(i)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(total)))
+    summarize(label, latencies, time.perf_counter() - started)
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--base-url", default="http://127.0.0.1:8002/youtube/v3")
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=20)
+    args = parser.parse_args()
+    params = {"part": "snippet", "maxResults": 5}
+
+    async def fresh_client(i):
+        async with httpx.AsyncClient(timeout=30.0) as client:
+            await client.get(f"{args.base_url}/search", params={**params, "q": f"q{i}"})
+
+    pooled = UpstreamClient("bench", args.base_url, max_keepalive_connections=args.concurrency)
+    await pooled.start()
+
+    async def pooled_client(i):
+        await pooled.get("/search", params={**params, "q": f"q{i}"})
+
+    try:
+        await run("client per request", fresh_client, args.requests, args.concurrency)
+        await run("pooled keep-alive", pooled_client, args.requests, args.concurrency)
+    finally:
+        await pooled.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
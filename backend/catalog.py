@@ -0,0 +1,259 @@
+"""
+Local song metadata catalog.
+
+Every song we see (search results, likes, plays) is upserted into the
+``songs`` collection keyed by its YouTube video id. Durations are not part of
+search results, so a background enricher resolves them lazily with batched
+``videos.list`` calls (up to 50 ids, 1 quota unit each). Liked songs, history
+and playlists store only song ids and hydrate metadata from here with a
+single ``$in`` query.
+
+Search results are decorated with durations on every request, cache hits
+included, so resolved durations are also kept in a bounded in-memory LRU.
+Once a duration is known it never changes; ids without one yet are
+re-checked in Mongo after a short interval (enrichment on another worker
+may have filled them in), so a repeated search costs no I/O.
+"""
+
+import asyncio
+import logging
+import re
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from pymongo import ASCENDING, DESCENDING, IndexModel, UpdateOne
+
+logger = logging.getLogger(__name__)
+
+VIDEOS_BATCH_SIZE = 50
+UNKNOWN_DURATION = "Unknown"
+# Stored for videos YouTube returned no duration for, so they are not retried
+UNAVAILABLE_SECONDS = -1
+
+ISO8601_DURATION = re.compile(r"P(?:(\d+)D)?T?(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?")
+
+
+def parse_duration(value: str) -> Optional[int]:
+    match = ISO8601_DURATION.fullmatch(value or "")
+    if not match or not any(match.groups()):
+        return None
+    days, hours, minutes, seconds = (int(part or 0) for part in match.groups())
+    return ((days * 24 + hours) * 60 + minutes) * 60 + seconds
+
+
+def format_duration(seconds: Optional[int]) -> str:
+    if seconds is None or seconds < 0:
+        return UNKNOWN_DURATION
+    hours, remainder = divmod(seconds, 3600)
+    minutes, secs = divmod(remainder, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{secs:02d}"
+    return f"{minutes}:{secs:02d}"
+
+
+def song_from_doc(doc: dict) -> dict:
+    return {
+        "id": doc["_id"],
+        "title": doc.get("title"),
+        "artist": doc.get("artist"),
+        "thumbnail": doc.get("thumbnail"),
+        "duration": format_duration(doc.get("duration_seconds")),
+        "published_at": doc.get("published_at"),
+    }
+
+
+class SongCatalog:
+    def __init__(
+        self,
+        db,
+        fetch_videos=None,
+        enrich_interval: float = 2.0,
+        duration_cache_size: int = 50000,
+        unknown_recheck_seconds: float = 10.0,
+    ):
+        # fetch_videos(ids) -> {id: iso8601 duration}; None disables enrichment
+        self.collection = db.songs
+        self.fetch_videos = fetch_videos
+        self.enrich_interval = enrich_interval
+        self.duration_cache_size = duration_cache_size
+        self.unknown_recheck_seconds = unknown_recheck_seconds
+        # song id -> (checked_at, formatted duration or None while unresolved)
+        self._durations: "OrderedDict[str, Tuple[float, Optional[str]]]" = OrderedDict()
+        # pause_when() -> True skips enrichment rounds (e.g. upstream quota spent)
+        self.pause_when: Optional[Callable[[], bool]] = None
+        self._pending: Dict[str, None] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._listeners: List[Callable[[List[dict]], None]] = []
+        self.upserts = 0
+        self.enriched = 0
+        self.enrich_calls = 0
+        self.enrich_errors = 0
+        self.duration_hits = 0
+        self.duration_misses = 0
+
+    @staticmethod
+    def register_indexes(index_manager):
+        index_manager.register(
+            "songs",
+            IndexModel([("duration_seconds", ASCENDING)], name="duration_seconds"),
+            IndexModel([("updated_at", DESCENDING)], name="updated_at"),
+        )
+
+    def add_listener(self, listener: Callable[[List[dict]], None]):
+        # Called with songs whose metadata was written authoritatively, and
+        # with client-supplied songs the catalog did not have before
+        self._listeners.append(listener)
+
+    async def start(self):
+        if self.fetch_videos is not None and self._task is None:
+            self._task = asyncio.create_task(self._enrich_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def upsert_many(self, songs: Iterable[dict], authoritative: bool = True):
+        # Client-supplied metadata (authoritative=False) never overwrites what we have
+        now = datetime.utcnow()
+        ops = []
+        written = []
+        for song in songs:
+            if not song.get("id"):
+                continue
+            written.append(song)
+            fields = {
+                key: song[key]
+                for key in ("title", "artist", "thumbnail", "published_at")
+                if song.get(key) is not None
+            }
+            on_insert = {"first_seen": now, "duration_seconds": None}
+            if authoritative:
+                fields["updated_at"] = now
+                update = {"$set": fields, "$setOnInsert": on_insert}
+            else:
+                update = {"$setOnInsert": {**on_insert, **fields, "updated_at": now}}
+            ops.append(UpdateOne({"_id": song["id"]}, update, upsert=True))
+        if not ops:
+            return
+        result = await self.collection.bulk_write(ops, ordered=False)
+        self.upserts += len(ops)
+        for song_id in result.upserted_ids.values():
+            self._pending[song_id] = None
+        if not authoritative:
+            # Only the inserted ones: client metadata never replaces ours
+            written = [written[index] for index in result.upserted_ids]
+        if written:
+            for listener in self._listeners:
+                listener(written)
+
+    async def hydrate(self, song_ids: Iterable[str]) -> Dict[str, dict]:
+        ids = list(dict.fromkeys(song_ids))
+        if not ids:
+            return {}
+        songs = {}
+        async for doc in self.collection.find({"_id": {"$in": ids}}):
+            songs[doc["_id"]] = song_from_doc(doc)
+        return songs
+
+    def _remember_duration(self, song_id: str, duration: Optional[str]):
+        self._durations[song_id] = (time.monotonic(), duration)
+        self._durations.move_to_end(song_id)
+        while len(self._durations) > self.duration_cache_size:
+            self._durations.popitem(last=False)
+
+    async def durations(self, song_ids: Iterable[str]) -> Dict[str, str]:
+        found = {}
+        missing = []
+        now = time.monotonic()
+        for song_id in dict.fromkeys(song_ids):
+            entry = self._durations.get(song_id)
+            if entry is None or (entry[1] is None and now - entry[0] >= self.unknown_recheck_seconds):
+                missing.append(song_id)
+                continue
+            self._durations.move_to_end(song_id)
+            self.duration_hits += 1
+            if entry[1] is not None:
+                found[song_id] = entry[1]
+        self.duration_misses += len(missing)
+        if not missing:
+            return found
+        resolved = {}
+        cursor = self.collection.find({"_id": {"$in": missing}}, {"duration_seconds": 1})
+        async for doc in cursor:
+            if doc.get("duration_seconds") is not None:
+                resolved[doc["_id"]] = format_duration(doc["duration_seconds"])
+        for song_id in missing:
+            self._remember_duration(song_id, resolved.get(song_id))
+        found.update(resolved)
+        return found
+
+    async def _next_batch(self) -> List[str]:
+        batch = list(self._pending)[:VIDEOS_BATCH_SIZE]
+        for song_id in batch:
+            del self._pending[song_id]
+        if not batch:
+            # Sweep for songs that missed enrichment (e.g. after a restart)
+            docs = await self.collection.find(
+                {"duration_seconds": None}, {"_id": 1}, limit=VIDEOS_BATCH_SIZE
+            ).to_list(length=VIDEOS_BATCH_SIZE)
+            batch = [doc["_id"] for doc in docs]
+        return batch
+
+    async def enrich_once(self) -> int:
+        if self.pause_when is not None and self.pause_when():
+            return 0
+        batch = await self._next_batch()
+        if not batch:
+            return 0
+        self.enrich_calls += 1
+        try:
+            durations = await self.fetch_videos(batch)
+        except Exception as e:
+            self.enrich_errors += 1
+            logger.error(f"Duration enrichment failed: {e}")
+            for song_id in batch:
+                self._pending[song_id] = None
+            return 0
+        ops = []
+        resolved = {}
+        for song_id in batch:
+            seconds = parse_duration(durations.get(song_id, ""))
+            resolved[song_id] = UNAVAILABLE_SECONDS if seconds is None else seconds
+            ops.append(UpdateOne({"_id": song_id}, {"$set": {"duration_seconds": resolved[song_id]}}))
+        await self.collection.bulk_write(ops, ordered=False)
+        for song_id, seconds in resolved.items():
+            self._remember_duration(song_id, format_duration(seconds))
+        self.enriched += len(ops)
+        return len(ops)
+
+    async def _enrich_loop(self):
+        while True:
+            try:
+                enriched = await self.enrich_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Catalog enrichment loop error: {e}")
+                enriched = 0
+            # Keep draining while there is a backlog, otherwise idle
+            if enriched < VIDEOS_BATCH_SIZE:
+                await asyncio.sleep(self.enrich_interval)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pending": len(self._pending),
+            "upserts": self.upserts,
+            "enriched": self.enriched,
+            "enrich_calls": self.enrich_calls,
+            "enrich_errors": self.enrich_errors,
+            "duration_cache_entries": len(self._durations),
+            "duration_cache_hits": self.duration_hits,
+            "duration_cache_misses": self.duration_misses,
+        }
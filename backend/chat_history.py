@@ -0,0 +1,276 @@
+"""
+Chat sequence numbers and the per-worker recent-message buffer.
+
+Every message gets a ``seq`` that increases across the whole deployment:
+from an ``$inc`` on a shared counter document, or from an in-process counter
+when a single worker is known to own the chat.
+
+The shared counter costs one primary round trip per allocation, and all
+workers update the same document. Pre-allocating blocks per worker would
+remove that, but it would break replay: a worker holding a lower block
+could publish after a client has already seen a higher seq from another
+worker, and ``seq > last_seq`` would then skip the message for good. What
+the sequencer does instead is coalesce: while one ``$inc`` is in flight,
+messages arriving on the same worker wait, and the next ``$inc`` claims the
+whole range for them in one update. An idle chat still pays one round trip
+per message (about a millisecond next to the primary). Under load each
+worker keeps at most one update in flight, so the counter document sees
+one writer per worker rather than one per message.
+``benchmarks/bench_chat_sequence.py`` measures both modes.
+
+Each worker keeps the most recent messages of every room in a bounded buffer, fed
+from the pub/sub bus, so reconnecting clients can be sent only what they
+missed (``seq > last_seq``) and the latest pages of ``/api/chat/messages``
+are served without touching Mongo.
+"""
+
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Deque, Dict, Iterable, List, Optional, Tuple
+
+from pymongo import ASCENDING, DESCENDING, IndexModel, ReadPreference, ReturnDocument
+
+from indexes import HotQuery
+from serialization import dumps_text
+
+logger = logging.getLogger(__name__)
+
+SEQ_COUNTER_ID = "chat_seq"
+LOCAL = "local"
+SHARED = "shared"
+
+
+class ChatSequencer:
+    def __init__(self, db, mode: str = SHARED, workers: int = 1):
+        if mode not in (LOCAL, SHARED):
+            raise ValueError(f"Unknown chat sequence mode: {mode}")
+        if mode == LOCAL and workers > 1:
+            # Each worker would count from the same seed and hand out duplicates
+            raise ValueError(f"Local chat sequence numbers need a single worker, got {workers}")
+        # The highest seq must come from the primary even when chat history
+        # reads are routed to secondaries
+        self.messages = db.chat_messages.with_options(read_preference=ReadPreference.PRIMARY)
+        self.counters = db.counters
+        self.mode = mode
+        self.value = 0
+        self._waiting: List[asyncio.Future] = []
+        self._allocator: Optional[asyncio.Task] = None
+        self.allocations = 0
+        self.allocated = 0
+
+    @staticmethod
+    def register_indexes(index_manager):
+        index_manager.register(
+            "chat_messages",
+            # Messages written before sequence numbers existed have no seq
+            IndexModel(
+                [("seq", ASCENDING)], name="seq_unique", unique=True,
+                partialFilterExpression={"seq": {"$exists": True}},
+            ),
+            IndexModel(
+                [("deleted", ASCENDING), ("room", ASCENDING), ("seq", DESCENDING)],
+                name="deleted_room_seq",
+            ),
+        )
+        index_manager.register_query(HotQuery(
+            "chat_messages.replay", "chat_messages", {"seq": {"$gt": 0}, "deleted": False},
+            sort=[("seq", ASCENDING)], limit=500,
+        ))
+
+    async def start(self):
+        newest = await self.messages.find_one(
+            {"seq": {"$exists": True}}, {"seq": 1}, sort=[("seq", DESCENDING)]
+        )
+        highest = newest["seq"] if newest else 0
+        counter = await self.counters.find_one_and_update(
+            {"_id": SEQ_COUNTER_ID},
+            {"$max": {"value": highest}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        self.value = counter["value"]
+
+    async def next(self) -> int:
+        if self.mode == LOCAL:
+            self.value += 1
+            return self.value
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiting.append(waiter)
+        if self._allocator is None:
+            self._allocator = asyncio.create_task(self._allocate())
+        return await waiter
+
+    async def _allocate(self):
+        # One $inc per round for everything that queued up during the last
+        # one; seqs are handed out in arrival order
+        batch: List[asyncio.Future] = []
+        try:
+            while self._waiting:
+                batch, self._waiting = self._waiting, []
+                try:
+                    counter = await self.counters.find_one_and_update(
+                        {"_id": SEQ_COUNTER_ID},
+                        {"$inc": {"value": len(batch)}},
+                        upsert=True,
+                        return_document=ReturnDocument.AFTER,
+                    )
+                except Exception as e:
+                    for waiter in batch:
+                        if not waiter.done():
+                            waiter.set_exception(e)
+                    continue
+                self.allocations += 1
+                self.allocated += len(batch)
+                self.value = counter["value"]
+                first = self.value - len(batch) + 1
+                for offset, waiter in enumerate(batch):
+                    # A sender that went away leaves a gap, which replay tolerates
+                    if not waiter.done():
+                        waiter.set_result(first + offset)
+        finally:
+            self._allocator = None
+            for waiter in batch + self._waiting:
+                if not waiter.done():
+                    waiter.cancel()
+            self._waiting = []
+
+    async def reassign(self) -> int:
+        # For a message whose seq was already taken: a local counter resyncs
+        # from what has been persisted before counting on
+        if self.mode == LOCAL:
+            await self.start()
+        return await self.next()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "mode": self.mode,
+            "value": self.value,
+            "allocations": self.allocations,
+            "allocated": self.allocated,
+        }
+
+    async def stop(self):
+        if self.mode == LOCAL:
+            # Lets a later shared-mode deployment continue from here
+            await self.counters.update_one(
+                {"_id": SEQ_COUNTER_ID}, {"$max": {"value": self.value}}, upsert=True
+            )
+
+
+class RecentMessages:
+    def __init__(self, capacity: int = 2000):
+        self.capacity = capacity
+        # (seq, message, frame), ordered by seq
+        self._entries: Deque[Tuple[int, dict, str]] = deque()
+        self._by_id: Dict[str, int] = {}
+        # True while the buffer holds every message that exists
+        self.complete = False
+        self.replays = 0
+        self.pages_served = 0
+        self.pages_missed = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def oldest_seq(self) -> Optional[int]:
+        return self._entries[0][0] if self._entries else None
+
+    def add(self, message: dict, frame: str):
+        seq = message["seq"]
+        if message["id"] in self._by_id:
+            return
+        entry = (seq, message, frame)
+        if not self._entries or seq > self._entries[-1][0]:
+            self._entries.append(entry)
+        else:
+            # Frames from other workers can arrive slightly out of order
+            index = len(self._entries)
+            while index > 0 and self._entries[index - 1][0] > seq:
+                index -= 1
+            self._entries.insert(index, entry)
+        self._by_id[message["id"]] = seq
+        while len(self._entries) > self.capacity:
+            _, evicted, _ = self._entries.popleft()
+            self._by_id.pop(evicted["id"], None)
+            self.complete = False
+
+    async def load(self, collection, serialize) -> int:
+        # From the primary: a lagging secondary would make "complete" a lie
+        collection = collection.with_options(read_preference=ReadPreference.PRIMARY)
+        docs = await collection.find(
+            {"seq": {"$exists": True}, "deleted": False},
+            sort=[("seq", DESCENDING)],
+            limit=self.capacity,
+        ).to_list(length=self.capacity)
+        for doc in reversed(docs):
+            message = serialize(doc)
+            self.add(message, dumps_text(message))
+        legacy = await collection.find_one({"seq": {"$exists": False}, "deleted": False}, {"_id": 1})
+        self.complete = len(docs) < self.capacity and legacy is None
+        logger.info(f"Chat buffer loaded {len(docs)} recent messages")
+        return len(docs)
+
+    def covers(self, last_seq: int) -> bool:
+        # Nothing after last_seq can be missing from the buffer
+        if self.complete:
+            return True
+        oldest = self.oldest_seq
+        return oldest is not None and oldest <= last_seq + 1
+
+    def since(self, last_seq: int, rooms: Iterable[str]) -> List[Tuple[dict, str]]:
+        rooms = set(rooms)
+        self.replays += 1
+        found = []
+        for seq, message, frame in reversed(self._entries):
+            if seq <= last_seq:
+                break
+            if message["room"] in rooms:
+                found.append((message, frame))
+        return found[::-1]
+
+    def page(self, room: str, limit: int, before: Optional[str] = None,
+             after: Optional[str] = None) -> Optional[Tuple[List[dict], bool]]:
+        # Returns (messages oldest-first, has_more), or None when the buffer
+        # cannot answer and the caller must go to Mongo
+        anchor = before or after
+        if anchor is not None and anchor not in self._by_id:
+            self.pages_missed += 1
+            return None
+        anchor_seq = self._by_id.get(anchor) if anchor else None
+        matched: List[dict] = []
+        if after is not None:
+            for seq, message, _ in self._entries:
+                if seq > anchor_seq and message["room"] == room:
+                    matched.append(message)
+                    if len(matched) > limit:
+                        break
+            # Everything newer than a buffered message is buffered too
+            self.pages_served += 1
+            return matched[:limit], len(matched) > limit
+        for seq, message, _ in reversed(self._entries):
+            if anchor_seq is not None and seq >= anchor_seq:
+                continue
+            if message["room"] == room:
+                matched.append(message)
+                if len(matched) > limit:
+                    break
+        if len(matched) <= limit and not self.complete:
+            # Older messages may exist beyond the buffer
+            self.pages_missed += 1
+            return None
+        self.pages_served += 1
+        return matched[:limit][::-1], len(matched) > limit
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "messages": len(self._entries),
+            "capacity": self.capacity,
+            "oldest_seq": self.oldest_seq,
+            "newest_seq": self._entries[-1][0] if self._entries else None,
+            "complete": self.complete,
+            "replays": self.replays,
+            "pages_served": self.pages_served,
+            "pages_missed": self.pages_missed,
+        }
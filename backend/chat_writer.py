@@ -0,0 +1,166 @@
+"""
+Persistence for chat messages.
+
+In ``sync`` mode every message is inserted before it is broadcast. In
+``write_behind`` mode messages are buffered and written with ``insert_many``
+every ``flush_interval_ms`` or once ``max_batch`` messages are queued, so the
+broadcast never waits on Mongo. Messages still buffered when the process dies
+are lost; ``stop()`` flushes them on a clean shutdown.
+
+A duplicate ``_id`` is a retried write that already landed. A duplicate
+``seq`` is a different message that lost a sequence race; it is given a
+fresh seq through ``resequence`` and written again rather than dropped.
+"""
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+SYNC = "sync"
+WRITE_BEHIND = "write_behind"
+
+MAX_RESEQUENCE_ATTEMPTS = 5
+
+
+def is_seq_conflict(error: Dict[str, Any]) -> bool:
+    if error.get("code") != 11000:
+        return False
+    return "seq" in (error.get("keyPattern") or {}) or "seq_unique" in (error.get("errmsg") or "")
+
+
+def duplicate_key_details(error: DuplicateKeyError) -> Dict[str, Any]:
+    return {"code": error.code, **(error.details or {})}
+
+
+class ChatWriter:
+    def __init__(
+        self,
+        collection,
+        mode: str = WRITE_BEHIND,
+        flush_interval_ms: float = 50,
+        max_batch: int = 500,
+        max_queue: int = 10000,
+        resequence: Optional[Callable[[], Awaitable[int]]] = None,
+    ):
+        if mode not in (SYNC, WRITE_BEHIND):
+            raise ValueError(f"Unknown chat persistence mode: {mode}")
+        self.collection = collection
+        self.mode = mode
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_batch = max_batch
+        self.max_queue = max_queue
+        self.resequence = resequence
+        self._buffer: List[dict] = []
+        self._wake = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.written = 0
+        self.batches = 0
+        self.failed = 0
+        self.resequenced = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    async def start(self):
+        if self.mode == WRITE_BEHIND and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def write(self, doc: dict):
+        if self.mode == SYNC or not self.running:
+            try:
+                await self.collection.insert_one(doc)
+            except DuplicateKeyError as e:
+                if not is_seq_conflict(duplicate_key_details(e)):
+                    raise
+                if not await self._insert_resequenced(doc):
+                    raise
+            self.written += 1
+            return
+        if len(self._buffer) >= self.max_queue:
+            # Apply backpressure to the writer instead of growing without bound
+            await self.flush()
+        self._buffer.append(doc)
+        if len(self._buffer) >= self.max_batch:
+            self._wake.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+
+    async def flush(self):
+        async with self._lock:
+            while self._buffer:
+                batch = self._buffer[:self.max_batch]
+                del self._buffer[:self.max_batch]
+                try:
+                    await self.collection.insert_many(batch, ordered=False)
+                    self.written += len(batch)
+                except BulkWriteError as e:
+                    # Duplicate ids from a retried batch are already persisted
+                    errors = e.details.get("writeErrors", [])
+                    failed = []
+                    for err in errors:
+                        if is_seq_conflict(err):
+                            if not await self._insert_resequenced(batch[err["index"]]):
+                                failed.append(err)
+                        elif err.get("code") != 11000:
+                            failed.append(err)
+                    self.written += len(batch) - len(failed)
+                    self.failed += len(failed)
+                    if failed:
+                        logger.error(f"Chat write-behind dropped {len(failed)} messages: {failed[0]}")
+                except Exception as e:
+                    logger.error(f"Chat write-behind flush failed, will retry: {e}")
+                    self._buffer[:0] = batch
+                    self.failed += 1
+                    return
+                finally:
+                    self.batches += 1
+
+    async def _insert_resequenced(self, doc: dict) -> bool:
+        if self.resequence is None:
+            return False
+        for _ in range(MAX_RESEQUENCE_ATTEMPTS):
+            taken = doc["seq"]
+            doc["seq"] = await self.resequence()
+            self.resequenced += 1
+            logger.warning(f"Chat message {doc['_id']} seq {taken} was taken, persisting as {doc['seq']}")
+            try:
+                await self.collection.insert_one(doc)
+                return True
+            except DuplicateKeyError as e:
+                if not is_seq_conflict(duplicate_key_details(e)):
+                    return True
+        return False
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "mode": self.mode,
+            "running": self.running,
+            "buffered": len(self._buffer),
+            "written": self.written,
+            "batches": self.batches,
+            "failed": self.failed,
+            "resequenced": self.resequenced,
+        }
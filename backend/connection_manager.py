@@ -0,0 +1,261 @@
+"""
+WebSocket fan-out for chat.
+
+Every connection gets a bounded outbound queue drained by its own writer
+task, so ``broadcast`` only enqueues the (once-encoded) frame and returns.
+A slow or stalled client backs up its own queue and is handled by the
+slow-consumer policy without delaying anyone else:
+
+* ``drop_oldest`` - discard the oldest queued frame to make room
+* ``disconnect``  - close the connection once its queue is full
+
+Connections are registered by id in plain dicts (per user and per room), so
+connect and disconnect are O(1) and a user may hold several sockets (tabs).
+A heartbeat task pings idle sockets and reaps those that stay silent past
+``idle_timeout``.
+
+Clients that opt into binary frames are sent the UTF-8 bytes of the same JSON.
+A broadcast encodes those bytes once and shares them across every binary
+connection, where a text frame is re-encoded by the server for each socket.
+"""
+
+import asyncio
+import itertools
+import logging
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Iterable, Optional, Union
+
+from fastapi import WebSocket
+
+logger = logging.getLogger(__name__)
+
+DROP_OLDEST = "drop_oldest"
+DISCONNECT = "disconnect"
+
+DEFAULT_ROOM = "global"
+PING_FRAME = '{"type": "ping"}'
+PING_FRAME_BYTES = PING_FRAME.encode()
+
+Frame = Union[str, bytes]
+
+
+class ClientConnection:
+    def __init__(self, manager: "ConnectionManager", connection_id: str, websocket: WebSocket,
+                 user_id: str, rooms: Iterable[str], binary: bool = False):
+        self.manager = manager
+        self.id = connection_id
+        self.websocket = websocket
+        self.user_id = user_id
+        self.rooms = set(rooms)
+        self.binary = binary
+        self.last_seen = time.monotonic()
+        self.queue: Deque[Frame] = deque()
+        self._ready = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        self.closed = False
+
+    def start(self):
+        self.task = asyncio.create_task(self._writer())
+
+    def touch(self):
+        self.last_seen = time.monotonic()
+
+    def enqueue(self, frame: Frame) -> bool:
+        if self.closed:
+            return False
+        if self.binary and isinstance(frame, str):
+            frame = frame.encode()
+        if len(self.queue) >= self.manager.max_queue:
+            if self.manager.slow_consumer_policy == DROP_OLDEST:
+                self.queue.popleft()
+                self.manager.dropped_frames += 1
+            else:
+                return False
+        self.queue.append(frame)
+        self._ready.set()
+        return True
+
+    async def _writer(self):
+        manager = self.manager
+        try:
+            while True:
+                await self._ready.wait()
+                self._ready.clear()
+                while self.queue:
+                    frame = self.queue.popleft()
+                    started = time.perf_counter()
+                    if isinstance(frame, bytes):
+                        send = self.websocket.send_bytes(frame)
+                    else:
+                        send = self.websocket.send_text(frame)
+                    await asyncio.wait_for(send, timeout=manager.send_timeout)
+                    manager.record_send(time.perf_counter() - started)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Failed to send to user {self.user_id}: {e!r}")
+            manager.send_failures += 1
+            await manager.drop(self)
+
+    def stop(self):
+        self.closed = True
+        self.queue.clear()
+        if self.task is not None and self.task is not asyncio.current_task():
+            self.task.cancel()
+
+
+class ConnectionManager:
+    def __init__(
+        self,
+        max_queue: int = 256,
+        slow_consumer_policy: str = DROP_OLDEST,
+        send_timeout: float = 5.0,
+        heartbeat_interval: float = 30.0,
+        idle_timeout: float = 90.0,
+    ):
+        if slow_consumer_policy not in (DROP_OLDEST, DISCONNECT):
+            raise ValueError(f"Unknown slow consumer policy: {slow_consumer_policy}")
+        self.max_queue = max_queue
+        self.slow_consumer_policy = slow_consumer_policy
+        self.send_timeout = send_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.idle_timeout = idle_timeout
+        self.connections: Dict[str, ClientConnection] = {}
+        self.user_connections: Dict[str, Dict[str, ClientConnection]] = {}
+        self.rooms: Dict[str, Dict[str, ClientConnection]] = {}
+        self._ids = itertools.count(1)
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        self.broadcasts = 0
+        self.frames_sent = 0
+        self.dropped_frames = 0
+        self.slow_disconnects = 0
+        self.send_failures = 0
+        self.reaped = 0
+        self.send_time_total = 0.0
+        self.send_time_max = 0.0
+
+    async def start(self):
+        if self.heartbeat_interval > 0 and self._heartbeat_task is None:
+            self._heartbeat_task = asyncio.create_task(self._heartbeat())
+
+    async def stop(self):
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+            try:
+                await self._heartbeat_task
+            except asyncio.CancelledError:
+                pass
+            self._heartbeat_task = None
+
+    async def connect(self, websocket: WebSocket, user_id: str,
+                      rooms: Iterable[str] = (DEFAULT_ROOM,), binary: bool = False) -> ClientConnection:
+        await websocket.accept()
+        connection_id = f"{user_id}:{next(self._ids)}"
+        connection = ClientConnection(self, connection_id, websocket, user_id, rooms, binary)
+        self.connections[connection_id] = connection
+        self.user_connections.setdefault(user_id, {})[connection_id] = connection
+        for room in connection.rooms:
+            self.rooms.setdefault(room, {})[connection_id] = connection
+        connection.start()
+        logger.info(
+            "User %s connected to chat (%s)", user_id, connection_id,
+            extra={"sample": "chat_connect", "user_id": user_id, "connection_id": connection_id}
+        )
+        return connection
+
+    def _unregister(self, connection: ClientConnection) -> bool:
+        if self.connections.pop(connection.id, None) is None:
+            return False
+        user_sockets = self.user_connections.get(connection.user_id)
+        if user_sockets is not None:
+            user_sockets.pop(connection.id, None)
+            if not user_sockets:
+                del self.user_connections[connection.user_id]
+        for room in connection.rooms:
+            members = self.rooms.get(room)
+            if members is not None:
+                members.pop(connection.id, None)
+                if not members:
+                    del self.rooms[room]
+        connection.stop()
+        return True
+
+    def disconnect(self, connection: ClientConnection):
+        if self._unregister(connection):
+            logger.info(
+                "User %s disconnected from chat (%s)", connection.user_id, connection.id,
+                extra={"sample": "chat_connect", "user_id": connection.user_id, "connection_id": connection.id}
+            )
+
+    async def drop(self, connection: ClientConnection):
+        self._unregister(connection)
+        try:
+            await connection.websocket.close()
+        except Exception:
+            pass
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            now = time.monotonic()
+            for connection in list(self.connections.values()):
+                idle = now - connection.last_seen
+                if idle > self.idle_timeout:
+                    logger.info(f"Reaping idle chat connection {connection.id}")
+                    self.reaped += 1
+                    await self.drop(connection)
+                elif idle > self.heartbeat_interval:
+                    connection.enqueue(PING_FRAME_BYTES if connection.binary else PING_FRAME)
+
+    def record_send(self, elapsed: float):
+        self.frames_sent += 1
+        self.send_time_total += elapsed
+        if elapsed > self.send_time_max:
+            self.send_time_max = elapsed
+
+    async def _fan_out(self, connections: Iterable[ClientConnection], message: str):
+        # The frame is encoded once by the caller and shared by every queue;
+        # its bytes are likewise encoded once for all binary connections
+        encoded: Optional[bytes] = None
+        slow = []
+        for connection in connections:
+            frame: Frame = message
+            if connection.binary:
+                if encoded is None:
+                    encoded = message.encode()
+                frame = encoded
+            if not connection.enqueue(frame):
+                slow.append(connection)
+        for connection in slow:
+            logger.warning(f"Disconnecting slow chat consumer {connection.id}")
+            self.slow_disconnects += 1
+            await self.drop(connection)
+
+    async def send_personal_message(self, message: str, user_id: str):
+        await self._fan_out(list(self.user_connections.get(user_id, {}).values()), message)
+
+    async def broadcast(self, message: str, room: str = DEFAULT_ROOM):
+        self.broadcasts += 1
+        await self._fan_out(list(self.rooms.get(room, {}).values()), message)
+
+    def stats(self) -> Dict[str, Any]:
+        depths = [len(c.queue) for c in self.connections.values()]
+        return {
+            "connections": len(self.connections),
+            "users": len(self.user_connections),
+            "binary_connections": sum(1 for c in self.connections.values() if c.binary),
+            "rooms": {room: len(members) for room, members in self.rooms.items()},
+            "slow_consumer_policy": self.slow_consumer_policy,
+            "max_queue": self.max_queue,
+            "queued_frames": sum(depths),
+            "max_queue_depth": max(depths, default=0),
+            "broadcasts": self.broadcasts,
+            "frames_sent": self.frames_sent,
+            "dropped_frames": self.dropped_frames,
+            "slow_disconnects": self.slow_disconnects,
+            "send_failures": self.send_failures,
+            "reaped": self.reaped,
+            "avg_send_ms": round(self.send_time_total / self.frames_sent * 1000, 3) if self.frames_sent else 0.0,
+            "max_send_ms": round(self.send_time_max * 1000, 3),
+        }
@@ -0,0 +1,185 @@
+"""
+MongoDB pool warm-up, cached health and per-collection read preferences.
+
+Motor connects lazily, so creating the client costs nothing. The app's
+lifespan calls ``MongoHealth.warm_up`` to open the pool's connections
+before the worker starts taking traffic, then runs a background pinger
+whose cached result answers readiness probes. Aggressive orchestrator
+probing therefore adds no database load.
+
+``RoutedDatabase`` hands out the listed collections with their own read
+preference, such as chat history and catalog reads from secondaries. Every
+other collection uses the client default. Reads that must see the latest
+write pin themselves to the primary with ``with_options``.
+"""
+
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from pymongo.read_preferences import Nearest, Primary, PrimaryPreferred, Secondary, SecondaryPreferred
+
+logger = logging.getLogger(__name__)
+
+READ_PREFERENCE_MODES = {
+    "primary": Primary,
+    "primaryPreferred": PrimaryPreferred,
+    "secondary": Secondary,
+    "secondaryPreferred": SecondaryPreferred,
+    "nearest": Nearest,
+}
+
+
+def parse_read_preferences(value: str, max_staleness_seconds: int = -1) -> Dict[str, Any]:
+    # "chat_messages=secondaryPreferred,songs=nearest" -> {collection: read preference}
+    preferences = {}
+    for part in filter(None, (item.strip() for item in value.split(","))):
+        collection, _, mode = part.partition("=")
+        mode_class = READ_PREFERENCE_MODES.get(mode.strip())
+        if mode_class is None:
+            raise ValueError(f"Unknown read preference '{mode.strip()}' for {collection.strip()}")
+        if mode_class is Primary:
+            preferences[collection.strip()] = Primary()
+        else:
+            preferences[collection.strip()] = mode_class(max_staleness=max_staleness_seconds)
+    return preferences
+
+
+class RoutedDatabase:
+    """A database whose configured collections carry their own read preference."""
+
+    def __init__(self, db, read_preferences: Dict[str, Any]):
+        self._db = db
+        self.read_preferences = read_preferences
+
+    def __getitem__(self, name: str):
+        preference = self.read_preferences.get(name)
+        if preference is None:
+            return self._db[name]
+        return self._db.get_collection(name, read_preference=preference)
+
+    def __getattr__(self, name: str):
+        # Database methods (command, create_collection...) pass through;
+        # any other attribute is a collection, as on a Motor database
+        if name.startswith("_") or hasattr(type(self._db), name):
+            return getattr(self._db, name)
+        return self[name]
+
+
+class MongoHealth:
+    def __init__(self, client, interval_seconds: float = 5.0, timeout_seconds: float = 2.0,
+                 failure_threshold: int = 2):
+        self.client = client
+        self.interval = interval_seconds
+        self.timeout = timeout_seconds
+        self.failure_threshold = failure_threshold
+        self.ok = False
+        self.draining = False
+        self.consecutive_failures = 0
+        self.last_check_at: Optional[datetime] = None
+        self.last_ok_at: Optional[datetime] = None
+        self.last_error: Optional[str] = None
+        self.latency_ms: Optional[float] = None
+        self.warm_connections = 0
+        self.warm_up_ms: Optional[float] = None
+        self.checks = 0
+        self._checked_at = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    async def warm_up(self, connections: int) -> bool:
+        # Concurrent pings each check out their own pooled connection, so the
+        # first requests do not pay for TCP/TLS setup and authentication
+        started = time.perf_counter()
+        results = await asyncio.gather(
+            *(self._ping() for _ in range(max(1, connections))), return_exceptions=True
+        )
+        failures = [result for result in results if isinstance(result, Exception)]
+        self.warm_connections = len(results) - len(failures)
+        self.warm_up_ms = round((time.perf_counter() - started) * 1000, 2)
+        if failures:
+            self._record_failure(failures[0])
+            logger.error(f"MongoDB warm-up failed: {failures[0]!r}")
+        else:
+            self._record_success(self.warm_up_ms)
+            logger.info(f"MongoDB pool warmed with {self.warm_connections} connections in {self.warm_up_ms} ms")
+        return not failures
+
+    async def _ping(self):
+        await asyncio.wait_for(self.client.admin.command("ping"), timeout=self.timeout)
+
+    async def check(self) -> bool:
+        started = time.perf_counter()
+        try:
+            await self._ping()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._record_failure(e)
+        else:
+            self._record_success(round((time.perf_counter() - started) * 1000, 2))
+        return self.ok
+
+    def _record_success(self, latency_ms: float):
+        if not self.ok:
+            logger.info("MongoDB is reachable")
+        self.ok = True
+        self.consecutive_failures = 0
+        self.latency_ms = latency_ms
+        self.last_error = None
+        self.last_check_at = self.last_ok_at = datetime.utcnow()
+        self._checked_at = time.monotonic()
+        self.checks += 1
+
+    def _record_failure(self, error: BaseException):
+        self.consecutive_failures += 1
+        self.last_error = repr(error)
+        self.last_check_at = datetime.utcnow()
+        self._checked_at = time.monotonic()
+        self.checks += 1
+        # One lost ping is not an outage
+        if self.ok and self.consecutive_failures >= self.failure_threshold:
+            logger.error(f"MongoDB unreachable after {self.consecutive_failures} checks: {self.last_error}")
+            self.ok = False
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # Stop advertising readiness first so traffic drains before shutdown
+        self.draining = True
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.check()
+
+    @property
+    def ready(self) -> bool:
+        # A pinger that stopped reporting is as bad as a failed ping
+        fresh = time.monotonic() - self._checked_at < self.interval * 3 + self.timeout
+        return self.ok and fresh and not self.draining
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "ready": self.ready,
+            "ok": self.ok,
+            "draining": self.draining,
+            "consecutive_failures": self.consecutive_failures,
+            "last_check_at": self.last_check_at,
+            "last_ok_at": self.last_ok_at,
+            "last_error": self.last_error,
+            "latency_ms": self.latency_ms,
+            "warm_connections": self.warm_connections,
+            "warm_up_ms": self.warm_up_ms,
+            "checks": self.checks,
+        }
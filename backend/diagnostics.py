@@ -0,0 +1,183 @@
+"""
+Event-loop diagnostics for live workers.
+
+``LoopWatchdog`` keeps a heartbeat task on the loop and a watchdog thread off
+it. When the heartbeat is late by more than the threshold, the thread grabs
+the loop thread's current stack, which is the code that is blocking it
+(a synchronous hash, a big ``json.dumps``, a blocking log handler...).
+Heartbeat delays double as event-loop lag samples.
+
+``SamplingProfiler`` samples a thread's stack at a fixed rate for a bounded
+time and returns collapsed stacks ("frame;frame;frame count" per line),
+which flamegraph.pl, speedscope and most flamegraph viewers accept.
+"""
+
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime
+from typing import Any, Deque, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def format_frame(frame) -> str:
+    code = frame.f_code
+    path = os.path.join(*code.co_filename.split(os.sep)[-2:]) if code.co_filename else "?"
+    # Folded stacks use ";" as the frame separator
+    return f"{code.co_name} ({path}:{code.co_firstlineno})".replace(";", ":")
+
+
+def stack_frames(frame, limit: int = 64) -> List[str]:
+    # Root first, as flamegraphs expect
+    frames = []
+    while frame is not None and len(frames) < limit:
+        frames.append(format_frame(frame))
+        frame = frame.f_back
+    return frames[::-1]
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class LoopWatchdog:
+    def __init__(self, threshold_ms: float = 100, interval_ms: float = 20, max_events: int = 100):
+        self.threshold = threshold_ms / 1000
+        self.interval = interval_ms / 1000
+        self.events: Deque[Dict[str, Any]] = deque(maxlen=max_events)
+        self.lags: Deque[float] = deque(maxlen=2048)
+        self._last_beat = time.monotonic()
+        self._loop_thread: Optional[int] = None
+        self._open_event: Optional[Dict[str, Any]] = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._task: Optional[asyncio.Task] = None
+        self.stalls = 0
+
+    async def start(self):
+        if self._task is not None:
+            return
+        self._loop_thread = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    async def stop(self):
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+            self._thread = None
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - expected)
+            with self._lock:
+                self._last_beat = now
+                self.lags.append(lag)
+                if self._open_event is not None:
+                    # The stall is over; record how long it really lasted
+                    self._open_event["blocked_ms"] = round(lag * 1000, 1)
+                    self._open_event = None
+
+    def _watch(self):
+        while not self._stop.wait(self.interval):
+            with self._lock:
+                late = time.monotonic() - self._last_beat - self.interval
+                if late < self.threshold or self._open_event is not None:
+                    continue
+                frame = sys._current_frames().get(self._loop_thread)
+                event = {
+                    "at": datetime.utcnow(),
+                    "blocked_ms": round(late * 1000, 1),
+                    "stack": stack_frames(frame) if frame is not None else [],
+                }
+                self._open_event = event
+                self.events.append(event)
+                self.stalls += 1
+            logger.warning(
+                f"Event loop blocked for over {late * 1000:.0f} ms in "
+                f"{event['stack'][-1] if event['stack'] else 'unknown code'}"
+            )
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lags = list(self.lags)
+            events = [dict(event) for event in self.events]
+        return {
+            "running": self._task is not None,
+            "threshold_ms": self.threshold * 1000,
+            "lag_ms": {
+                "samples": len(lags),
+                "p50": round(percentile(lags, 0.5) * 1000, 3),
+                "p99": round(percentile(lags, 0.99) * 1000, 3),
+                "max": round(max(lags, default=0.0) * 1000, 3),
+            },
+            "stalls": self.stalls,
+            "slow_events": events[::-1],
+        }
+
+
+class ProfilerBusy(RuntimeError):
+    pass
+
+
+class SamplingProfiler:
+    def __init__(self, max_seconds: float = 60, max_hz: int = 1000):
+        self.max_seconds = max_seconds
+        self.max_hz = max_hz
+        self._running = threading.Lock()
+        self.runs = 0
+
+    def _sample(self, thread_ids: Optional[List[int]], seconds: float, hz: int) -> Counter:
+        stacks: Counter = Counter()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        me = threading.get_ident()
+        period = 1 / hz
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident == me or (thread_ids is not None and ident not in thread_ids):
+                    continue
+                frames = stack_frames(frame)
+                if thread_ids is None or len(thread_ids) > 1:
+                    frames.insert(0, names.get(ident, str(ident)).replace(";", ":"))
+                stacks[";".join(frames)] += 1
+            time.sleep(period)
+        return stacks
+
+    async def profile(self, seconds: float, hz: int = 100, thread_ids: Optional[List[int]] = None) -> str:
+        # thread_ids=None samples every thread, each rooted at its thread name
+        if not self._running.acquire(blocking=False):
+            raise ProfilerBusy("A profile is already running")
+        try:
+            seconds = max(0.1, min(seconds, self.max_seconds))
+            hz = max(1, min(hz, self.max_hz))
+            self.runs += 1
+            # Sample from a thread so the loop keeps serving the traffic we profile
+            stacks = await asyncio.get_running_loop().run_in_executor(
+                None, self._sample, thread_ids, seconds, hz
+            )
+        finally:
+            self._running.release()
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
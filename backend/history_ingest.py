@@ -0,0 +1,298 @@
+"""
+Buffered ingestion of "song played" events.
+
+Plays are appended to an in-process buffer and written with one unordered
+``bulk_write`` per flush. Events carrying an idempotency key get a
+deterministic ``_id`` so a retried request hits a duplicate-key error and is
+dropped instead of being counted twice. After each flush the newly inserted
+events are folded into per-user and per-song play-count rollups, which the
+"top played" views read instead of scanning raw history.
+
+Rows are written with ``rollup: "pending"``. A flush claims its rows by
+swapping that marker for a one-off token (an atomic per-row update, so a row
+is claimed by exactly one worker), rolls the claimed rows up and then drops
+the marker. A failed rollup puts the marker back, and a periodic sweep
+claims any pending rows left behind: rollups that failed, and rows whose
+insert landed even though the flush saw an error (they come back as
+duplicate keys on the retry). Counts therefore converge on what is in
+``listening_history``. Without transactions a rollup that fails part-way
+through may be applied twice when retried, and a worker that dies between
+claiming and rolling up leaves its rows claimed.
+"""
+
+import asyncio
+import logging
+import random
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from pymongo import ASCENDING, DESCENDING, IndexModel, InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from indexes import HotQuery
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_PENDING = "pending"
+
+
+def play_event_id(user_id: str, idempotency_key: Optional[str]) -> str:
+    if idempotency_key:
+        return f"{user_id}:{idempotency_key}"
+    return str(uuid.uuid4())
+
+
+class HistoryIngestor:
+    def __init__(
+        self,
+        db,
+        library,
+        flush_interval_ms: float = 250,
+        max_batch: int = 1000,
+        max_buffer: int = 50000,
+        sweep_interval: float = 30.0,
+        sweep_limit: int = 1000,
+    ):
+        self.history = db.listening_history
+        self.user_counts = db.play_counts_user
+        self.song_counts = db.play_counts_song
+        self.library = library
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_batch = max_batch
+        self.max_buffer = max_buffer
+        self.sweep_interval = sweep_interval
+        self.sweep_limit = sweep_limit
+        self._buffer: List[dict] = []
+        self._wake = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.accepted = 0
+        self.inserted = 0
+        self.duplicates = 0
+        self.failed = 0
+        self.flushes = 0
+        self.rolled_up = 0
+        self.rollup_failures = 0
+        self.swept = 0
+
+    @staticmethod
+    def register_indexes(index_manager):
+        index_manager.register(
+            "listening_history",
+            # Only rows still waiting for (or in) a rollup carry the field
+            IndexModel([("rollup", ASCENDING)], name="rollup_pending",
+                       partialFilterExpression={"rollup": {"$exists": True}}),
+        )
+        index_manager.register(
+            "play_counts_user",
+            IndexModel([("user_id", ASCENDING), ("count", DESCENDING)], name="user_count"),
+        )
+        index_manager.register(
+            "play_counts_song",
+            IndexModel([("count", DESCENDING)], name="count"),
+        )
+        index_manager.register_query(HotQuery(
+            "play_counts_user.top", "play_counts_user", {"user_id": "probe"},
+            sort=[("count", DESCENDING)], limit=20,
+        ))
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def submit(self, user_id: str, events: List[dict]) -> List[str]:
+        # events: [{"song_id", "played_at", "idempotency_key"}]
+        if len(self._buffer) + len(events) > self.max_buffer:
+            await self.flush()
+        ids = []
+        for event in events:
+            doc = {
+                "_id": play_event_id(user_id, event.get("idempotency_key")),
+                "user_id": user_id,
+                "song_id": event["song_id"],
+                "played_at": event.get("played_at") or datetime.utcnow(),
+                "rollup": ROLLUP_PENDING,
+            }
+            self._buffer.append(doc)
+            ids.append(doc["_id"])
+        self.accepted += len(events)
+        if self._task is None:
+            await self.flush()
+        elif len(self._buffer) >= self.max_batch:
+            self._wake.set()
+        return ids
+
+    async def _run(self):
+        last_sweep = time.monotonic()
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+            if time.monotonic() - last_sweep >= self.sweep_interval:
+                last_sweep = time.monotonic()
+                await self.sweep()
+
+    async def flush(self):
+        async with self._lock:
+            while self._buffer:
+                batch = self._buffer[:self.max_batch]
+                del self._buffer[:self.max_batch]
+                self.flushes += 1
+                rejected = set()
+                duplicate_ids = []
+                try:
+                    await self.history.bulk_write([InsertOne(doc) for doc in batch], ordered=False)
+                except BulkWriteError as e:
+                    for err in e.details.get("writeErrors", []):
+                        rejected.add(err["index"])
+                        if err.get("code") == 11000:
+                            self.duplicates += 1
+                            # Possibly our own insert from a flush that errored
+                            # after writing; the claim skips rows already counted
+                            duplicate_ids.append(batch[err["index"]]["_id"])
+                        else:
+                            self.failed += 1
+                except Exception as e:
+                    logger.error(f"History flush failed, will retry: {e}")
+                    self._buffer[:0] = batch
+                    return
+
+                inserted = [doc for i, doc in enumerate(batch) if i not in rejected]
+                self.inserted += len(inserted)
+                await self._claim_and_rollup(inserted, duplicate_ids)
+                if inserted:
+                    await self._maybe_trim({doc["user_id"] for doc in inserted})
+
+    async def sweep(self) -> int:
+        # Roll up pending rows no flush finished with
+        try:
+            docs = await self.history.find(
+                {"rollup": ROLLUP_PENDING}, {"_id": 1}, limit=self.sweep_limit
+            ).to_list(length=self.sweep_limit)
+        except Exception as e:
+            logger.error(f"Play count sweep failed: {e}")
+            return 0
+        if not docs:
+            return 0
+        rolled_up = await self._claim_and_rollup([], [doc["_id"] for doc in docs])
+        self.swept += rolled_up
+        return rolled_up
+
+    async def _claim_and_rollup(self, inserted: List[dict], other_ids: List[str]) -> int:
+        ids = [doc["_id"] for doc in inserted] + other_ids
+        if not ids:
+            return 0
+        token = uuid.uuid4().hex
+        try:
+            claimed = await self.history.update_many(
+                {"_id": {"$in": ids}, "rollup": ROLLUP_PENDING}, {"$set": {"rollup": token}}
+            )
+        except Exception as e:
+            self.rollup_failures += 1
+            logger.error(f"Play count rollup claim failed, left for the sweep: {e}")
+            return 0
+        if not claimed.modified_count:
+            return 0
+        try:
+            if not other_ids and claimed.modified_count == len(inserted):
+                # Claimed every row this flush wrote: the buffered docs are the rows
+                events = inserted
+            else:
+                events = await self.history.find({"rollup": token}).to_list(length=len(ids))
+            await self._rollup(events)
+        except Exception as e:
+            self.rollup_failures += 1
+            logger.error(f"Play count rollup failed, left for the sweep: {e}")
+            await self._release(token, {"$set": {"rollup": ROLLUP_PENDING}})
+            return 0
+        await self._release(token, {"$unset": {"rollup": ""}})
+        self.rolled_up += len(events)
+        return len(events)
+
+    async def _release(self, token: str, update: dict):
+        try:
+            await self.history.update_many({"rollup": token}, update)
+        except Exception as e:
+            logger.error(f"Releasing rollup claim {token} failed: {e}")
+
+    async def _rollup(self, events: List[dict]):
+        per_user: Dict[tuple, Dict[str, Any]] = defaultdict(lambda: {"count": 0, "last": None})
+        per_song: Dict[str, Dict[str, Any]] = defaultdict(lambda: {"count": 0, "last": None})
+        for event in events:
+            user_entry = per_user[(event["user_id"], event["song_id"])]
+            song_entry = per_song[event["song_id"]]
+            for entry in (user_entry, song_entry):
+                entry["count"] += 1
+                if entry["last"] is None or event["played_at"] > entry["last"]:
+                    entry["last"] = event["played_at"]
+
+        user_ops = [
+            UpdateOne(
+                {"_id": f"{user_id}:{song_id}"},
+                {
+                    "$inc": {"count": entry["count"]},
+                    "$max": {"last_played_at": entry["last"]},
+                    "$setOnInsert": {"user_id": user_id, "song_id": song_id},
+                },
+                upsert=True,
+            )
+            for (user_id, song_id), entry in per_user.items()
+        ]
+        song_ops = [
+            UpdateOne(
+                {"_id": song_id},
+                {"$inc": {"count": entry["count"]}, "$max": {"last_played_at": entry["last"]}},
+                upsert=True,
+            )
+            for song_id, entry in per_song.items()
+        ]
+        await self.user_counts.bulk_write(user_ops, ordered=False)
+        await self.song_counts.bulk_write(song_ops, ordered=False)
+
+    async def _maybe_trim(self, user_ids):
+        for user_id in user_ids:
+            if random.random() < self.library.trim_probability:
+                try:
+                    await self.library.trim_history(user_id)
+                except Exception as e:
+                    logger.error(f"History trim failed for {user_id}: {e}")
+
+    async def top_for_user(self, user_id: str, limit: int = 20) -> List[dict]:
+        return await self.user_counts.find(
+            {"user_id": user_id}, sort=[("count", DESCENDING)], limit=limit
+        ).to_list(length=limit)
+
+    async def top_songs(self, limit: int = 20) -> List[dict]:
+        return await self.song_counts.find(
+            {}, sort=[("count", DESCENDING)], limit=limit
+        ).to_list(length=limit)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "running": self._task is not None,
+            "buffered": len(self._buffer),
+            "accepted": self.accepted,
+            "inserted": self.inserted,
+            "duplicates": self.duplicates,
+            "failed": self.failed,
+            "flushes": self.flushes,
+            "rolled_up": self.rolled_up,
+            "rollup_failures": self.rollup_failures,
+            "swept": self.swept,
+        }
@@ -0,0 +1,130 @@
+"""
+Index bootstrap and query-plan verification.
+
+Every collection's required indexes are declared here (or registered by the
+subsystem that owns the collection) and created idempotently at startup.
+With ``check_mode`` set to ``warn`` or ``strict`` each registered hot query is
+run through ``explain()``; a COLLSCAN in the winning plan is logged, and in
+``strict`` mode aborts startup.
+"""
+
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+
+logger = logging.getLogger(__name__)
+
+CHECK_OFF = "off"
+CHECK_WARN = "warn"
+CHECK_STRICT = "strict"
+
+
+class IndexCheckError(RuntimeError):
+    pass
+
+
+class HotQuery:
+    def __init__(self, name: str, collection: str, filter: dict,
+                 sort: Optional[List[Tuple[str, int]]] = None, limit: int = 0):
+        self.name = name
+        self.collection = collection
+        self.filter = filter
+        self.sort = sort
+        self.limit = limit
+
+
+def find_stages(plan: Any) -> List[str]:
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages.extend(find_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(find_stages(value))
+    return stages
+
+
+class IndexManager:
+    def __init__(self, db, check_mode: str = CHECK_OFF):
+        if check_mode not in (CHECK_OFF, CHECK_WARN, CHECK_STRICT):
+            raise ValueError(f"Unknown index check mode: {check_mode}")
+        self.db = db
+        self.check_mode = check_mode
+        self.indexes: Dict[str, List[IndexModel]] = {}
+        self.queries: List[HotQuery] = []
+        self.report: Dict[str, Any] = {"created": {}, "errors": [], "plans": {}}
+
+    def register(self, collection: str, *indexes: IndexModel):
+        self.indexes.setdefault(collection, []).extend(indexes)
+
+    def register_query(self, query: HotQuery):
+        self.queries.append(query)
+
+    async def ensure(self):
+        for collection, indexes in self.indexes.items():
+            try:
+                names = await self.db[collection].create_indexes(indexes)
+                self.report["created"][collection] = names
+            except Exception as e:
+                # Typically duplicate data blocking a unique index
+                message = f"Index creation failed on {collection}: {e}"
+                logger.error(message)
+                self.report["errors"].append(message)
+                if self.check_mode == CHECK_STRICT:
+                    raise IndexCheckError(message)
+        logger.info(f"Indexes ensured on {len(self.indexes)} collections")
+
+    async def verify_plans(self):
+        if self.check_mode == CHECK_OFF:
+            return
+        collscans = []
+        for query in self.queries:
+            cursor = self.db[query.collection].find(query.filter)
+            if query.sort:
+                cursor = cursor.sort(query.sort)
+            if query.limit:
+                cursor = cursor.limit(query.limit)
+            try:
+                explain = await cursor.explain()
+            except Exception as e:
+                logger.error(f"explain() failed for {query.name}: {e}")
+                continue
+            stages = find_stages(explain.get("queryPlanner", {}).get("winningPlan", {}))
+            self.report["plans"][query.name] = stages
+            if "COLLSCAN" in stages:
+                collscans.append(query.name)
+                logger.warning(f"Hot query '{query.name}' uses a COLLSCAN: {stages}")
+        if collscans and self.check_mode == CHECK_STRICT:
+            raise IndexCheckError(f"Collection scans in hot queries: {', '.join(collscans)}")
+
+    async def bootstrap(self):
+        await self.ensure()
+        await self.verify_plans()
+
+
+def register_core_indexes(manager: IndexManager):
+    manager.register(
+        "users",
+        IndexModel([("email", ASCENDING)], name="email_unique", unique=True),
+        IndexModel([("username", ASCENDING)], name="username_unique", unique=True),
+    )
+    manager.register(
+        "chat_messages",
+        IndexModel(
+            [("deleted", ASCENDING), ("room", ASCENDING), ("timestamp", DESCENDING), ("_id", DESCENDING)],
+            name="deleted_room_timestamp",
+        ),
+    )
+
+    manager.register_query(HotQuery("users.by_email", "users", {"email": "probe@example.com"}))
+    manager.register_query(HotQuery("users.by_username", "users", {"username": "probe"}))
+    manager.register_query(HotQuery(
+        "chat_messages.recent",
+        "chat_messages",
+        {"deleted": False, "room": {"$in": ["global", None]}},
+        sort=[("timestamp", DESCENDING), ("_id", DESCENDING)],
+        limit=51,
+    ))
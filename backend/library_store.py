@@ -0,0 +1,111 @@
+"""
+Per-user liked songs and listening history, stored outside the user document.
+
+``liked_songs`` holds one document per (user_id, song_id) with a composite
+``_id`` so like/unlike are idempotent upserts/deletes. ``listening_history``
+holds one document per play (written by ``history_ingest``) and is capped at
+``history_limit`` entries per user by an amortized trim. Reads are
+keyset-paginated on (time, _id).
+"""
+
+import logging
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+
+from indexes import HotQuery
+
+logger = logging.getLogger(__name__)
+
+
+def liked_id(user_id: str, song_id: str) -> str:
+    return f"{user_id}:{song_id}"
+
+
+class LibraryStore:
+    def __init__(self, db, history_limit: int = 1000, trim_probability: float = 0.05):
+        self.liked = db.liked_songs
+        self.history = db.listening_history
+        self.history_limit = history_limit
+        self.trim_probability = trim_probability
+
+    @staticmethod
+    def register_indexes(index_manager):
+        index_manager.register(
+            "liked_songs",
+            IndexModel([("user_id", ASCENDING), ("song_id", ASCENDING)], name="user_song_unique", unique=True),
+            IndexModel([("user_id", ASCENDING), ("liked_at", DESCENDING), ("_id", DESCENDING)], name="user_liked_at"),
+        )
+        index_manager.register(
+            "listening_history",
+            IndexModel([("user_id", ASCENDING), ("played_at", DESCENDING), ("_id", DESCENDING)], name="user_played_at"),
+        )
+        index_manager.register_query(HotQuery(
+            "liked_songs.page", "liked_songs", {"user_id": "probe"},
+            sort=[("liked_at", DESCENDING), ("_id", DESCENDING)], limit=51,
+        ))
+        index_manager.register_query(HotQuery(
+            "listening_history.page", "listening_history", {"user_id": "probe"},
+            sort=[("played_at", DESCENDING), ("_id", DESCENDING)], limit=51,
+        ))
+
+    async def _page(self, collection, user_id: str, time_field: str, limit: int,
+                    before: Optional[str]) -> Tuple[List[dict], bool]:
+        query: Dict[str, Any] = {"user_id": user_id}
+        if before:
+            anchor = await collection.find_one({"_id": before, "user_id": user_id}, {time_field: 1})
+            if anchor is None:
+                raise KeyError(before)
+            query["$or"] = [
+                {time_field: {"$lt": anchor[time_field]}},
+                {time_field: anchor[time_field], "_id": {"$lt": before}},
+            ]
+        docs = await collection.find(
+            query,
+            sort=[(time_field, DESCENDING), ("_id", DESCENDING)],
+            limit=limit + 1,
+        ).to_list(length=limit + 1)
+        return docs[:limit], len(docs) > limit
+
+    # Liked songs
+
+    async def like(self, user_id: str, song_id: str) -> bool:
+        # Song metadata lives in the catalog; only the reference is stored here
+        update = {
+            "$setOnInsert": {"user_id": user_id, "song_id": song_id, "liked_at": datetime.utcnow()}
+        }
+        result = await self.liked.update_one({"_id": liked_id(user_id, song_id)}, update, upsert=True)
+        return result.upserted_id is not None
+
+    async def unlike(self, user_id: str, song_id: str) -> bool:
+        result = await self.liked.delete_one({"_id": liked_id(user_id, song_id)})
+        return result.deleted_count > 0
+
+    async def liked_page(self, user_id: str, limit: int = 50,
+                         before: Optional[str] = None) -> Tuple[List[dict], bool]:
+        cursor_id = liked_id(user_id, before) if before else None
+        return await self._page(self.liked, user_id, "liked_at", limit, cursor_id)
+
+    # Listening history
+
+    async def trim_history(self, user_id: str) -> int:
+        # Find the oldest entry we keep, then delete everything older
+        boundary = await self.history.find(
+            {"user_id": user_id},
+            {"played_at": 1},
+            sort=[("played_at", DESCENDING), ("_id", DESCENDING)],
+            skip=self.history_limit - 1,
+            limit=1,
+        ).to_list(length=1)
+        if not boundary:
+            return 0
+        result = await self.history.delete_many({
+            "user_id": user_id,
+            "played_at": {"$lt": boundary[0]["played_at"]},
+        })
+        return result.deleted_count
+
+    async def history_page(self, user_id: str, limit: int = 50,
+                           before: Optional[str] = None) -> Tuple[List[dict], bool]:
+        return await self._page(self.history, user_id, "played_at", limit, before)
@@ -0,0 +1,198 @@
+"""
+In-process inverted index over songs we have already seen.
+
+Titles and artists from the catalog are tokenized into an index of
+token -> song ids, with a sorted token list for prefix lookups. Every query
+token must match exactly except the last, which matches as a prefix, so
+partially typed queries work. Lookups never leave the process, which keeps
+typeahead well under 10 ms.
+"""
+
+import asyncio
+import bisect
+import heapq
+import logging
+import re
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+# Upper bound on ids collected from one prefix, to keep 1-letter prefixes cheap
+PREFIX_SCAN_LIMIT = 5000
+INDEXED_FIELDS = ("id", "title", "artist", "thumbnail", "published_at")
+
+
+def tokenize(text: Optional[str]) -> List[str]:
+    return TOKEN_PATTERN.findall((text or "").lower())
+
+
+class LocalSearchIndex:
+    def __init__(self, max_songs: int = 200000, max_known_queries: int = 50000):
+        self.max_songs = max_songs
+        self.max_known_queries = max_known_queries
+        self._known_queries: "OrderedDict[str, None]" = OrderedDict()
+        self._songs: "OrderedDict[str, dict]" = OrderedDict()
+        self._song_tokens: Dict[str, Set[str]] = {}
+        self._postings: Dict[str, Set[str]] = {}
+        self._tokens: List[str] = []
+        self.searches = 0
+        self.suggests = 0
+
+    def __len__(self) -> int:
+        return len(self._songs)
+
+    def add_many(self, songs: Iterable[dict]):
+        for song in songs:
+            if song.get("id") and song.get("title"):
+                self.add(song)
+
+    def add(self, song: dict):
+        song_id = song["id"]
+        if song_id in self._songs:
+            self.remove(song_id)
+        elif len(self._songs) >= self.max_songs:
+            self.remove(next(iter(self._songs)))
+
+        self._songs[song_id] = {key: song.get(key) for key in INDEXED_FIELDS}
+        tokens = set(tokenize(song.get("title"))) | set(tokenize(song.get("artist")))
+        self._song_tokens[song_id] = tokens
+        for token in tokens:
+            postings = self._postings.get(token)
+            if postings is None:
+                postings = self._postings[token] = set()
+                bisect.insort(self._tokens, token)
+            postings.add(song_id)
+
+    def remove(self, song_id: str):
+        self._songs.pop(song_id, None)
+        for token in self._song_tokens.pop(song_id, ()):
+            postings = self._postings.get(token)
+            if postings is None:
+                continue
+            postings.discard(song_id)
+            if not postings:
+                del self._postings[token]
+                index = bisect.bisect_left(self._tokens, token)
+                if index < len(self._tokens) and self._tokens[index] == token:
+                    del self._tokens[index]
+
+    @staticmethod
+    def normalize_query(q: str) -> str:
+        return " ".join(tokenize(q))
+
+    def mark_query(self, q: str):
+        # Queries already answered upstream; their results are in the index
+        key = self.normalize_query(q)
+        self._known_queries[key] = None
+        self._known_queries.move_to_end(key)
+        while len(self._known_queries) > self.max_known_queries:
+            self._known_queries.popitem(last=False)
+
+    def knows_query(self, q: str) -> bool:
+        return self.normalize_query(q) in self._known_queries
+
+    def _prefix_ids(self, prefix: str) -> Set[str]:
+        ids: Set[str] = set()
+        index = bisect.bisect_left(self._tokens, prefix)
+        while index < len(self._tokens) and self._tokens[index].startswith(prefix):
+            ids |= self._postings[self._tokens[index]]
+            if len(ids) >= PREFIX_SCAN_LIMIT:
+                break
+            index += 1
+        return ids
+
+    def _match(self, tokens: List[str]) -> Set[str]:
+        sets = [self._postings.get(token, set()) for token in tokens[:-1]]
+        sets.append(self._prefix_ids(tokens[-1]))
+        sets.sort(key=len)
+        matched = set(sets[0])
+        for other in sets[1:]:
+            matched &= other
+            if not matched:
+                break
+        return matched
+
+    def _score(self, song_id: str, tokens: List[str]) -> tuple:
+        song = self._songs[song_id]
+        title_tokens = tokenize(song["title"])
+        artist_tokens = set(tokenize(song["artist"]))
+        exact = sum(1 for token in tokens if token in title_tokens or token in artist_tokens)
+        in_title = sum(1 for token in tokens if any(t.startswith(token) for t in title_tokens))
+        # More exact hits, more title hits, then shorter (closer) titles first
+        return (-exact, -in_title, len(title_tokens))
+
+    def search(self, q: str, limit: int = 20) -> List[dict]:
+        self.searches += 1
+        tokens = tokenize(q)
+        if not tokens:
+            return []
+        ranked = self._rank(self._match(tokens), tokens, limit)
+        return [dict(self._songs[song_id], duration="Unknown") for song_id in ranked]
+
+    def _rank(self, matched: Set[str], tokens: List[str], limit: Optional[int]) -> List[str]:
+        # Every match is scored, so the best ones are never cut before ranking;
+        # the id breaks ties so results are stable between calls
+        def key(song_id):
+            return (self._score(song_id, tokens), song_id)
+
+        if limit is None:
+            return sorted(matched, key=key)
+        return heapq.nsmallest(limit, matched, key=key)
+
+    def suggest(self, q: str, limit: int = 10) -> List[Dict[str, Any]]:
+        self.suggests += 1
+        tokens = tokenize(q)
+        if not tokens:
+            return []
+        matched = self._match(tokens)
+        # Titles repeat (covers, re-uploads), so rank a few spare candidates
+        # and only rank everything when those collapse below the limit
+        suggestions = self._distinct_titles(self._rank(matched, tokens, limit * 4), limit)
+        if len(suggestions) < limit and len(matched) > limit * 4:
+            suggestions = self._distinct_titles(self._rank(matched, tokens, None), limit)
+        return suggestions
+
+    def _distinct_titles(self, ranked: List[str], limit: int) -> List[Dict[str, Any]]:
+        suggestions = []
+        seen = set()
+        for song_id in ranked:
+            song = self._songs[song_id]
+            text = song["title"]
+            if text.lower() in seen:
+                continue
+            seen.add(text.lower())
+            suggestions.append({"text": text, "artist": song["artist"], "song_id": song_id})
+            if len(suggestions) >= limit:
+                break
+        return suggestions
+
+    async def load(self, collection, batch_size: int = 1000):
+        # Most recently refreshed songs first, so the cap keeps the relevant ones
+        cursor = collection.find(
+            {"title": {"$exists": True}},
+            {"title": 1, "artist": 1, "thumbnail": 1, "published_at": 1},
+            sort=[("updated_at", -1)],
+            limit=self.max_songs,
+            batch_size=batch_size,
+        )
+        docs = await cursor.to_list(length=self.max_songs)
+        # Insert oldest first so eviction order matches recency
+        for count, doc in enumerate(reversed(docs)):
+            self.add({**doc, "id": doc["_id"]})
+            if count % 1000 == 999:
+                await asyncio.sleep(0)  # Do not starve requests during warm-up
+        loaded = len(docs)
+        logger.info(f"Local search index loaded {loaded} songs")
+        return loaded
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "songs": len(self._songs),
+            "tokens": len(self._tokens),
+            "known_queries": len(self._known_queries),
+            "max_songs": self.max_songs,
+            "searches": self.searches,
+            "suggests": self.suggests,
+        }
@@ -0,0 +1,184 @@
+"""
+Non-blocking, structured logging.
+
+Loggers hand records to a bounded in-memory queue; a ``QueueListener`` thread
+formats them (as JSON by default) and does the actual I/O, so a slow stderr
+or log shipper never stalls the event loop. When the queue is full records
+are dropped and counted rather than blocking.
+
+Each record carries the current request id (set by ``RequestIdMiddleware``
+from ``X-Request-ID`` or generated). High-volume lines opt into sampling with
+``extra={"sample": "<key>"}``; only the configured fraction of those is kept.
+"""
+
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import uuid
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional
+
+request_id_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("request_id", default=None)
+
+REQUEST_ID_HEADER = "x-request-id"
+
+# Attributes every LogRecord has; anything else came in through extra=
+STANDARD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+def parse_sample_rates(value: str) -> Dict[str, float]:
+    # "search=0.1,chat_connect=0.05" -> {"search": 0.1, "chat_connect": 0.05}
+    rates = {}
+    for part in filter(None, (item.strip() for item in value.split(","))):
+        key, _, rate = part.partition("=")
+        rates[key.strip()] = float(rate)
+    return rates
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in STANDARD_ATTRS and value is not None:
+                entry[key] = value
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        if not hasattr(record, "request_id"):
+            record.request_id = None
+        return super().format(record)
+
+
+class ContextFilter(logging.Filter):
+    """Stamps the request id and applies sampling, on the caller's thread."""
+
+    def __init__(self, sample_rates: Dict[str, float]):
+        super().__init__()
+        self.sample_rates = sample_rates
+        self.sampled_out: Dict[str, int] = defaultdict(int)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        sample_key = getattr(record, "sample", None)
+        if sample_key is not None:
+            rate = self.sample_rates.get(sample_key, 1.0)
+            if rate < 1.0 and random.random() >= rate:
+                self.sampled_out[sample_key] += 1
+                return False
+            record.sample_rate = rate
+        record.request_id = request_id_var.get()
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Only merge args and render the traceback here; formatting happens
+        # on the listener thread
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogPipeline:
+    def __init__(self, level: str = "INFO", fmt: str = "json", sample_rates: Optional[Dict[str, float]] = None,
+                 queue_size: int = 10000):
+        self.level = level.upper()
+        self.fmt = fmt
+        self.queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.context_filter = ContextFilter(sample_rates or {})
+        self.handler = DroppingQueueHandler(self.queue)
+        self.handler.addFilter(self.context_filter)
+        output = logging.StreamHandler()
+        output.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter())
+        self.listener = logging.handlers.QueueListener(self.queue, output, respect_handler_level=True)
+        self._started = False
+
+    def install(self):
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(self.handler)
+        root.setLevel(self.level)
+        self.start()
+
+    def start(self):
+        if not self._started:
+            self.listener.start()
+            self._started = True
+
+    def stop(self):
+        # Flushes everything queued so far
+        if self._started:
+            self.listener.stop()
+            self._started = False
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "level": self.level,
+            "format": self.fmt,
+            "queued": self.queue.qsize(),
+            "queue_size": self.queue.maxsize,
+            "dropped": self.handler.dropped,
+            "sample_rates": self.context_filter.sample_rates,
+            "sampled_out": dict(self.context_filter.sampled_out),
+        }
+
+
+class RequestIdMiddleware:
+    """Binds a request id to the request's context and echoes it in the response."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            await self.app(scope, receive, send)
+            return
+        request_id = None
+        for name, value in scope.get("headers", ()):
+            if name == REQUEST_ID_HEADER.encode():
+                request_id = value.decode("latin-1")[:64]
+                break
+        request_id = request_id or uuid.uuid4().hex
+        token = request_id_var.set(request_id)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [
+                    (REQUEST_ID_HEADER.encode(), request_id.encode("latin-1"))
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_id_var.reset(token)
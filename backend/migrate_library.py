@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Move embedded liked_songs / listening_history arrays out of user documents.
+
+Users are processed in batches; each batch is upserted into the liked_songs
+and listening_history collections with bulk_write and only then are the
+arrays unset on those users, so the migration can be interrupted and re-run.
+Every migrated row has a deterministic ``_id`` (plays are keyed by their
+position in the embedded array), so a re-run never duplicates a like or a play.
+Song metadata found in the arrays is upserted into the songs catalog.
+
+    python migrate_library.py --batch-size 500 [--dry-run]
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+from datetime import datetime
+
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+
+from catalog import SongCatalog
+from library_store import liked_id
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("migrate_library")
+
+
+def song_from_entry(entry):
+    # Embedded entries were either bare song ids or song dicts
+    if isinstance(entry, str):
+        return entry, None
+    if isinstance(entry, dict):
+        song = entry.get("song") if isinstance(entry.get("song"), dict) else entry
+        song_id = entry.get("song_id") or song.get("id")
+        return song_id, {k: v for k, v in song.items() if k not in ("played_at", "liked_at", "timestamp")}
+    return None, None
+
+
+def entry_time(entry, field, fallback):
+    if isinstance(entry, dict):
+        value = entry.get(field) or entry.get("timestamp")
+        if isinstance(value, datetime):
+            return value
+    return fallback
+
+
+def migrated_history_id(user_id: str, index: int) -> str:
+    # Stable across re-runs: the array is only unset after its rows are written
+    return f"{user_id}:migrated:{index}"
+
+
+def build_ops(user):
+    user_id = user["_id"]
+    fallback = user.get("created_at") or datetime.utcnow()
+    liked_ops, history_ops, songs = [], [], []
+
+    for entry in user.get("liked_songs") or []:
+        song_id, song = song_from_entry(entry)
+        if not song_id:
+            continue
+        if song:
+            songs.append({**song, "id": song_id})
+        on_insert = {"user_id": user_id, "song_id": song_id,
+                     "liked_at": entry_time(entry, "liked_at", fallback)}
+        liked_ops.append(UpdateOne({"_id": liked_id(user_id, song_id)},
+                                   {"$setOnInsert": on_insert}, upsert=True))
+
+    for index, entry in enumerate(user.get("listening_history") or []):
+        song_id, song = song_from_entry(entry)
+        if not song_id:
+            continue
+        if song:
+            songs.append({**song, "id": song_id})
+        on_insert = {"user_id": user_id, "song_id": song_id,
+                     "played_at": entry_time(entry, "played_at", fallback)}
+        history_ops.append(UpdateOne({"_id": migrated_history_id(user_id, index)},
+                                     {"$setOnInsert": on_insert}, upsert=True))
+
+    return liked_ops, history_ops, songs
+
+
+async def migrate(db, batch_size: int, dry_run: bool):
+    catalog = SongCatalog(db)
+    query = {"$or": [{"liked_songs.0": {"$exists": True}}, {"listening_history.0": {"$exists": True}}]}
+    projection = {"liked_songs": 1, "listening_history": 1, "created_at": 1}
+    totals = {"users": 0, "liked": 0, "history": 0}
+
+    while True:
+        users = await db.users.find(query, projection, limit=batch_size).to_list(length=batch_size)
+        if not users:
+            break
+
+        liked_ops, history_ops, songs = [], [], []
+        for user in users:
+            user_liked, user_history, user_songs = build_ops(user)
+            liked_ops.extend(user_liked)
+            history_ops.extend(user_history)
+            songs.extend(user_songs)
+
+        totals["users"] += len(users)
+        totals["liked"] += len(liked_ops)
+        totals["history"] += len(history_ops)
+        if dry_run:
+            logger.info(f"[dry run] batch of {len(users)} users: {len(liked_ops)} likes, {len(history_ops)} plays")
+            if len(users) < batch_size:
+                break
+            # Without writes the same users would match again; page by _id instead
+            query["_id"] = {"$gt": users[-1]["_id"]}
+            continue
+
+        await catalog.upsert_many(songs, authoritative=False)
+        if liked_ops:
+            await db.liked_songs.bulk_write(liked_ops, ordered=False)
+        if history_ops:
+            await db.listening_history.bulk_write(history_ops, ordered=False)
+        await db.users.update_many(
+            {"_id": {"$in": [user["_id"] for user in users]}},
+            {"$unset": {"liked_songs": "", "listening_history": ""}},
+        )
+        logger.info(f"Migrated batch of {len(users)} users: {len(liked_ops)} likes, {len(history_ops)} plays")
+
+    # Users whose arrays were empty still carry the fields
+    if not dry_run:
+        await db.users.update_many(
+            {"$or": [{"liked_songs": {"$exists": True}}, {"listening_history": {"$exists": True}}]},
+            {"$unset": {"liked_songs": "", "listening_history": ""}},
+        )
+    logger.info(f"Done: {totals}")
+    return totals
+
+
+async def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    client = AsyncIOMotorClient(os.getenv("MONGO_URL"))
+    try:
+        await migrate(client.foxenfy_db, args.batch_size, args.dry_run)
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
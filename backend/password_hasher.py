@@ -0,0 +1,90 @@
+"""
+Password hashing off the event loop.
+
+bcrypt is deliberately slow (~100-300 ms per call at cost 12), so running it
+inline in an async handler stalls every other coroutine on the worker. All
+hashing and verification here runs on a dedicated, size-limited thread pool
+(bcrypt releases the GIL), with a cap on queued work so a login burst is shed
+with a fast error instead of piling up.
+"""
+
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional, Tuple
+
+from passlib.context import CryptContext
+
+logger = logging.getLogger(__name__)
+
+
+class PasswordPoolSaturated(Exception):
+    pass
+
+
+class PasswordHasher:
+    def __init__(self, rounds: int = 12, max_workers: int = 4, max_pending: int = 64):
+        self.rounds = rounds
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        # min_rounds makes hashes created with a lower cost report needs_update
+        self.context = CryptContext(
+            schemes=["bcrypt"],
+            deprecated="auto",
+            bcrypt__default_rounds=rounds,
+            bcrypt__min_rounds=rounds,
+        )
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="password"
+        )
+        self.pending = 0
+        self.rejected = 0
+        self.rehashed = 0
+
+    async def _run(self, fn, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise PasswordPoolSaturated("Password worker pool is saturated")
+        loop = asyncio.get_running_loop()
+        job = self._executor.submit(fn, *args)
+        self.pending += 1
+        # Counted until the job itself finishes: a cancelled caller does not
+        # take a job that is already running off the pool
+        job.add_done_callback(lambda _: self._job_done(loop))
+        return await asyncio.wrap_future(job)
+
+    def _job_done(self, loop: asyncio.AbstractEventLoop):
+        # Runs on a pool thread; pending is only ever changed on the loop
+        try:
+            loop.call_soon_threadsafe(self._release)
+        except RuntimeError:
+            pass  # Loop already closed, nothing is counting any more
+
+    def _release(self):
+        self.pending -= 1
+
+    async def hash(self, password: str) -> str:
+        return await self._run(self.context.hash, password)
+
+    async def verify(self, password: str, hashed: str) -> bool:
+        return await self._run(self.context.verify, password, hashed)
+
+    async def verify_and_update(self, password: str, hashed: str) -> Tuple[bool, Optional[str]]:
+        # Returns (valid, new_hash); new_hash is set when the stored cost is outdated
+        valid, new_hash = await self._run(self.context.verify_and_update, password, hashed)
+        if new_hash:
+            self.rehashed += 1
+        return valid, new_hash
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "rounds": self.rounds,
+            "max_workers": self.max_workers,
+            "max_pending": self.max_pending,
+            "pending": self.pending,
+            "rejected": self.rejected,
+            "rehashed": self.rehashed,
+        }
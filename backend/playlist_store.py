@@ -0,0 +1,374 @@
+"""
+Playlists and their ordered tracks.
+
+``playlists`` holds one document per playlist (name, owner, track count and a
+``version`` bumped by every change). ``playlist_tracks`` holds one document
+per entry with a lexicographic ``position`` key, so insert, move and remove
+each touch a single track document instead of rewriting an embedded array.
+
+Position keys are fractional indexes: a new key is generated strictly between
+its neighbours' keys, so nothing else is renumbered. Keys use base-62 digits
+in ASCII order, which is also the order Mongo sorts them in. The scheme
+(integer part with a length-encoding head, then fraction digits) keeps keys
+short for the common case of appending at the end.
+
+Tracks are listed keyset-paginated on ``position``; the position of the last
+track doubles as the cursor. The playlist ``version`` is bumped only after a
+change is written, so a reader that sees version N also sees its tracks.
+"""
+
+import logging
+import uuid
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from pymongo import ASCENDING, DESCENDING, DeleteOne, IndexModel, InsertOne, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from indexes import HotQuery
+
+logger = logging.getLogger(__name__)
+
+DIGITS = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+INTEGER_ZERO = "a0"
+SMALLEST_INTEGER = "A" + DIGITS[0] * 26
+
+# Concurrent edits can pick the same key; the unique index catches it
+POSITION_RETRIES = 3
+
+
+def _midpoint(a: str, b: Optional[str]) -> str:
+    # A fraction strictly between "0.a" and "0.b" (b=None means 1)
+    if b is not None:
+        n = 0
+        while n < len(b) and (a[n] if n < len(a) else DIGITS[0]) == b[n]:
+            n += 1
+        if n > 0:
+            return b[:n] + _midpoint(a[n:], b[n:])
+    digit_a = DIGITS.index(a[0]) if a else 0
+    digit_b = DIGITS.index(b[0]) if b is not None else len(DIGITS)
+    if digit_b - digit_a > 1:
+        return DIGITS[(digit_a + digit_b + 1) // 2]
+    if b is not None and len(b) > 1:
+        return b[0]
+    return DIGITS[digit_a] + _midpoint(a[1:], None)
+
+
+def _integer_length(head: str) -> int:
+    if "a" <= head <= "z":
+        return ord(head) - ord("a") + 2
+    if "A" <= head <= "Z":
+        return ord("Z") - ord(head) + 2
+    raise ValueError(f"Invalid position key head: {head}")
+
+
+def _integer_part(key: str) -> str:
+    length = _integer_length(key[0])
+    if length > len(key):
+        raise ValueError(f"Invalid position key: {key}")
+    return key[:length]
+
+
+def _increment_integer(x: str) -> Optional[str]:
+    head, digits = x[0], list(x[1:])
+    for i in range(len(digits) - 1, -1, -1):
+        d = DIGITS.index(digits[i]) + 1
+        if d < len(DIGITS):
+            digits[i] = DIGITS[d]
+            return head + "".join(digits)
+        digits[i] = DIGITS[0]
+    # Carried out of the top digit: the integer needs one more digit
+    if head == "Z":
+        return "a" + DIGITS[0]
+    if head == "z":
+        return None
+    head = chr(ord(head) + 1)
+    if head > "a":
+        digits.append(DIGITS[0])
+    else:
+        digits.pop()
+    return head + "".join(digits)
+
+
+def _decrement_integer(x: str) -> Optional[str]:
+    head, digits = x[0], list(x[1:])
+    for i in range(len(digits) - 1, -1, -1):
+        d = DIGITS.index(digits[i]) - 1
+        if d >= 0:
+            digits[i] = DIGITS[d]
+            return head + "".join(digits)
+        digits[i] = DIGITS[-1]
+    if head == "a":
+        return "Z" + DIGITS[-1]
+    if head == "A":
+        return None
+    head = chr(ord(head) - 1)
+    if head < "Z":
+        digits.append(DIGITS[-1])
+    else:
+        digits.pop()
+    return head + "".join(digits)
+
+
+def key_between(a: Optional[str], b: Optional[str]) -> str:
+    """A position key that sorts strictly between a and b (None = open end)."""
+    if a is not None and b is not None and a >= b:
+        raise ValueError(f"Position keys out of order: {a} >= {b}")
+    if a is None:
+        if b is None:
+            return INTEGER_ZERO
+        ib = _integer_part(b)
+        fb = b[len(ib):]
+        if ib == SMALLEST_INTEGER:
+            return ib + _midpoint("", fb)
+        if ib < b:
+            return ib
+        decremented = _decrement_integer(ib)
+        if decremented is None:
+            raise ValueError("Cannot generate a position key before the smallest key")
+        return decremented
+    ia = _integer_part(a)
+    fa = a[len(ia):]
+    if b is None:
+        incremented = _increment_integer(ia)
+        return ia + _midpoint(fa, None) if incremented is None else incremented
+    ib = _integer_part(b)
+    fb = b[len(ib):]
+    if ia == ib:
+        return ia + _midpoint(fa, fb)
+    incremented = _increment_integer(ia)
+    if incremented is not None and incremented < b:
+        return incremented
+    return ia + _midpoint(fa, None)
+
+
+def keys_between(a: Optional[str], b: Optional[str], n: int) -> List[str]:
+    """n ascending keys between a and b, spread out so none grows needlessly long."""
+    if n <= 0:
+        return []
+    if n == 1:
+        return [key_between(a, b)]
+    if b is None:
+        keys = [key_between(a, None)]
+        for _ in range(n - 1):
+            keys.append(key_between(keys[-1], None))
+        return keys
+    if a is None:
+        keys = [key_between(None, b)]
+        for _ in range(n - 1):
+            keys.append(key_between(None, keys[-1]))
+        return keys[::-1]
+    mid = n // 2
+    c = key_between(a, b)
+    return keys_between(a, c, mid) + [c] + keys_between(c, b, n - mid - 1)
+
+
+class PlaylistFull(Exception):
+    pass
+
+
+class PlaylistStore:
+    def __init__(self, db, max_tracks: int = 5000):
+        self.playlists = db.playlists
+        self.tracks = db.playlist_tracks
+        self.max_tracks = max_tracks
+
+    @staticmethod
+    def register_indexes(index_manager):
+        index_manager.register(
+            "playlists",
+            IndexModel([("owner_id", ASCENDING), ("updated_at", DESCENDING)], name="owner_updated_at"),
+        )
+        index_manager.register(
+            "playlist_tracks",
+            IndexModel([("playlist_id", ASCENDING), ("position", ASCENDING)], name="playlist_position_unique",
+                       unique=True),
+        )
+        index_manager.register_query(HotQuery(
+            "playlists.by_owner", "playlists", {"owner_id": "probe"},
+            sort=[("updated_at", DESCENDING)], limit=100,
+        ))
+        index_manager.register_query(HotQuery(
+            "playlist_tracks.page", "playlist_tracks", {"playlist_id": "probe", "position": {"$gt": ""}},
+            sort=[("position", ASCENDING)], limit=101,
+        ))
+
+    # Playlists
+
+    async def create(self, owner_id: str, name: str, description: str = "") -> dict:
+        now = datetime.utcnow()
+        doc = {
+            "_id": str(uuid.uuid4()),
+            "owner_id": owner_id,
+            "name": name,
+            "description": description or "",
+            "track_count": 0,
+            "version": 1,
+            "created_at": now,
+            "updated_at": now,
+        }
+        await self.playlists.insert_one(doc)
+        return doc
+
+    async def get(self, playlist_id: str) -> Optional[dict]:
+        return await self.playlists.find_one({"_id": playlist_id})
+
+    async def list_for_owner(self, owner_id: str, limit: int = 100) -> List[dict]:
+        return await self.playlists.find(
+            {"owner_id": owner_id}, sort=[("updated_at", DESCENDING)], limit=limit
+        ).to_list(length=limit)
+
+    async def update(self, playlist_id: str, fields: Dict[str, Any]) -> Optional[dict]:
+        return await self._touch(playlist_id, set_fields=fields)
+
+    async def delete(self, playlist_id: str) -> bool:
+        result = await self.playlists.delete_one({"_id": playlist_id})
+        if result.deleted_count:
+            await self.tracks.delete_many({"playlist_id": playlist_id})
+        return result.deleted_count > 0
+
+    async def _touch(self, playlist_id: str, track_delta: int = 0,
+                     set_fields: Optional[Dict[str, Any]] = None) -> Optional[dict]:
+        # Bumps the version once the change it describes is already written
+        update: Dict[str, Any] = {
+            "$inc": {"version": 1, "track_count": track_delta},
+            "$set": {**(set_fields or {}), "updated_at": datetime.utcnow()},
+        }
+        return await self.playlists.find_one_and_update(
+            {"_id": playlist_id}, update, return_document=ReturnDocument.AFTER
+        )
+
+    # Tracks
+
+    async def tracks_page(self, playlist_id: str, limit: int = 100,
+                          after: Optional[str] = None) -> Tuple[List[dict], bool]:
+        query: Dict[str, Any] = {"playlist_id": playlist_id}
+        if after:
+            query["position"] = {"$gt": after}
+        docs = await self.tracks.find(
+            query, sort=[("position", ASCENDING)], limit=limit + 1
+        ).to_list(length=limit + 1)
+        return docs[:limit], len(docs) > limit
+
+    async def _position(self, playlist_id: str, track_id: str) -> str:
+        doc = await self.tracks.find_one({"_id": track_id, "playlist_id": playlist_id}, {"position": 1})
+        if doc is None:
+            raise KeyError(track_id)
+        return doc["position"]
+
+    async def _neighbour(self, playlist_id: str, position: Optional[str], forward: bool,
+                         exclude: Optional[str] = None) -> Optional[str]:
+        # The closest position after (forward) or before a position; None = from the end
+        query: Dict[str, Any] = {"playlist_id": playlist_id}
+        if position is not None:
+            query["position"] = {"$gt" if forward else "$lt": position}
+        if exclude is not None:
+            query["_id"] = {"$ne": exclude}
+        doc = await self.tracks.find_one(
+            query, {"position": 1}, sort=[("position", ASCENDING if forward else DESCENDING)]
+        )
+        return doc["position"] if doc else None
+
+    async def _gap(self, playlist_id: str, after: Optional[str], before: Optional[str],
+                   exclude: Optional[str] = None) -> Tuple[Optional[str], Optional[str]]:
+        # (lower, upper) positions to insert between: after a track, before a
+        # track, or at the end when neither is given
+        if after is not None:
+            lower = await self._position(playlist_id, after)
+            return lower, await self._neighbour(playlist_id, lower, True, exclude)
+        if before is not None:
+            upper = await self._position(playlist_id, before)
+            return await self._neighbour(playlist_id, upper, False, exclude), upper
+        return await self._neighbour(playlist_id, None, False, exclude), None
+
+    async def add_tracks(self, playlist_id: str, song_ids: List[str], added_by: str,
+                         after: Optional[str] = None, before: Optional[str] = None) -> Tuple[List[dict], dict]:
+        # Reserve room first so concurrent adds cannot overshoot max_tracks
+        reserved = await self.playlists.find_one_and_update(
+            {"_id": playlist_id, "track_count": {"$lte": self.max_tracks - len(song_ids)}},
+            {"$inc": {"track_count": len(song_ids)}},
+        )
+        if reserved is None:
+            if await self.playlists.count_documents({"_id": playlist_id}, limit=1):
+                raise PlaylistFull(f"Playlists hold at most {self.max_tracks} tracks")
+            raise KeyError(playlist_id)
+
+        now = datetime.utcnow()
+        inserted: List[dict] = []
+        remaining = list(song_ids)
+        try:
+            for attempt in range(POSITION_RETRIES):
+                if inserted:
+                    # Continue right after what the last attempt managed to insert
+                    lower = inserted[-1]["position"]
+                    upper = await self._neighbour(playlist_id, lower, True)
+                else:
+                    lower, upper = await self._gap(playlist_id, after, before)
+                docs = [
+                    {
+                        "_id": str(uuid.uuid4()),
+                        "playlist_id": playlist_id,
+                        "song_id": song_id,
+                        "position": position,
+                        "added_by": added_by,
+                        "added_at": now,
+                    }
+                    for song_id, position in zip(remaining, keys_between(lower, upper, len(remaining)))
+                ]
+                try:
+                    await self.tracks.bulk_write([InsertOne(doc) for doc in docs], ordered=True)
+                    inserted.extend(docs)
+                    break
+                except BulkWriteError as e:
+                    done = e.details.get("nInserted", 0)
+                    inserted.extend(docs[:done])
+                    remaining = remaining[done:]
+                    if attempt == POSITION_RETRIES - 1 or any(
+                        error.get("code") != 11000 for error in e.details.get("writeErrors", [])
+                    ):
+                        raise
+        except BaseException:
+            # Give back the reservation without hiding why the insert failed
+            try:
+                await self._settle_reservation(playlist_id, inserted, len(song_ids))
+            except Exception as e:
+                logger.error(f"Releasing the track reservation of playlist {playlist_id} failed: {e}")
+            raise
+        playlist = await self._settle_reservation(playlist_id, inserted, len(song_ids))
+        return inserted, playlist
+
+    async def _settle_reservation(self, playlist_id: str, inserted: List[dict], reserved: int) -> Optional[dict]:
+        # Returns None if the playlist was deleted meanwhile; tracks inserted
+        # after its cascade delete would otherwise be orphaned
+        playlist = await self._touch(playlist_id, track_delta=len(inserted) - reserved)
+        if playlist is None and inserted:
+            await self.tracks.delete_many({"_id": {"$in": [doc["_id"] for doc in inserted]}})
+        return playlist
+
+    async def remove_tracks(self, playlist_id: str, track_ids: Iterable[str]) -> Tuple[int, Optional[dict]]:
+        ops = [DeleteOne({"_id": track_id, "playlist_id": playlist_id}) for track_id in set(track_ids)]
+        result = await self.tracks.bulk_write(ops, ordered=False)
+        if not result.deleted_count:
+            return 0, await self.get(playlist_id)
+        return result.deleted_count, await self._touch(playlist_id, track_delta=-result.deleted_count)
+
+    async def move_track(self, playlist_id: str, track_id: str, after: Optional[str] = None,
+                         before: Optional[str] = None) -> Tuple[dict, dict]:
+        if track_id in (after, before):
+            raise ValueError("A track cannot be moved relative to itself")
+        await self._position(playlist_id, track_id)
+        for attempt in range(POSITION_RETRIES):
+            lower, upper = await self._gap(playlist_id, after, before, exclude=track_id)
+            try:
+                track = await self.tracks.find_one_and_update(
+                    {"_id": track_id, "playlist_id": playlist_id},
+                    {"$set": {"position": key_between(lower, upper)}},
+                    return_document=ReturnDocument.AFTER,
+                )
+                break
+            except DuplicateKeyError:
+                if attempt == POSITION_RETRIES - 1:
+                    raise
+        if track is None:
+            raise KeyError(track_id)
+        return track, await self._touch(playlist_id)
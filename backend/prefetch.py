@@ -0,0 +1,254 @@
+"""
+Background warm-up and refresh-ahead for popular search queries.
+
+Every first-page search is recorded with an exponentially decayed score.
+Each cycle the top queries whose cache entry is missing or about to expire
+are reloaded: from the shared cache tier while it is still fresh, otherwise
+from upstream, and only while the quota budget allows it. Raw counts are
+persisted to ``search_queries`` so a fresh deploy can pre-warm the previous
+top-N before the first user searches.
+"""
+
+import asyncio
+import heapq
+import logging
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from pymongo import DESCENDING, IndexModel, UpdateOne
+
+from search_cache import SearchCache
+
+logger = logging.getLogger(__name__)
+
+Fetch = Callable[[str, int], Awaitable[Any]]
+
+# Persisted query counts are forgotten after this long without a search
+QUERY_RETENTION_DAYS = 7
+
+
+class QueryPrefetcher:
+    def __init__(
+        self,
+        db,
+        cache: SearchCache,
+        fetch: Fetch,
+        allow_upstream: Callable[[], bool],
+        interval_seconds: float = 30,
+        top_n: int = 50,
+        warm_n: int = 50,
+        refresh_ahead_seconds: float = 60,
+        max_upstream_per_cycle: int = 5,
+        min_score: float = 2,
+        decay: float = 0.95,
+        max_tracked: int = 10000,
+    ):
+        self.collection = db.search_queries
+        self.cache = cache
+        self.fetch = fetch
+        self.allow_upstream = allow_upstream
+        self.interval = interval_seconds
+        self.top_n = top_n
+        self.warm_n = warm_n
+        self.refresh_ahead = refresh_ahead_seconds
+        self.max_upstream_per_cycle = max_upstream_per_cycle
+        self.min_score = min_score
+        self.decay = decay
+        self.max_tracked = max_tracked
+        self._scores: Dict[Tuple[str, int], float] = {}
+        self._unflushed: Dict[Tuple[str, int], int] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.recent: Deque[Dict[str, Any]] = deque(maxlen=50)
+        self.cycles = 0
+        self.last_cycle_at: Optional[datetime] = None
+        self.warmed = 0
+        self.refreshed_shared = 0
+        self.refreshed_upstream = 0
+        self.skipped_quota = 0
+        self.errors = 0
+
+    @staticmethod
+    def register_indexes(index_manager):
+        index_manager.register(
+            "search_queries",
+            IndexModel([("count", DESCENDING)], name="count"),
+            IndexModel(
+                [("last_seen", DESCENDING)],
+                name="last_seen_ttl",
+                expireAfterSeconds=QUERY_RETENTION_DAYS * 86400,
+            ),
+        )
+
+    @staticmethod
+    def normalize(q: str) -> str:
+        return " ".join(q.lower().split())
+
+    def record(self, q: str, max_results: int):
+        key = (self.normalize(q), max_results)
+        if not key[0]:
+            return
+        if key not in self._scores and len(self._scores) >= 2 * self.max_tracked:
+            # Searches must not pay for an O(n) scan each; prune in batches
+            self._prune()
+        self._scores[key] = self._scores.get(key, 0) + 1
+        self._unflushed[key] = self._unflushed.get(key, 0) + 1
+
+    def _prune(self):
+        # Forget all but the max_tracked most popular queries
+        if len(self._scores) > self.max_tracked:
+            keep = heapq.nlargest(self.max_tracked, self._scores.items(), key=lambda item: item[1])
+            self._scores = dict(keep)
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush_counts()
+
+    async def _run(self):
+        try:
+            await self.warm_up()
+        except Exception as e:
+            logger.error(f"Search warm-up failed: {e}")
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_cycle()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Search prefetch cycle failed: {e}")
+
+    async def flush_counts(self):
+        if not self._unflushed:
+            return
+        pending, self._unflushed = self._unflushed, {}
+        now = datetime.utcnow()
+        ops = [
+            UpdateOne(
+                {"_id": f"{max_results}|{q}"},
+                {
+                    "$inc": {"count": count},
+                    "$set": {"last_seen": now},
+                    "$setOnInsert": {"q": q, "max_results": max_results},
+                },
+                upsert=True,
+            )
+            for (q, max_results), count in pending.items()
+        ]
+        try:
+            await self.collection.bulk_write(ops, ordered=False)
+        except Exception as e:
+            logger.error(f"Search query count flush failed: {e}")
+
+    async def warm_up(self) -> int:
+        # Seed scores from what was popular before this process started
+        docs = await self.collection.find(
+            {"last_seen": {"$gt": datetime.utcnow() - timedelta(days=1)}},
+            sort=[("count", DESCENDING)],
+            limit=self.warm_n,
+        ).to_list(length=self.warm_n)
+        for doc in docs:
+            key = (doc["q"], doc["max_results"])
+            self._scores[key] = max(self._scores.get(key, 0), self.min_score)
+        warmed = await self._refresh([(doc["q"], doc["max_results"]) for doc in docs], "warm_up")
+        self.warmed += warmed
+        logger.info(f"Search warm-up loaded {warmed} of {len(docs)} popular queries")
+        return warmed
+
+    def top_queries(self) -> List[Tuple[str, int]]:
+        ranked = sorted(self._scores.items(), key=lambda item: item[1], reverse=True)
+        return [key for key, score in ranked[:self.top_n] if score >= self.min_score]
+
+    async def run_cycle(self) -> int:
+        self.cycles += 1
+        self.last_cycle_at = datetime.utcnow()
+        await self.flush_counts()
+        due = [
+            (q, max_results) for q, max_results in self.top_queries()
+            if self.cache.expires_in(q, max_results) <= self.refresh_ahead
+        ]
+        refreshed = await self._refresh(due, "refresh")
+        # Decay so yesterday's hits make way for what is trending now
+        for key in list(self._scores):
+            self._scores[key] *= self.decay
+            if self._scores[key] < 0.1:
+                del self._scores[key]
+        self._prune()
+        return refreshed
+
+    async def _refresh(self, queries: List[Tuple[str, int]], reason: str) -> int:
+        refreshed = 0
+        upstream_calls = 0
+        for q, max_results in queries:
+            allow = upstream_calls < self.max_upstream_per_cycle and self.allow_upstream()
+            started = time.perf_counter()
+            try:
+                source = await self.cache.refresh(
+                    q, max_results,
+                    lambda q=q, max_results=max_results: self.fetch(q, max_results),
+                    # Anything the shared tier still holds beyond the next cycle will do
+                    min_shared_ttl=self.interval + self.refresh_ahead,
+                    allow_upstream=allow,
+                )
+            except Exception as e:
+                self.errors += 1
+                self._log(q, max_results, reason, "error", started, str(e))
+                continue
+            if source is None:
+                self.skipped_quota += 1
+                self._log(q, max_results, reason, "skipped", started)
+                continue
+            if source == "upstream":
+                upstream_calls += 1
+                self.refreshed_upstream += 1
+            else:
+                self.refreshed_shared += 1
+            refreshed += 1
+            self._log(q, max_results, reason, source, started)
+        return refreshed
+
+    def _log(self, q: str, max_results: int, reason: str, source: str, started: float,
+             error: Optional[str] = None):
+        entry = {
+            "query": q,
+            "max_results": max_results,
+            "reason": reason,
+            "source": source,
+            "at": datetime.utcnow(),
+            "ms": round((time.perf_counter() - started) * 1000, 2),
+        }
+        if error:
+            entry["error"] = error
+        self.recent.append(entry)
+
+    def stats(self) -> Dict[str, Any]:
+        cache_stats = self.cache.stats()
+        return {
+            "running": self._task is not None,
+            "tracked_queries": len(self._scores),
+            "top_queries": [
+                {"query": q, "max_results": max_results, "score": round(self._scores[(q, max_results)], 2)}
+                for q, max_results in self.top_queries()[:10]
+            ],
+            "cycles": self.cycles,
+            "last_cycle_at": self.last_cycle_at,
+            "warmed": self.warmed,
+            "refreshed_shared": self.refreshed_shared,
+            "refreshed_upstream": self.refreshed_upstream,
+            "skipped_quota": self.skipped_quota,
+            "errors": self.errors,
+            "cache_hit_ratio": cache_stats["hit_ratio"],
+            "prefetch_hits": cache_stats["prefetch_hits"],
+            "recent": list(self.recent)[::-1],
+        }
@@ -0,0 +1,81 @@
+"""
+Small TTL cache of user display profiles (username + avatar).
+
+Shared by chat history enrichment and the WebSocket broadcast path so both
+resolve many senders with at most one ``$in`` query for the misses.
+"""
+
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+PROFILE_PROJECTION = {"username": 1, "avatar": 1}
+
+
+class ProfileCache:
+    def __init__(self, collection, ttl_seconds: float = 60, max_entries: int = 50000):
+        self.collection = collection
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[float, Optional[dict]]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.queries = 0
+
+    def _get_local(self, user_id: str):
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return False, None
+        expires_at, profile = entry
+        if expires_at <= time.monotonic():
+            del self._entries[user_id]
+            return False, None
+        self._entries.move_to_end(user_id)
+        return True, profile
+
+    def put(self, user_id: str, profile: Optional[dict]):
+        # None is cached too, so unknown senders do not cause repeated lookups
+        self._entries[user_id] = (time.monotonic() + self.ttl_seconds, profile)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def get_many(self, user_ids: Iterable[str]) -> Dict[str, Optional[dict]]:
+        profiles: Dict[str, Optional[dict]] = {}
+        missing = []
+        for user_id in set(user_ids):
+            found, profile = self._get_local(user_id)
+            if found:
+                self.hits += 1
+                profiles[user_id] = profile
+            else:
+                self.misses += 1
+                missing.append(user_id)
+
+        if missing:
+            self.queries += 1
+            cursor = self.collection.find({"_id": {"$in": missing}}, PROFILE_PROJECTION)
+            async for user in cursor:
+                profiles[user["_id"]] = {
+                    "username": user["username"],
+                    "avatar": user.get("avatar"),
+                }
+            for user_id in missing:
+                profiles.setdefault(user_id, None)
+                self.put(user_id, profiles[user_id])
+
+        return profiles
+
+    async def get(self, user_id: str) -> Optional[dict]:
+        return (await self.get_many([user_id]))[user_id]
+
+    def invalidate(self, user_id: str):
+        self._entries.pop(user_id, None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "queries": self.queries,
+        }
@@ -0,0 +1,249 @@
+"""
+Pub/sub backends for cross-process chat fan-out.
+
+Workers never broadcast directly: they publish each frame to the bus and
+broadcast only what they receive from it, to their own sockets. With the
+in-process backend that is a direct call; with Mongo or Redis every worker
+(including the publisher) receives the frame exactly once.
+
+Backends implement ``start(handler)``, ``publish(message, room)`` and
+``stop()``; the handler is called as ``handler(message, room)``.
+
+The Mongo backend has to re-open its tailable cursor whenever it dies, and
+resume without skipping frames. Client-generated ObjectIds cannot be the
+resume point: each worker stamps them with its own clock and counter, so a
+frame from one worker can sort below one already seen from another. Each
+event instead gets an empty BSON timestamp, which the server replaces with
+its own unique, increasing timestamp on insert. A re-opened cursor starts
+``resume_overlap_seconds`` before the last timestamp seen, which also
+covers concurrent inserts becoming visible slightly out of order, and
+events replayed from that overlap are dropped by ``_id``.
+"""
+
+import asyncio
+import logging
+from collections import deque
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Set, Tuple
+
+from bson import ObjectId, Timestamp
+from pymongo import CursorType
+from pymongo.errors import CollectionInvalid
+
+logger = logging.getLogger(__name__)
+
+Handler = Callable[[str, str], Awaitable[None]]
+
+
+class PubSubBackend:
+    name = "base"
+
+    def __init__(self):
+        self._handler: Optional[Handler] = None
+        self.published = 0
+        self.received = 0
+
+    async def start(self, handler: Handler):
+        self._handler = handler
+
+    async def publish(self, message: str, room: str = "global"):
+        raise NotImplementedError
+
+    async def stop(self):
+        pass
+
+    async def _deliver(self, message: str, room: str):
+        self.received += 1
+        if self._handler is None:
+            return
+        try:
+            await self._handler(message, room)
+        except Exception as e:
+            logger.error(f"Pub/sub handler error ({self.name}): {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": self.name, "published": self.published, "received": self.received}
+
+
+class InProcessPubSub(PubSubBackend):
+    name = "memory"
+
+    async def publish(self, message: str, room: str = "global"):
+        self.published += 1
+        await self._deliver(message, room)
+
+
+class MongoCappedPubSub(PubSubBackend):
+    """Tails a capped collection; works on standalone mongod (no replica set needed)."""
+
+    name = "mongo"
+
+    def __init__(self, db, collection_name: str = "chat_events", size_bytes: int = 16 * 1024 * 1024,
+                 channel: str = "chat", resume_overlap_seconds: int = 5, reopen_delay: float = 0.5):
+        super().__init__()
+        self.db = db
+        self.collection_name = collection_name
+        self.size_bytes = size_bytes
+        self.channel = channel
+        self.resume_overlap_seconds = resume_overlap_seconds
+        self.reopen_delay = reopen_delay
+        self.collection = db[collection_name]
+        self._task: Optional[asyncio.Task] = None
+        # (ts, _id) of events delivered within the resume overlap, oldest first
+        self._recent: Deque[Tuple[Timestamp, ObjectId]] = deque()
+        self._recent_ids: Set[ObjectId] = set()
+        self.reopens = 0
+        self.replayed = 0
+
+    async def start(self, handler: Handler):
+        await super().start(handler)
+        try:
+            await self.db.create_collection(self.collection_name, capped=True, size=self.size_bytes)
+        except CollectionInvalid:
+            pass  # Already exists
+        # Only deliver events published after this worker started
+        newest = await self.collection.find_one({"ts": {"$exists": True}}, sort=[("$natural", -1)])
+        self._task = asyncio.create_task(self._tail(newest["ts"] if newest else Timestamp(0, 0)))
+
+    async def publish(self, message: str, room: str = "global"):
+        self.published += 1
+        await self.collection.insert_one({
+            "channel": self.channel,
+            "room": room,
+            "payload": message,
+            "created_at": datetime.utcnow(),
+            # Filled in by the server with its own increasing timestamp
+            "ts": Timestamp(0, 0),
+        })
+
+    def _remember(self, doc: dict):
+        self._recent.append((doc["ts"], doc["_id"]))
+        self._recent_ids.add(doc["_id"])
+        horizon = doc["ts"].time - self.resume_overlap_seconds
+        while self._recent and self._recent[0][0].time < horizon:
+            _, forgotten = self._recent.popleft()
+            self._recent_ids.discard(forgotten)
+
+    async def _tail(self, start_ts: Timestamp):
+        query: Dict[str, Any] = {"ts": {"$gt": start_ts}, "channel": self.channel}
+        last_ts: Optional[Timestamp] = None
+        while True:
+            try:
+                cursor = self.collection.find(query, cursor_type=CursorType.TAILABLE_AWAIT)
+                while cursor.alive:
+                    async for doc in cursor:
+                        if doc["_id"] in self._recent_ids:
+                            self.replayed += 1
+                            continue
+                        if last_ts is None or doc["ts"] > last_ts:
+                            last_ts = doc["ts"]
+                        self._remember(doc)
+                        await self._deliver(doc["payload"], doc.get("room", "global"))
+                    await asyncio.sleep(0)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Chat event tailing failed, restarting: {e}")
+            # A tailable cursor dies when the collection is empty or it falls
+            # behind; re-open it a little before the last event seen
+            if last_ts is not None:
+                floor = Timestamp(max(last_ts.time - self.resume_overlap_seconds, 0), 0)
+                after = {"$gte": floor} if floor > start_ts else {"$gt": start_ts}
+                query = {"ts": after, "channel": self.channel}
+            self.reopens += 1
+            await asyncio.sleep(self.reopen_delay)
+
+    def stats(self) -> Dict[str, Any]:
+        return {**super().stats(), "reopens": self.reopens, "replayed": self.replayed}
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+class RedisPubSub(PubSubBackend):
+    """
+    Redis PUBLISH/SUBSCRIBE. ``client`` is anything exposing the
+    ``redis.asyncio`` surface used here: ``publish(channel, message)`` and
+    ``pubsub()`` returning an object with ``subscribe``, ``get_message``,
+    ``unsubscribe`` and ``close`` - e.g. a local fakeredis instance.
+    """
+
+    name = "redis"
+
+    def __init__(self, client, channel: str = "foxenfy:chat"):
+        super().__init__()
+        self.client = client
+        self.channel = channel
+        self._pubsub = None
+        self._task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def from_url(cls, url: str, channel: str = "foxenfy:chat") -> "RedisPubSub":
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise RuntimeError("The redis chat pub/sub backend requires the 'redis' package")
+        return cls(redis.from_url(url, decode_responses=True), channel)
+
+    async def start(self, handler: Handler):
+        await super().start(handler)
+        self._pubsub = self.client.pubsub()
+        await self._pubsub.subscribe(self.channel)
+        self._task = asyncio.create_task(self._listen())
+
+    async def publish(self, message: str, room: str = "global"):
+        self.published += 1
+        # Room names cannot contain newlines, so the first line carries the room
+        await self.client.publish(self.channel, f"{room}\n{message}")
+
+    async def _listen(self):
+        while True:
+            try:
+                message = await self._pubsub.get_message(
+                    ignore_subscribe_messages=True, timeout=1.0
+                )
+                if message is None:
+                    continue
+                data = message["data"]
+                if isinstance(data, bytes):
+                    data = data.decode()
+                room, _, payload = data.partition("\n")
+                await self._deliver(payload, room)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Redis chat subscription error: {e}")
+                await asyncio.sleep(0.5)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._pubsub is not None:
+            await self._pubsub.unsubscribe(self.channel)
+            await self._pubsub.close()
+            self._pubsub = None
+
+
+def create_pubsub(backend: str, db=None, redis_url: Optional[str] = None,
+                  capped_size_bytes: int = 16 * 1024 * 1024, channel: str = "chat") -> PubSubBackend:
+    # Buses on different channels share the backend but never see each other's messages
+    if backend == "memory":
+        return InProcessPubSub()
+    if backend == "mongo":
+        return MongoCappedPubSub(db, size_bytes=capped_size_bytes, channel=channel)
+    if backend == "redis":
+        if not redis_url:
+            raise ValueError("CHAT_PUBSUB_REDIS_URL is required for the redis backend")
+        return RedisPubSub.from_url(redis_url, f"foxenfy:{channel}")
+    raise ValueError(f"Unknown chat pub/sub backend: {backend}")
@@ -0,0 +1,227 @@
+"""
+Token-bucket rate limiting and the daily upstream quota budget.
+
+Buckets are kept in process memory (LRU-bounded) by default. With the Mongo
+store every worker updates the same bucket document atomically through a
+pipeline update, so limits hold across a multi-worker deployment. The quota
+budget counts YouTube units spent today and tells callers when to stop going
+upstream and answer from the cache or the local index instead.
+"""
+
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Tuple
+
+from pymongo import ReturnDocument
+
+logger = logging.getLogger(__name__)
+
+QUOTA_NORMAL = "normal"
+QUOTA_CONSERVE = "conserve"
+QUOTA_EXHAUSTED = "exhausted"
+
+
+class RateLimitExceeded(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__(f"Rate limit exceeded, retry after {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+class MemoryBucketStore:
+    name = "memory"
+
+    def __init__(self, max_keys: int = 100000):
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+
+    async def setup(self):
+        pass
+
+    async def take(self, key: str, capacity: float, rate: float, cost: float) -> Tuple[bool, float]:
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated) * rate)
+        allowed = tokens >= cost
+        if allowed:
+            tokens -= cost
+        self._buckets[key] = (tokens, now)
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return allowed, tokens
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+class MongoBucketStore:
+    name = "mongo"
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.errors = 0
+
+    async def setup(self):
+        try:
+            await self.collection.create_index("expires_at", expireAfterSeconds=0)
+        except Exception as e:
+            logger.error(f"Rate limit store index creation failed: {e}")
+
+    async def take(self, key: str, capacity: float, rate: float, cost: float) -> Tuple[bool, float]:
+        now = time.time()
+        # Refill, decide and consume in one atomic round trip
+        refilled = {"$min": [
+            capacity,
+            {"$add": [
+                {"$ifNull": ["$tokens", capacity]},
+                {"$multiply": [{"$subtract": [now, {"$ifNull": ["$updated", now]}]}, rate]},
+            ]},
+        ]}
+        pipeline = [
+            {"$set": {"tokens": refilled, "updated": now}},
+            {"$set": {"allowed": {"$gte": ["$tokens", cost]}}},
+            {"$set": {
+                "tokens": {"$cond": ["$allowed", {"$subtract": ["$tokens", cost]}, "$tokens"]},
+                # Idle buckets are full again after capacity / rate seconds
+                "expires_at": datetime.utcnow() + timedelta(seconds=capacity / rate + 60),
+            }},
+        ]
+        try:
+            doc = await self.collection.find_one_and_update(
+                {"_id": key}, pipeline, upsert=True, return_document=ReturnDocument.AFTER
+            )
+        except Exception as e:
+            # Fail open: a store outage must not take search down with it
+            self.errors += 1
+            logger.error(f"Rate limit store error: {e}")
+            return True, capacity
+        return doc["allowed"], doc["tokens"]
+
+
+class RateLimiter:
+    def __init__(self, name: str, capacity: float, per_minute: float, store=None):
+        self.name = name
+        self.capacity = capacity
+        self.rate = per_minute / 60
+        self.store = store if store is not None else MemoryBucketStore()
+        self.allowed = 0
+        self.limited = 0
+
+    async def hit(self, key: str, cost: float = 1):
+        allowed, tokens = await self.store.take(f"{self.name}:{key}", self.capacity, self.rate, cost)
+        if allowed:
+            self.allowed += 1
+            return
+        self.limited += 1
+        raise RateLimitExceeded((cost - tokens) / self.rate)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "capacity": self.capacity,
+            "per_minute": self.rate * 60,
+            "store": self.store.name,
+            "allowed": self.allowed,
+            "limited": self.limited,
+        }
+
+
+class QuotaBudget:
+    def __init__(
+        self,
+        daily_limit: int = 10000,
+        conserve_ratio: float = 0.8,
+        exhausted_ratio: float = 0.98,
+        collection=None,
+        reset_tz: str = "America/Los_Angeles",
+        refresh_seconds: float = 5,
+    ):
+        self.daily_limit = daily_limit
+        self.conserve_ratio = conserve_ratio
+        self.exhausted_ratio = exhausted_ratio
+        self.collection = collection
+        self.refresh_seconds = refresh_seconds
+        self.tz = self._load_tz(reset_tz)
+        self.used = 0
+        self.spent_here = 0
+        self._day = self.day_key()
+        self._refreshed_at = 0.0
+
+    @staticmethod
+    def _load_tz(name: str):
+        # YouTube quotas reset at midnight Pacific time
+        try:
+            from zoneinfo import ZoneInfo
+            return ZoneInfo(name)
+        except Exception:
+            logger.warning(f"Time zone {name} unavailable, quota resets at midnight UTC")
+            return timezone.utc
+
+    def day_key(self) -> str:
+        return datetime.now(self.tz).strftime("%Y-%m-%d")
+
+    def seconds_until_reset(self) -> int:
+        now = datetime.now(self.tz)
+        midnight = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+        return max(1, int((midnight - now).total_seconds()))
+
+    def _roll_day(self):
+        day = self.day_key()
+        if day != self._day:
+            self._day = day
+            self.used = 0
+
+    async def spend(self, units: int):
+        self._roll_day()
+        self.spent_here += units
+        if self.collection is None:
+            self.used += units
+            return
+        try:
+            doc = await self.collection.find_one_and_update(
+                {"_id": self._day},
+                {"$inc": {"used": units}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+            self.used = doc["used"]
+            self._refreshed_at = time.monotonic()
+        except Exception as e:
+            logger.error(f"Quota budget update failed: {e}")
+            self.used += units
+
+    async def refresh(self):
+        # Pick up what other workers spent since our last write
+        self._roll_day()
+        if self.collection is None or time.monotonic() - self._refreshed_at < self.refresh_seconds:
+            return
+        self._refreshed_at = time.monotonic()
+        try:
+            doc = await self.collection.find_one({"_id": self._day})
+        except Exception as e:
+            logger.error(f"Quota budget read failed: {e}")
+            return
+        self.used = max(self.used, doc["used"] if doc else 0)
+
+    def current_mode(self) -> str:
+        if self.used >= self.daily_limit * self.exhausted_ratio:
+            return QUOTA_EXHAUSTED
+        if self.used >= self.daily_limit * self.conserve_ratio:
+            return QUOTA_CONSERVE
+        return QUOTA_NORMAL
+
+    async def mode(self) -> str:
+        await self.refresh()
+        return self.current_mode()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "day": self._day,
+            "daily_limit": self.daily_limit,
+            "used": self.used,
+            "spent_by_this_worker": self.spent_here,
+            "mode": self.current_mode(),
+            "shared": self.collection is not None,
+            "seconds_until_reset": self.seconds_until_reset(),
+        }
@@ -0,0 +1,246 @@
+"""
+Two-tier cache for upstream music search results.
+
+Tier one is an in-process LRU with a TTL, tier two is an optional Mongo
+collection shared by every worker (expired by a TTL index). Concurrent
+identical misses are coalesced so only one upstream call is made; that call
+runs in its own task, so the requester that started it can disconnect
+without cancelling the others waiting on the same key. Entries
+can also be refreshed ahead of expiry (see ``prefetch``); hits on those are
+counted separately so the effect of prefetching is visible.
+"""
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Cost of one youtube/v3/search call in quota units
+SEARCH_QUOTA_COST = 100
+
+
+class SearchCache:
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        ttl_seconds: float = 300,
+        collection=None,
+        shared_ttl_seconds: float = 3600,
+    ):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.collection = collection
+        self.shared_ttl_seconds = shared_ttl_seconds
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._prefetched: Set[str] = set()
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.upstream_errors = 0
+        self.prefetch_hits = 0
+
+    @staticmethod
+    def make_key(q: str, max_results: int, cursor: Optional[str] = None) -> str:
+        normalized = " ".join(q.lower().split())
+        return f"{normalized}|{max_results}|{cursor or ''}"
+
+    async def setup(self):
+        if self.collection is None:
+            return
+        try:
+            await self.collection.create_index("expires_at", expireAfterSeconds=0)
+        except Exception as e:
+            logger.error(f"Search cache index creation failed: {e}")
+
+    def _get_local(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            self._prefetched.discard(key)
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def _set_local(self, key: str, value: Any, ttl_seconds: Optional[float] = None):
+        ttl = self.ttl_seconds if ttl_seconds is None else min(ttl_seconds, self.ttl_seconds)
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            evicted, _ = self._entries.popitem(last=False)
+            self._prefetched.discard(evicted)
+
+    def _count_local_hit(self, key: str):
+        self.local_hits += 1
+        if key in self._prefetched:
+            self.prefetch_hits += 1
+
+    async def _get_shared_doc(self, key: str) -> Optional[dict]:
+        if self.collection is None:
+            return None
+        try:
+            return await self.collection.find_one(
+                {"_id": key, "expires_at": {"$gt": datetime.utcnow()}}
+            )
+        except Exception as e:
+            logger.error(f"Shared search cache read failed: {e}")
+            return None
+
+    async def _get_shared(self, key: str) -> Optional[Any]:
+        doc = await self._get_shared_doc(key)
+        return doc["value"] if doc else None
+
+    async def _set_shared(self, key: str, value: Any):
+        if self.collection is None:
+            return
+        now = datetime.utcnow()
+        try:
+            await self.collection.replace_one(
+                {"_id": key},
+                {
+                    "_id": key,
+                    "value": value,
+                    "created_at": now,
+                    "expires_at": now + timedelta(seconds=self.shared_ttl_seconds),
+                },
+                upsert=True,
+            )
+        except Exception as e:
+            logger.error(f"Shared search cache write failed: {e}")
+
+    def peek(self, q: str, max_results: int, cursor: Optional[str] = None) -> Optional[Any]:
+        key = self.make_key(q, max_results, cursor)
+        value = self._get_local(key)
+        if value is not None:
+            self._count_local_hit(key)
+        return value
+
+    async def get_cached(self, q: str, max_results: int, cursor: Optional[str] = None) -> Optional[Any]:
+        # Both tiers, never upstream: for callers that must not spend quota
+        key = self.make_key(q, max_results, cursor)
+        value = self._get_local(key)
+        if value is not None:
+            self._count_local_hit(key)
+            return value
+        doc = await self._get_shared_doc(key)
+        if doc is None:
+            return None
+        self.shared_hits += 1
+        remaining = (doc["expires_at"] - datetime.utcnow()).total_seconds()
+        self._set_local(key, doc["value"], remaining)
+        return doc["value"]
+
+    def expires_in(self, q: str, max_results: int) -> float:
+        entry = self._entries.get(self.make_key(q, max_results))
+        return max(0.0, entry[0] - time.monotonic()) if entry else 0.0
+
+    async def refresh(
+        self,
+        q: str,
+        max_results: int,
+        fetch: Callable[[], Awaitable[Any]],
+        min_shared_ttl: float = 0,
+        allow_upstream: bool = True,
+    ) -> Optional[str]:
+        # Reload an entry ahead of expiry: from the shared tier while it has at
+        # least min_shared_ttl seconds left, otherwise from upstream. Returns
+        # where the value came from, or None if upstream was not allowed.
+        key = self.make_key(q, max_results)
+        doc = await self._get_shared_doc(key)
+        if doc is not None:
+            remaining = (doc["expires_at"] - datetime.utcnow()).total_seconds()
+            if remaining > min_shared_ttl:
+                self._set_local(key, doc["value"], remaining)
+                self._prefetched.add(key)
+                return "shared"
+        if not allow_upstream:
+            return None
+        # Join a user miss already loading this key rather than paying twice
+        task = self._inflight.get(key) or self._start_load(key, fetch, use_shared=False)
+        await asyncio.shield(task)
+        self._prefetched.add(key)
+        return "upstream"
+
+    async def get_or_fetch(
+        self,
+        q: str,
+        max_results: int,
+        fetch: Callable[[], Awaitable[Any]],
+        cursor: Optional[str] = None,
+    ) -> Any:
+        key = self.make_key(q, max_results, cursor)
+
+        value = self._get_local(key)
+        if value is not None:
+            self._count_local_hit(key)
+            return value
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            task = self._start_load(key, fetch)
+        # Cancelling a waiter (a client that went away) leaves the load running
+        return await asyncio.shield(task)
+
+    def _start_load(self, key: str, fetch: Callable[[], Awaitable[Any]], use_shared: bool = True) -> asyncio.Task:
+        task = asyncio.create_task(self._load(key, fetch, use_shared))
+        self._inflight[key] = task
+        task.add_done_callback(lambda done: self._load_done(key, done))
+        return task
+
+    async def _load(self, key: str, fetch: Callable[[], Awaitable[Any]], use_shared: bool) -> Any:
+        # use_shared is False for refreshes, which have already rejected the shared copy
+        value = await self._get_shared(key) if use_shared else None
+        if value is not None:
+            self.shared_hits += 1
+        else:
+            if use_shared:
+                self.misses += 1
+            try:
+                value = await fetch()
+            except Exception:
+                self.upstream_errors += 1
+                raise
+            await self._set_shared(key, value)
+        self._set_local(key, value)
+        return value
+
+    def _load_done(self, key: str, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            # Mark as retrieved so a failure nobody waited for does not warn at GC
+            task.exception()
+
+    def clear(self):
+        self._entries.clear()
+        self._prefetched.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        served = self.local_hits + self.shared_hits + self.coalesced
+        total = served + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "shared_tier": self.collection is not None,
+            "local_hits": self.local_hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "upstream_errors": self.upstream_errors,
+            "inflight": len(self._inflight),
+            "hit_ratio": round(served / total, 4) if total else 0.0,
+            "prefetched_entries": len(self._prefetched),
+            "prefetch_hits": self.prefetch_hits,
+            "quota_units_saved": served * SEARCH_QUOTA_COST,
+        }
@@ -0,0 +1,59 @@
+"""
+Fast JSON encoding for HTTP responses, chat frames and stream events.
+
+Uses orjson when it is installed, which encodes datetimes natively (same
+ISO 8601 text as ``datetime.isoformat()``) and is several times faster than
+the stdlib. Falls back to ``json`` with the same compact output otherwise.
+
+``FastJSONResponse`` is the app's default response class. Handlers serving
+data the server built itself return one directly: FastAPI then skips both the
+``jsonable_encoder`` walk and response-model validation, while the route's
+``response_model`` still documents the shape in the OpenAPI schema.
+"""
+
+import json
+from datetime import date, datetime
+from typing import Any
+
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Stats endpoints key some dicts by non-string values
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS if orjson is not None else 0
+
+
+def _default(value: Any) -> Any:
+    if isinstance(value, BaseModel):
+        return value.model_dump()
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(value: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(value, default=_default, option=ORJSON_OPTIONS)
+    return json.dumps(value, default=_default, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def dumps_text(value: Any) -> str:
+    # For transports that want text (WebSocket text frames, pub/sub payloads)
+    return dumps(value).decode()
+
+
+def loads(data: Any) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
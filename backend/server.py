@@ -1,32 +1,155 @@
-from fastapi import FastAPI, HTTPException, Depends, status, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Request, status, WebSocket, WebSocketDisconnect
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from pymongo import MongoClient
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 from motor.motor_asyncio import AsyncIOMotorClient
-from datetime import datetime, timedelta
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
 from typing import Optional, List, Dict, Any
 import os
-import httpx
+import asyncio
+import math
+import threading
 import uuid
 import json
 import logging
-from passlib.context import CryptContext
 from jose import JWTError, jwt
-from pydantic import BaseModel, EmailStr, validator
+from pydantic import BaseModel, EmailStr, ValidationError, validator
 from dotenv import load_dotenv
+from search_cache import SearchCache, SEARCH_QUOTA_COST
+from upstream import UpstreamClient, UpstreamError, CircuitOpenError
+from session_cache import SessionCache
+from password_hasher import PasswordHasher, PasswordPoolSaturated
+from profile_cache import ProfileCache
+from chat_writer import ChatWriter
+from chat_history import ChatSequencer, RecentMessages, SHARED
+from connection_manager import ConnectionManager, DEFAULT_ROOM
+from pubsub import create_pubsub
+from indexes import IndexManager, register_core_indexes
+from database import MongoHealth, RoutedDatabase, parse_read_preferences
+from library_store import LibraryStore
+from playlist_store import PlaylistStore, PlaylistFull
+from history_ingest import HistoryIngestor
+from catalog import SongCatalog
+from local_search import LocalSearchIndex
+from prefetch import QueryPrefetcher
+from serialization import FastJSONResponse, dumps_text, loads
+from diagnostics import LoopWatchdog, SamplingProfiler, ProfilerBusy
+from log_pipeline import LogPipeline, RequestIdMiddleware, parse_sample_rates
+from metrics import (
+    Registry, MetricsMiddleware, MongoCommandMetrics, EventLoopLagMonitor, CONTENT_TYPE, FAST_BUCKETS
+)
+from rate_limit import (
+    MemoryBucketStore, MongoBucketStore, QuotaBudget, RateLimiter, RateLimitExceeded,
+    QUOTA_NORMAL, QUOTA_EXHAUSTED
+)
 
 # Load environment variables
 load_dotenv()
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Configure logging: records are queued and written by a background thread
+log_pipeline = LogPipeline(
+    level=os.getenv("LOG_LEVEL", "INFO"),
+    fmt=os.getenv("LOG_FORMAT", "json"),
+    sample_rates=parse_sample_rates(os.getenv("LOG_SAMPLE_RATES", "search=0.1,chat_connect=0.1")),
+    queue_size=int(os.getenv("LOG_QUEUE_SIZE", 10000))
+)
+log_pipeline.install()
+# httpx logs every upstream request at INFO; the metrics already cover those
+logging.getLogger("httpx").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
+# Metrics, exposed in Prometheus text format at /metrics
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+# When set, scrapers must send "Authorization: Bearer <token>"
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+metrics = Registry()
+http_request_seconds = metrics.histogram(
+    "http_request_duration_seconds", "HTTP request latency by route template",
+    ["method", "route", "status"]
+)
+mongo_command_seconds = metrics.histogram(
+    "mongo_command_duration_seconds", "MongoDB command latency by collection and command",
+    ["collection", "command"], buckets=FAST_BUCKETS
+)
+mongo_command_failures = metrics.counter(
+    "mongo_command_failures_total", "Failed MongoDB commands", ["collection", "command"]
+)
+upstream_request_seconds = metrics.histogram(
+    "upstream_request_duration_seconds", "Upstream HTTP attempt latency by path and status",
+    ["upstream", "path", "status"]
+)
+chat_fanout_seconds = metrics.histogram(
+    "chat_broadcast_fanout_seconds", "Time to fan a chat frame out to this worker's connections",
+    buckets=FAST_BUCKETS
+)
+event_loop_lag_seconds = metrics.histogram(
+    "event_loop_lag_seconds", "Delay of a periodic event-loop wake-up", buckets=FAST_BUCKETS
+)
+loop_monitor = EventLoopLagMonitor(
+    event_loop_lag_seconds, interval=float(os.getenv("EVENT_LOOP_LAG_INTERVAL", 0.5))
+)
+mongo_command_metrics = MongoCommandMetrics(mongo_command_seconds, mongo_command_failures)
+
+# Opt-in stall detection; the on-demand profiler is always available to admins
+DIAGNOSTICS_ENABLED = os.getenv("DIAGNOSTICS_ENABLED", "false").lower() == "true"
+loop_watchdog = LoopWatchdog(
+    threshold_ms=float(os.getenv("DIAGNOSTICS_SLOW_CALLBACK_MS", 100)),
+    interval_ms=float(os.getenv("DIAGNOSTICS_HEARTBEAT_MS", 20))
+)
+profiler = SamplingProfiler(max_seconds=float(os.getenv("DIAGNOSTICS_PROFILE_MAX_SECONDS", 60)))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    log_pipeline.start()
+    if METRICS_ENABLED:
+        await loop_monitor.start()
+    if DIAGNOSTICS_ENABLED:
+        await loop_watchdog.start()
+    # Open the pool before anything queries, so readiness means warm connections
+    await mongo_health.warm_up(MONGO_WARM_CONNECTIONS)
+    await mongo_health.start()
+    await index_manager.bootstrap()
+    await youtube_client.start()
+    await search_cache.setup()
+    await rate_limit_store.setup()
+    await chat_writer.start()
+    await chat_sequencer.start()
+    await chat_buffer.load(db.chat_messages, lambda doc: serialize_chat_message(doc, None))
+    await history_ingestor.start()
+    await catalog.start()
+    spawn(load_local_search_index())
+    if SEARCH_PREFETCH_ENABLED:
+        await prefetcher.start()
+    await control_bus.start(handle_control_message)
+    await chat_bus.start(deliver_chat_frame)
+    await manager.start()
+    yield
+    await mongo_health.stop()
+    await manager.stop()
+    await chat_bus.stop()
+    await control_bus.stop()
+    await chat_writer.stop()
+    await chat_sequencer.stop()
+    await history_ingestor.stop()
+    await prefetcher.stop()
+    await catalog.stop()
+    await youtube_client.close()
+    password_hasher.shutdown()
+    await loop_monitor.stop()
+    await loop_watchdog.stop()
+    client.close()
+    log_pipeline.stop()
+
 app = FastAPI(
     title="Foxenfy API", 
     version="2.0.0",
-    description="Premium Music Streaming Platform API"
+    description="Premium Music Streaming Platform API",
+    default_response_class=FastJSONResponse,
+    lifespan=lifespan
 )
 
 # CORS configuration
@@ -38,60 +161,286 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# MongoDB connection
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware, histogram=http_request_seconds, exclude=["/metrics", "/livez", "/readyz"])
+
+# Added last so it is outermost and every other layer sees the request id
+app.add_middleware(RequestIdMiddleware)
+
+# MongoDB connection. Motor connects lazily; the lifespan warms the pool
+# and closes it. Pool settings given here override those in MONGO_URL.
 MONGO_URL = os.getenv("MONGO_URL")
-client = AsyncIOMotorClient(MONGO_URL)
+MONGO_POOL_OPTIONS = {
+    "maxPoolSize": int(os.getenv("MONGO_MAX_POOL_SIZE", 100)),
+    "minPoolSize": int(os.getenv("MONGO_MIN_POOL_SIZE", 10)),
+    "maxIdleTimeMS": int(os.getenv("MONGO_MAX_IDLE_TIME_MS", 300000)),
+    "connectTimeoutMS": int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", 5000)),
+    "serverSelectionTimeoutMS": int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000)),
+    "socketTimeoutMS": int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", 30000)),
+}
+client = AsyncIOMotorClient(
+    MONGO_URL,
+    event_listeners=[mongo_command_metrics] if METRICS_ENABLED else [],
+    **MONGO_POOL_OPTIONS
+)
+MONGO_WARM_CONNECTIONS = int(os.getenv("MONGO_WARM_CONNECTIONS", MONGO_POOL_OPTIONS["minPoolSize"]))
+
+# e.g. MONGO_READ_PREFERENCES="chat_messages=secondaryPreferred,songs=secondaryPreferred"
+# sends chat history and catalog reads to secondaries; writes always go to the primary
+MONGO_READ_PREFERENCES = parse_read_preferences(
+    os.getenv("MONGO_READ_PREFERENCES", ""),
+    max_staleness_seconds=int(os.getenv("MONGO_MAX_STALENESS_SECONDS", -1))
+)
 db = client.foxenfy_db
+if MONGO_READ_PREFERENCES:
+    db = RoutedDatabase(db, MONGO_READ_PREFERENCES)
+
+# Readiness is answered from a cached ping refreshed in the background
+mongo_health = MongoHealth(
+    client,
+    interval_seconds=float(os.getenv("MONGO_HEALTH_INTERVAL_SECONDS", 5)),
+    timeout_seconds=float(os.getenv("MONGO_HEALTH_TIMEOUT_SECONDS", 2)),
+    failure_threshold=int(os.getenv("MONGO_HEALTH_FAILURE_THRESHOLD", 2))
+)
+metrics.gauge("mongo_up", "1 while the cached MongoDB ping succeeds", callback=lambda: int(mongo_health.ok))
+
+# Required indexes; MONGO_INDEX_CHECK=warn|strict also explains hot queries at startup
+index_manager = IndexManager(db, check_mode=os.getenv("MONGO_INDEX_CHECK", "off"))
+register_core_indexes(index_manager)
 
 # Security
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+password_hasher = PasswordHasher(
+    rounds=int(os.getenv("BCRYPT_ROUNDS", 12)),
+    max_workers=int(os.getenv("PASSWORD_POOL_WORKERS", 4)),
+    max_pending=int(os.getenv("PASSWORD_POOL_MAX_PENDING", 64))
+)
 security = HTTPBearer()
 JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY")
 JWT_ALGORITHM = os.getenv("JWT_ALGORITHM")
 JWT_ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("JWT_ACCESS_TOKEN_EXPIRE_MINUTES", 30))
 YOUTUBE_API_KEY = os.getenv("YOUTUBE_API_KEY")
 
+# Authenticated session cache (token hash -> projected user document)
+session_cache = SessionCache(
+    max_entries=int(os.getenv("SESSION_CACHE_MAX_ENTRIES", 10000)),
+    max_ttl_seconds=float(os.getenv("SESSION_CACHE_MAX_TTL_SECONDS", 300))
+)
+
+# Fields needed to authorize a request; never pull the unbounded arrays
+USER_PROJECTION = {
+    "username": 1,
+    "email": 1,
+    "role": 1,
+    "avatar": 1,
+    "created_at": 1,
+    "premium_until": 1
+}
+
+# Display profiles (username/avatar) for chat enrichment
+profile_cache = ProfileCache(
+    db.users,
+    ttl_seconds=float(os.getenv("PROFILE_CACHE_TTL_SECONDS", 60)),
+    max_entries=int(os.getenv("PROFILE_CACHE_MAX_ENTRIES", 50000))
+)
+
+# Chat sequence numbers: the shared counter, unless a single worker opts into "local"
+chat_sequencer = ChatSequencer(
+    db,
+    mode=os.getenv("CHAT_SEQUENCE_MODE", SHARED),
+    workers=int(os.getenv("WEB_CONCURRENCY", 1))
+)
+ChatSequencer.register_indexes(index_manager)
+
+# Chat message persistence ("sync" or "write_behind")
+chat_writer = ChatWriter(
+    db.chat_messages,
+    mode=os.getenv("CHAT_PERSISTENCE_MODE", "write_behind"),
+    flush_interval_ms=float(os.getenv("CHAT_FLUSH_INTERVAL_MS", 50)),
+    max_batch=int(os.getenv("CHAT_FLUSH_MAX_BATCH", 500)),
+    max_queue=int(os.getenv("CHAT_WRITE_MAX_QUEUE", 10000)),
+    resequence=chat_sequencer.reassign
+)
+
+# Liked songs and listening history, one document per entry
+library = LibraryStore(db, history_limit=int(os.getenv("HISTORY_MAX_ENTRIES_PER_USER", 1000)))
+LibraryStore.register_indexes(index_manager)
+
+# Playlists with per-track documents ordered by fractional position keys
+playlists = PlaylistStore(db, max_tracks=int(os.getenv("PLAYLIST_MAX_TRACKS", 5000)))
+PlaylistStore.register_indexes(index_manager)
+
+# Buffered play-event ingestion with per-user/per-song rollups
+history_ingestor = HistoryIngestor(
+    db,
+    library,
+    flush_interval_ms=float(os.getenv("HISTORY_FLUSH_INTERVAL_MS", 250)),
+    max_batch=int(os.getenv("HISTORY_FLUSH_MAX_BATCH", 1000)),
+    max_buffer=int(os.getenv("HISTORY_MAX_BUFFER", 50000)),
+    sweep_interval=float(os.getenv("HISTORY_ROLLUP_SWEEP_INTERVAL", 30))
+)
+HistoryIngestor.register_indexes(index_manager)
+
+# Upstream YouTube client (pooled, created at startup)
+YOUTUBE_API_BASE_URL = os.getenv("YOUTUBE_API_BASE_URL", "https://www.googleapis.com/youtube/v3")
+
+youtube_client = UpstreamClient(
+    "youtube",
+    YOUTUBE_API_BASE_URL,
+    max_connections=int(os.getenv("UPSTREAM_MAX_CONNECTIONS", 100)),
+    max_keepalive_connections=int(os.getenv("UPSTREAM_MAX_KEEPALIVE", 20)),
+    keepalive_expiry=float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", 30)),
+    connect_timeout=float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", 2)),
+    read_timeout=float(os.getenv("UPSTREAM_READ_TIMEOUT", 5)),
+    max_retries=int(os.getenv("UPSTREAM_MAX_RETRIES", 2)),
+    breaker_threshold=int(os.getenv("UPSTREAM_BREAKER_THRESHOLD", 5)),
+    breaker_reset_seconds=float(os.getenv("UPSTREAM_BREAKER_RESET_SECONDS", 30))
+)
+
+# Local song catalog; durations are filled in lazily via batched videos.list
+catalog = SongCatalog(
+    db,
+    fetch_videos=None,  # Wired to fetch_video_durations below
+    enrich_interval=float(os.getenv("CATALOG_ENRICH_INTERVAL", 2)),
+    duration_cache_size=int(os.getenv("CATALOG_DURATION_CACHE_SIZE", 50000))
+)
+SongCatalog.register_indexes(index_manager)
+
+# Local search over songs already in the catalog; upstream is the fallback
+local_search = LocalSearchIndex(max_songs=int(os.getenv("LOCAL_SEARCH_MAX_SONGS", 200000)))
+catalog.add_listener(local_search.add_many)
+LOCAL_SEARCH_ENABLED = os.getenv("LOCAL_SEARCH_ENABLED", "true").lower() == "true"
+# Fraction of max_results the local index must return to skip the upstream call
+LOCAL_SEARCH_MIN_RECALL = float(os.getenv("LOCAL_SEARCH_MIN_RECALL", 0.5))
+
+# Search result cache
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", 2048))
+SEARCH_CACHE_TTL_SECONDS = float(os.getenv("SEARCH_CACHE_TTL_SECONDS", 300))
+SEARCH_CACHE_SHARED = os.getenv("SEARCH_CACHE_SHARED", "true").lower() == "true"
+SEARCH_CACHE_SHARED_TTL_SECONDS = float(os.getenv("SEARCH_CACHE_SHARED_TTL_SECONDS", 3600))
+
+search_cache = SearchCache(
+    max_entries=SEARCH_CACHE_MAX_ENTRIES,
+    ttl_seconds=SEARCH_CACHE_TTL_SECONDS,
+    collection=db.search_cache if SEARCH_CACHE_SHARED else None,
+    shared_ttl_seconds=SEARCH_CACHE_SHARED_TTL_SECONDS
+)
+
+# Rate limiting and the daily YouTube quota budget
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+# Trust X-Forwarded-For only when running behind a proxy that sets it
+RATE_LIMIT_TRUST_FORWARDED = os.getenv("RATE_LIMIT_TRUST_FORWARDED", "false").lower() == "true"
+
+if os.getenv("RATE_LIMIT_STORE", "memory") == "mongo":
+    rate_limit_store = MongoBucketStore(db.rate_limits)
+else:
+    rate_limit_store = MemoryBucketStore(max_keys=int(os.getenv("RATE_LIMIT_MAX_KEYS", 100000)))
+
+search_user_limiter = RateLimiter(
+    "search_user",
+    capacity=float(os.getenv("SEARCH_RATE_USER_BURST", 20)),
+    per_minute=float(os.getenv("SEARCH_RATE_USER_PER_MINUTE", 60)),
+    store=rate_limit_store
+)
+search_ip_limiter = RateLimiter(
+    "search_ip",
+    capacity=float(os.getenv("SEARCH_RATE_IP_BURST", 60)),
+    per_minute=float(os.getenv("SEARCH_RATE_IP_PER_MINUTE", 180)),
+    store=rate_limit_store
+)
+auth_ip_limiter = RateLimiter(
+    "auth_ip",
+    capacity=float(os.getenv("AUTH_RATE_IP_BURST", 10)),
+    per_minute=float(os.getenv("AUTH_RATE_IP_PER_MINUTE", 20)),
+    store=rate_limit_store
+)
+
+quota_budget = QuotaBudget(
+    daily_limit=int(os.getenv("YOUTUBE_DAILY_QUOTA", 10000)),
+    conserve_ratio=float(os.getenv("YOUTUBE_QUOTA_CONSERVE_RATIO", 0.8)),
+    exhausted_ratio=float(os.getenv("YOUTUBE_QUOTA_EXHAUSTED_RATIO", 0.98)),
+    collection=db.upstream_quota if os.getenv("YOUTUBE_QUOTA_SHARED", "true").lower() == "true" else None
+)
+
+# Refresh-ahead and post-deploy warm-up of popular searches
+SEARCH_PREFETCH_ENABLED = os.getenv("SEARCH_PREFETCH_ENABLED", "true").lower() == "true"
+SEARCH_PREFETCH_QUOTA_SHARE = float(os.getenv("SEARCH_PREFETCH_QUOTA_SHARE", 0.3))
+
+prefetcher = QueryPrefetcher(
+    db,
+    search_cache,
+    fetch=lambda q, max_results: fetch_youtube_page(q, max_results),
+    # Prefetching is optional work: it may only use the first share of the day's quota
+    allow_upstream=lambda: quota_budget.used < quota_budget.daily_limit * SEARCH_PREFETCH_QUOTA_SHARE,
+    interval_seconds=float(os.getenv("SEARCH_PREFETCH_INTERVAL_SECONDS", 30)),
+    top_n=int(os.getenv("SEARCH_PREFETCH_TOP_N", 50)),
+    warm_n=int(os.getenv("SEARCH_PREFETCH_WARM_N", 50)),
+    refresh_ahead_seconds=float(os.getenv("SEARCH_PREFETCH_REFRESH_AHEAD_SECONDS", 60)),
+    max_upstream_per_cycle=int(os.getenv("SEARCH_PREFETCH_MAX_UPSTREAM_PER_CYCLE", 5))
+)
+QueryPrefetcher.register_indexes(index_manager)
+
 # WebSocket connection manager for chat
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
-        self.user_connections: Dict[str, WebSocket] = {}
-
-    async def connect(self, websocket: WebSocket, user_id: str):
-        await websocket.accept()
-        self.active_connections.append(websocket)
-        self.user_connections[user_id] = websocket
-        logger.info(f"User {user_id} connected to chat")
-
-    def disconnect(self, websocket: WebSocket, user_id: str):
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
-        if user_id in self.user_connections:
-            del self.user_connections[user_id]
-        logger.info(f"User {user_id} disconnected from chat")
-
-    async def send_personal_message(self, message: str, user_id: str):
-        if user_id in self.user_connections:
-            try:
-                await self.user_connections[user_id].send_text(message)
-            except Exception as e:
-                logger.error(f"Failed to send message to user {user_id}: {e}")
+manager = ConnectionManager(
+    max_queue=int(os.getenv("CHAT_CLIENT_MAX_QUEUE", 256)),
+    slow_consumer_policy=os.getenv("CHAT_SLOW_CONSUMER_POLICY", "drop_oldest"),
+    send_timeout=float(os.getenv("CHAT_SEND_TIMEOUT", 5)),
+    heartbeat_interval=float(os.getenv("CHAT_HEARTBEAT_INTERVAL", 30)),
+    idle_timeout=float(os.getenv("CHAT_IDLE_TIMEOUT", 90))
+)
 
-    async def broadcast(self, message: str):
-        disconnected = []
-        for user_id, connection in self.user_connections.items():
-            try:
-                await connection.send_text(message)
-            except Exception as e:
-                logger.error(f"Failed to broadcast to user {user_id}: {e}")
-                disconnected.append(user_id)
-        
-        # Clean up disconnected users
-        for user_id in disconnected:
-            if user_id in self.user_connections:
-                del self.user_connections[user_id]
+# Chat fan-out bus; each worker broadcasts what it receives to its own sockets
+PUBSUB_OPTIONS = {
+    "db": db,
+    "redis_url": os.getenv("CHAT_PUBSUB_REDIS_URL"),
+    "capped_size_bytes": int(os.getenv("CHAT_PUBSUB_CAPPED_SIZE", 16 * 1024 * 1024)),
+}
+chat_bus = create_pubsub(os.getenv("CHAT_PUBSUB_BACKEND", "memory"), **PUBSUB_OPTIONS)
+# Same backend, separate channel: cache invalidations between workers
+control_bus = create_pubsub(os.getenv("CHAT_PUBSUB_BACKEND", "memory"), channel="control", **PUBSUB_OPTIONS)
 
-manager = ConnectionManager()
+# Recent messages per worker, for reconnect replay and the latest history pages
+chat_buffer = RecentMessages(capacity=int(os.getenv("CHAT_BUFFER_SIZE", 2000)))
+# Larger gaps make the client reload history over HTTP instead
+CHAT_REPLAY_MAX = min(int(os.getenv("CHAT_REPLAY_MAX", 200)), manager.max_queue // 2)
+
+# Scrape-time gauges read from the components' own counters
+def cache_hit_ratios() -> Dict[tuple, float]:
+    profile = profile_cache.stats()
+    profile_total = profile["hits"] + profile["misses"]
+    return {
+        ("search",): search_cache.stats()["hit_ratio"],
+        ("session",): session_cache.stats()["hit_ratio"],
+        ("profile",): profile["hits"] / profile_total if profile_total else 0.0,
+    }
+
+metrics.gauge("cache_hit_ratio", "Hit ratio since start", ["cache"], callback=cache_hit_ratios)
+metrics.gauge("websocket_connections", "Open chat WebSocket connections", callback=lambda: len(manager.connections))
+metrics.gauge(
+    "chat_queued_frames", "Frames waiting in per-connection send queues",
+    callback=lambda: manager.stats()["queued_frames"]
+)
+metrics.gauge("event_loop_lag_max_seconds", "Largest event-loop lag seen", callback=lambda: loop_monitor.max_lag)
+metrics.gauge("upstream_quota_used_units", "YouTube quota units used today", callback=lambda: quota_budget.used)
+metrics.gauge(
+    "upstream_circuit_open", "1 while the upstream circuit breaker is open",
+    ["upstream"], callback=lambda: {(youtube_client.name,): int(youtube_client.breaker.state == "open")}
+)
+youtube_client.add_observer(
+    lambda path, status, seconds: upstream_request_seconds.observe(
+        seconds, upstream=youtube_client.name, path=path, status=status
+    )
+)
+
+# Quota units per YouTube endpoint. Charged before every attempt, retries
+# included: YouTube bills each call even when it fails.
+YOUTUBE_QUOTA_COSTS = {"/search": SEARCH_QUOTA_COST, "/videos": 1}
+
+async def charge_youtube_quota(path: str):
+    cost = YOUTUBE_QUOTA_COSTS.get(path)
+    if cost:
+        await quota_budget.spend(cost)
+
+youtube_client.add_attempt_hook(charge_youtube_quota)
 
 # Enhanced Pydantic models with validation
 class UserCreate(BaseModel):
@@ -121,10 +470,19 @@ class UserLogin(BaseModel):
     email: EmailStr
     password: str
 
+class User(BaseModel):
+    id: str
+    username: str
+    email: str
+    role: str
+    avatar: Optional[str] = None
+    created_at: datetime
+    premium_until: Optional[datetime] = None
+
 class Token(BaseModel):
     access_token: str
     token_type: str
-    user: dict
+    user: User
 
 class PlaylistCreate(BaseModel):
     name: str
@@ -142,6 +500,16 @@ class PlaylistUpdate(BaseModel):
     name: Optional[str] = None
     description: Optional[str] = None
 
+    @validator('name')
+    def validate_name(cls, v):
+        if v is not None:
+            if len(v.strip()) < 1:
+                raise ValueError('Playlist name cannot be empty')
+            if len(v) > 100:
+                raise ValueError('Playlist name is too long')
+            return v.strip()
+        return v
+
 class ChatMessage(BaseModel):
     message: str
 
@@ -153,26 +521,220 @@ class ChatMessage(BaseModel):
             raise ValueError('Message is too long')
         return v.strip()
 
-class User(BaseModel):
-    id: str
-    username: str
-    email: str
+class RoleUpdate(BaseModel):
     role: str
+
+    @validator('role')
+    def validate_role(cls, v):
+        if v not in ("user", "premium", "admin"):
+            raise ValueError('Role must be one of: user, premium, admin')
+        return v
+
+class AvatarUpdate(BaseModel):
     avatar: Optional[str] = None
+
+    @validator('avatar')
+    def validate_avatar(cls, v):
+        if v is not None and len(v) > 500:
+            raise ValueError('Avatar URL is too long')
+        return v
+
+class SongInfo(BaseModel):
+    id: str
+    title: str
+    artist: Optional[str] = None
+    thumbnail: Optional[str] = None
+    duration: Optional[str] = None
+
+    @validator('id')
+    def validate_id(cls, v):
+        if not v.strip() or len(v) > 64:
+            raise ValueError('Invalid song id')
+        return v.strip()
+
+    @validator('title')
+    def validate_title(cls, v):
+        if len(v) > 300:
+            raise ValueError('Song title is too long')
+        return v
+
+class PlayEvent(BaseModel):
+    song: SongInfo
+    played_at: Optional[datetime] = None
+    idempotency_key: Optional[str] = None
+
+    @validator('idempotency_key')
+    def validate_idempotency_key(cls, v):
+        if v is not None and (not v.strip() or len(v) > 100):
+            raise ValueError('Invalid idempotency key')
+        return v
+
+class TrackAnchor(BaseModel):
+    # Place relative to another track: after it, before it, or at the end
+    after: Optional[str] = None
+    before: Optional[str] = None
+
+    @validator('before')
+    def validate_anchor(cls, v, values):
+        if v is not None and values.get('after') is not None:
+            raise ValueError("Use either 'after' or 'before', not both")
+        return v
+
+class PlaylistTracksAdd(TrackAnchor):
+    songs: List[SongInfo]
+
+    @validator('songs')
+    def validate_songs(cls, v):
+        if len(v) < 1:
+            raise ValueError('At least one song is required')
+        if len(v) > 500:
+            raise ValueError('At most 500 songs per request')
+        return v
+
+class PlaylistTracksRemove(BaseModel):
+    track_ids: List[str]
+
+    @validator('track_ids')
+    def validate_track_ids(cls, v):
+        if len(v) < 1:
+            raise ValueError('At least one track id is required')
+        if len(v) > 500:
+            raise ValueError('At most 500 tracks per request')
+        return v
+
+class PlayEventBatch(BaseModel):
+    events: List[PlayEvent]
+
+    @validator('events')
+    def validate_events(cls, v):
+        if len(v) < 1:
+            raise ValueError('At least one event is required')
+        if len(v) > 500:
+            raise ValueError('At most 500 events per batch')
+        return v
+
+# Response models. Handlers build these payloads themselves and return them
+# as FastJSONResponse, so the models document the API without re-validating
+class SongResult(BaseModel):
+    id: str
+    title: Optional[str] = None
+    artist: Optional[str] = None
+    thumbnail: Optional[str] = None
+    duration: Optional[str] = None
+    published_at: Optional[str] = None
+
+class SearchResponse(BaseModel):
+    songs: List[SongResult]
+    query: str
+    total: int
+    source: str
+    next_cursor: Optional[str] = None
+    degraded: bool = False
+
+class Suggestion(BaseModel):
+    text: str
+    artist: str
+    song_id: str
+
+class SearchSuggestions(BaseModel):
+    query: str
+    suggestions: List[Suggestion]
+
+class LikedSong(BaseModel):
+    id: str
+    song: SongResult
+    liked_at: datetime
+
+class LikedSongsPage(BaseModel):
+    songs: List[LikedSong]
+    total: int
+    has_more: bool
+    before: Optional[str] = None
+
+class HistoryEntry(BaseModel):
+    id: str
+    song: SongResult
+    played_at: datetime
+
+class HistoryPage(BaseModel):
+    history: List[HistoryEntry]
+    total: int
+    has_more: bool
+    before: Optional[str] = None
+
+class PlaylistOut(BaseModel):
+    id: str
+    owner_id: str
+    name: str
+    description: str
+    track_count: int
+    version: int
     created_at: datetime
-    premium_until: Optional[datetime] = None
+    updated_at: datetime
+
+class PlaylistTrack(BaseModel):
+    id: str
+    song: SongResult
+    position: str
+    added_at: datetime
+
+class PlaylistTracksPage(BaseModel):
+    tracks: List[PlaylistTrack]
+    total: int
+    has_more: bool
+    after: Optional[str] = None
+    version: int
+
+class ChatMessageOut(BaseModel):
+    id: str
+    user_id: str
+    username: str
+    avatar: Optional[str] = None
+    room: str
+    message: str
+    timestamp: datetime
+    seq: Optional[int] = None
+
+class ChatMessagesPage(BaseModel):
+    messages: List[ChatMessageOut]
+    total: int
+    has_more: bool
+    before: Optional[str] = None
+    after: Optional[str] = None
+    source: str
 
 # Utility functions with enhanced error handling
-def verify_password(plain_password, hashed_password):
+background_tasks = set()
+
+def spawn(coro):
+    # Keep a reference so fire-and-forget tasks are not garbage collected
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+def password_pool_busy_exception():
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Server is busy, please try again shortly",
+        headers={"Retry-After": "1"}
+    )
+
+async def verify_password(plain_password, hashed_password):
+    # Returns (valid, new_hash); new_hash is set when the stored hash needs a rehash
     try:
-        return pwd_context.verify(plain_password, hashed_password)
+        return await password_hasher.verify_and_update(plain_password, hashed_password)
+    except PasswordPoolSaturated:
+        raise password_pool_busy_exception()
     except Exception as e:
         logger.error(f"Password verification error: {e}")
-        return False
+        return False, None
 
-def get_password_hash(password):
+async def get_password_hash(password):
     try:
-        return pwd_context.hash(password)
+        return await password_hasher.hash(password)
+    except PasswordPoolSaturated:
+        raise password_pool_busy_exception()
     except Exception as e:
         logger.error(f"Password hashing error: {e}")
         raise HTTPException(
@@ -203,8 +765,12 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+    token = credentials.credentials
+    cached_user = session_cache.get(token)
+    if cached_user is not None:
+        return cached_user
+
     try:
-        token = credentials.credentials
         payload = jwt.decode(token, JWT_SECRET_KEY, algorithms=[JWT_ALGORITHM])
         user_id: str = payload.get("sub")
         if user_id is None:
@@ -217,14 +783,47 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
         raise credentials_exception
     
     try:
-        user = await db.users.find_one({"_id": user_id})
+        user = await db.users.find_one({"_id": user_id}, USER_PROJECTION)
         if user is None:
             raise credentials_exception
+        session_cache.set(token, user, payload.get("exp"))
         return user
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Database user lookup error: {e}")
         raise credentials_exception
 
+async def update_user_fields(user_id: str, fields: dict) -> Optional[dict]:
+    # Any change to fields held in cached sessions must go through here
+    result = await db.users.find_one_and_update(
+        {"_id": user_id},
+        {"$set": fields},
+        projection=USER_PROJECTION,
+        return_document=ReturnDocument.AFTER
+    )
+    invalidate_user_caches(user_id)
+    try:
+        # Other workers drop their copies when this arrives; if it is lost
+        # they still expire within SESSION_CACHE_MAX_TTL_SECONDS
+        await control_bus.publish(dumps_text({"type": "invalidate_user", "user_id": user_id}))
+    except Exception as e:
+        logger.error(f"Publishing session invalidation for {user_id} failed: {e}")
+    return result
+
+def invalidate_user_caches(user_id: str):
+    session_cache.invalidate_user(user_id)
+    profile_cache.invalidate(user_id)
+
+async def handle_control_message(message: str, room: str):
+    try:
+        data = loads(message)
+    except ValueError as e:
+        logger.error(f"Unreadable control message: {e}")
+        return
+    if data.get("type") == "invalidate_user" and data.get("user_id"):
+        invalidate_user_caches(data["user_id"])
+
 async def get_admin_user(current_user: dict = Depends(get_current_user)):
     if current_user.get("role") != "admin":
         raise HTTPException(
@@ -233,12 +832,63 @@ async def get_admin_user(current_user: dict = Depends(get_current_user)):
         )
     return current_user
 
+def client_ip(request: Request) -> str:
+    if RATE_LIMIT_TRUST_FORWARDED:
+        forwarded = request.headers.get("x-forwarded-for")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
+
+def rate_limited_exception(retry_after: float):
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail="Too many requests, please slow down",
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+    )
+
+async def search_rate_limit(request: Request, current_user: dict = Depends(get_current_user)):
+    if not RATE_LIMIT_ENABLED:
+        return
+    try:
+        await search_user_limiter.hit(current_user["_id"])
+        await search_ip_limiter.hit(client_ip(request))
+    except RateLimitExceeded as e:
+        raise rate_limited_exception(e.retry_after)
+
+async def auth_rate_limit(request: Request):
+    # Every login/register attempt costs a bcrypt round, so cap them per IP
+    if not RATE_LIMIT_ENABLED:
+        return
+    try:
+        await auth_ip_limiter.hit(client_ip(request))
+    except RateLimitExceeded as e:
+        raise rate_limited_exception(e.retry_after)
+
+def quota_exhausted_exception():
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Daily music search quota reached; only previously seen results are available",
+        headers={"Retry-After": str(quota_budget.seconds_until_reset())}
+    )
+
+async def deliver_chat_frame(message: str, room: str):
+    # Every worker sees every frame here, so every worker's buffer is complete
+    try:
+        data = loads(message)
+        if data.get("seq") is not None:
+            chat_buffer.add(data, message)
+    except (ValueError, KeyError) as e:
+        logger.error(f"Unbufferable chat frame: {e}")
+    started = asyncio.get_running_loop().time()
+    await manager.broadcast(message, room)
+    chat_fanout_seconds.observe(asyncio.get_running_loop().time() - started)
+
 # API Routes with enhanced error handling
 @app.get("/")
 async def root():
     return {"message": "Foxenfy API is running!", "version": "2.0.0", "status": "active"}
 
-@app.post("/api/auth/register", response_model=Token)
+@app.post("/api/auth/register", response_model=Token, dependencies=[Depends(auth_rate_limit)])
 async def register(user: UserCreate):
     try:
         # Check if user exists
@@ -258,7 +908,7 @@ async def register(user: UserCreate):
         
         # Create user
         user_id = str(uuid.uuid4())
-        hashed_password = get_password_hash(user.password)
+        hashed_password = await get_password_hash(user.password)
         
         user_doc = {
             "_id": user_id,
@@ -268,10 +918,7 @@ async def register(user: UserCreate):
             "role": "user",
             "avatar": None,
             "created_at": datetime.utcnow(),
-            "premium_until": None,
-            "liked_songs": [],
-            "listening_history": [],
-            "playlists": []
+            "premium_until": None
         }
         
         await db.users.insert_one(user_doc)
@@ -293,14 +940,20 @@ async def register(user: UserCreate):
             "premium_until": None
         }
         
-        return {
+        return FastJSONResponse({
             "access_token": access_token,
             "token_type": "bearer",
             "user": user_response
-        }
+        })
         
     except HTTPException:
         raise
+    except DuplicateKeyError:
+        # Lost a race with a concurrent registration; the unique index caught it
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Email or username already registered"
+        )
     except Exception as e:
         logger.error(f"Registration error: {e}")
         raise HTTPException(
@@ -308,17 +961,24 @@ async def register(user: UserCreate):
             detail="Registration failed due to server error"
         )
 
-@app.post("/api/auth/login", response_model=Token)
+@app.post("/api/auth/login", response_model=Token, dependencies=[Depends(auth_rate_limit)])
 async def login(user: UserLogin):
     try:
         db_user = await db.users.find_one({"email": user.email})
-        if not db_user or not verify_password(user.password, db_user["password"]):
+        verified, new_hash = (False, None)
+        if db_user:
+            verified, new_hash = await verify_password(user.password, db_user["password"])
+        if not verified:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Incorrect email or password",
                 headers={"WWW-Authenticate": "Bearer"},
             )
         
+        if new_hash:
+            # Stored hash uses an older bcrypt cost; upgrade it transparently
+            await db.users.update_one({"_id": db_user["_id"]}, {"$set": {"password": new_hash}})
+        
         access_token_expires = timedelta(minutes=JWT_ACCESS_TOKEN_EXPIRE_MINUTES)
         access_token = create_access_token(
             data={"sub": db_user["_id"]}, expires_delta=access_token_expires
@@ -336,11 +996,11 @@ async def login(user: UserLogin):
             "premium_until": db_user.get("premium_until")
         }
         
-        return {
+        return FastJSONResponse({
             "access_token": access_token,
             "token_type": "bearer",
             "user": user_response
-        }
+        })
         
     except HTTPException:
         raise
@@ -351,10 +1011,10 @@ async def login(user: UserLogin):
             detail="Login failed due to server error"
         )
 
-@app.get("/api/auth/me")
+@app.get("/api/auth/me", response_model=User)
 async def get_me(current_user: dict = Depends(get_current_user)):
     try:
-        return {
+        return FastJSONResponse({
             "id": current_user["_id"],
             "username": current_user["username"],
             "email": current_user["email"],
@@ -362,7 +1022,7 @@ async def get_me(current_user: dict = Depends(get_current_user)):
             "avatar": current_user.get("avatar"),
             "created_at": current_user["created_at"],
             "premium_until": current_user.get("premium_until")
-        }
+        })
     except Exception as e:
         logger.error(f"Get user info error: {e}")
         raise HTTPException(
@@ -370,8 +1030,154 @@ async def get_me(current_user: dict = Depends(get_current_user)):
             detail="Failed to get user information"
         )
 
-@app.get("/api/search")
-async def search_songs(q: str, max_results: int = 20, current_user: dict = Depends(get_current_user)):
+async def fetch_youtube_page(q: str, max_results: int, cursor: Optional[str] = None) -> Dict[str, Any]:
+    params = {
+        "part": "snippet",
+        "q": f"{q} music",
+        "type": "video",
+        "maxResults": max_results,
+        "key": YOUTUBE_API_KEY,
+        "videoCategoryId": "10"  # Music category
+    }
+    if cursor:
+        params["pageToken"] = cursor
+    try:
+        response = await youtube_client.get("/search", params=params)
+    except CircuitOpenError:
+        raise HTTPException(status_code=503, detail="Music search service temporarily unavailable")
+    except UpstreamError as e:
+        logger.error(f"YouTube API request failed: {e}")
+        raise HTTPException(status_code=503, detail="Music search service temporarily unavailable")
+    
+    if response.status_code == 400 and cursor:
+        raise HTTPException(status_code=400, detail="Invalid or expired search cursor")
+    if response.status_code != 200:
+        logger.error(f"YouTube API error: {response.status_code} - {response.text}")
+        raise HTTPException(status_code=500, detail="Music search service temporarily unavailable")
+        
+    data = response.json()
+    
+    songs = []
+    for item in data.get("items", []):
+        song = {
+            "id": item["id"]["videoId"],
+            "title": item["snippet"]["title"],
+            "artist": item["snippet"]["channelTitle"],
+            "thumbnail": item["snippet"]["thumbnails"]["medium"]["url"],
+            "duration": "Unknown",  # Filled in from the catalog once enriched
+            "published_at": item["snippet"]["publishedAt"]
+        }
+        songs.append(song)
+    
+    if not cursor:
+        local_search.mark_query(q)
+    spawn(remember_songs(songs))
+    # YouTube's pageToken is handed to clients as an opaque cursor
+    return {"songs": songs, "next_cursor": data.get("nextPageToken")}
+
+async def load_local_search_index():
+    try:
+        await local_search.load(catalog.collection)
+    except Exception as e:
+        logger.error(f"Local search index load failed: {e}")
+
+def search_locally(q: str, max_results: int, quota_mode: str = QUOTA_NORMAL) -> Optional[List[dict]]:
+    # Local results are good enough once this exact query has been answered
+    # upstream before and the index still returns enough of them. While the
+    # quota budget is tight any local match is preferred over spending it.
+    if not LOCAL_SEARCH_ENABLED:
+        return None
+    if quota_mode != QUOTA_NORMAL:
+        return local_search.search(q, max_results) or None
+    if not local_search.knows_query(q):
+        return None
+    songs = local_search.search(q, max_results)
+    if len(songs) < max(1, int(max_results * LOCAL_SEARCH_MIN_RECALL)):
+        return None
+    return songs
+
+async def remember_songs(songs: List[dict]):
+    try:
+        await catalog.upsert_many(songs)
+    except Exception as e:
+        logger.error(f"Catalog upsert error: {e}")
+
+async def fetch_video_durations(video_ids: List[str]) -> Dict[str, str]:
+    if await quota_budget.mode() == QUOTA_EXHAUSTED:
+        raise UpstreamError("Daily quota exhausted, deferring duration lookups")
+    response = await youtube_client.get(
+        "/videos",
+        params={"part": "contentDetails", "id": ",".join(video_ids), "key": YOUTUBE_API_KEY}
+    )
+    if response.status_code != 200:
+        raise UpstreamError(f"videos.list returned {response.status_code}")
+    return {
+        item["id"]: item.get("contentDetails", {}).get("duration", "")
+        for item in response.json().get("items", [])
+    }
+
+if os.getenv("CATALOG_ENRICH_DURATIONS", "true").lower() == "true":
+    catalog.fetch_videos = fetch_video_durations
+    catalog.pause_when = lambda: quota_budget.current_mode() == QUOTA_EXHAUSTED
+
+async def with_catalog_durations(songs: List[dict]) -> List[dict]:
+    missing = [song["id"] for song in songs if song.get("duration") == "Unknown"]
+    if not missing:
+        return songs
+    try:
+        durations = await catalog.durations(missing)
+    except Exception as e:
+        logger.error(f"Catalog duration lookup error: {e}")
+        return songs
+    # Copy rather than mutate: the list may be shared with the search cache
+    return [
+        {**song, "duration": durations[song["id"]]} if song["id"] in durations else song
+        for song in songs
+    ]
+
+@app.put("/api/auth/me/avatar")
+async def update_my_avatar(update: AvatarUpdate, current_user: dict = Depends(get_current_user)):
+    try:
+        user = await update_user_fields(current_user["_id"], {"avatar": update.avatar})
+        return {"id": current_user["_id"], "avatar": user.get("avatar") if user else update.avatar}
+    except Exception as e:
+        logger.error(f"Avatar update error: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to update avatar"
+        )
+
+@app.put("/api/admin/users/{user_id}/role")
+async def update_user_role(user_id: str, update: RoleUpdate, admin_user: dict = Depends(get_admin_user)):
+    try:
+        user = await update_user_fields(user_id, {"role": update.role})
+    except Exception as e:
+        logger.error(f"Role update error: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to update user role"
+        )
+    if user is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+    logger.info(f"Role of user {user_id} changed to {update.role} by {admin_user['username']}")
+    return {"id": user_id, "role": user["role"]}
+
+def fetch_search_page(q: str, max_results: int, cursor: Optional[str] = None):
+    return search_cache.get_or_fetch(
+        q, max_results, lambda: fetch_youtube_page(q, max_results, cursor), cursor=cursor
+    )
+
+async def cached_search_page(q: str, max_results: int, cursor: Optional[str], quota_mode: str):
+    # Normally a local miss falls through to fetch_search_page, which checks
+    # the shared tier itself. When quota is short that fetch may be refused,
+    # so the shared tier has to be consulted before giving up.
+    if quota_mode == QUOTA_NORMAL:
+        return search_cache.peek(q, max_results, cursor)
+    return await search_cache.get_cached(q, max_results, cursor)
+
+@app.get("/api/search", response_model=SearchResponse, dependencies=[Depends(search_rate_limit)])
+async def search_songs(q: str, max_results: int = 20, cursor: Optional[str] = None,
+                       current_user: dict = Depends(get_current_user)):
     if not q.strip():
         raise HTTPException(status_code=400, detail="Search query cannot be empty")
     
@@ -379,39 +1185,35 @@ async def search_songs(q: str, max_results: int = 20, current_user: dict = Depen
         max_results = 50
     
     try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.get(
-                "https://www.googleapis.com/youtube/v3/search",
-                params={
-                    "part": "snippet",
-                    "q": f"{q} music",
-                    "type": "video",
-                    "maxResults": max_results,
-                    "key": YOUTUBE_API_KEY,
-                    "videoCategoryId": "10"  # Music category
-                }
-            )
-            
-            if response.status_code != 200:
-                logger.error(f"YouTube API error: {response.status_code} - {response.text}")
-                raise HTTPException(status_code=500, detail="Music search service temporarily unavailable")
-                
-            data = response.json()
-            
-            songs = []
-            for item in data.get("items", []):
-                song = {
-                    "id": item["id"]["videoId"],
-                    "title": item["snippet"]["title"],
-                    "artist": item["snippet"]["channelTitle"],
-                    "thumbnail": item["snippet"]["thumbnails"]["medium"]["url"],
-                    "duration": "Unknown",  # Would need additional API call for duration
-                    "published_at": item["snippet"]["publishedAt"]
-                }
-                songs.append(song)
-            
-            logger.info(f"Search performed by {current_user['username']}: '{q}' - {len(songs)} results")
-            return {"songs": songs, "query": q, "total": len(songs)}
+        source = "cache"
+        next_cursor = None
+        quota_mode = await quota_budget.mode()
+        if not cursor:
+            prefetcher.record(q, max_results)
+        page = await cached_search_page(q, max_results, cursor, quota_mode)
+        songs = page["songs"] if page is not None else None
+        if songs is None and not cursor:
+            songs = search_locally(q, max_results, quota_mode)
+            source = "local"
+        if songs is None:
+            if quota_mode == QUOTA_EXHAUSTED:
+                raise quota_exhausted_exception()
+            page = await fetch_search_page(q, max_results, cursor)
+            songs = page["songs"]
+            source = "upstream"
+        if page is not None:
+            next_cursor = page["next_cursor"]
+        songs = await with_catalog_durations(songs)
+        
+        logger.info(
+            "Search performed by %s: '%s' - %d results (%s)", current_user["username"], q, len(songs), source,
+            extra={"sample": "search", "user_id": current_user["_id"], "query": q,
+                   "results": len(songs), "source": source}
+        )
+        return FastJSONResponse({
+            "songs": songs, "query": q, "total": len(songs), "source": source,
+            "next_cursor": next_cursor, "degraded": quota_mode != QUOTA_NORMAL
+        })
             
     except HTTPException:
         raise
@@ -419,43 +1221,624 @@ async def search_songs(q: str, max_results: int = 20, current_user: dict = Depen
         logger.error(f"Search error: {e}")
         raise HTTPException(status_code=500, detail="Search failed due to server error")
 
+SEARCH_STREAM_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "sse": "text/event-stream"}
+
+def encode_search_event(event: str, payload: Dict[str, Any], stream_format: str) -> str:
+    if stream_format == "sse":
+        return f"event: {event}\ndata: {dumps_text(payload)}\n\n"
+    return dumps_text({"type": event, **payload}) + "\n"
+
+@app.get("/api/search/stream", dependencies=[Depends(search_rate_limit)])
+async def search_songs_stream(q: str, max_results: int = 20, cursor: Optional[str] = None,
+                              stream_format: str = Query("ndjson", alias="format"),
+                              current_user: dict = Depends(get_current_user)):
+    # Streams "results" events as each source answers (cache/local first,
+    # upstream after), then one "done" event carrying the next page cursor
+    if not q.strip():
+        raise HTTPException(status_code=400, detail="Search query cannot be empty")
+    if stream_format not in SEARCH_STREAM_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail="format must be 'ndjson' or 'sse'")
+    max_results = max(1, min(max_results, 50))
+
+    async def events():
+        sent = set()
+
+        async def results(songs: List[dict], source: str) -> str:
+            fresh = [song for song in songs if song["id"] not in sent]
+            sent.update(song["id"] for song in fresh)
+            fresh = await with_catalog_durations(fresh)
+            return encode_search_event("results", {"source": source, "songs": fresh}, stream_format)
+
+        quota_mode = await quota_budget.mode()
+        if not cursor:
+            prefetcher.record(q, max_results)
+        page = await cached_search_page(q, max_results, cursor, quota_mode)
+        if page is None and not cursor and LOCAL_SEARCH_ENABLED:
+            local_songs = local_search.search(q, max_results)
+            if local_songs:
+                yield await results(local_songs, "local")
+        if page is None and quota_mode != QUOTA_NORMAL and (sent or quota_mode == QUOTA_EXHAUSTED):
+            # Save the remaining quota for searches nothing local can answer
+            if not sent:
+                e = quota_exhausted_exception()
+                yield encode_search_event("error", {"status": e.status_code, "detail": e.detail}, stream_format)
+            yield encode_search_event("done", {"total": len(sent), "next_cursor": None, "degraded": True}, stream_format)
+            return
+        if page is not None:
+            source = "cache"
+        else:
+            source = "upstream"
+            try:
+                page = await fetch_search_page(q, max_results, cursor)
+            except HTTPException as e:
+                yield encode_search_event("error", {"status": e.status_code, "detail": e.detail}, stream_format)
+                yield encode_search_event("done", {"total": len(sent), "next_cursor": None}, stream_format)
+                return
+            except Exception as e:
+                logger.error(f"Streaming search error: {e}")
+                yield encode_search_event("error", {"status": 500, "detail": "Search failed due to server error"}, stream_format)
+                yield encode_search_event("done", {"total": len(sent), "next_cursor": None}, stream_format)
+                return
+        yield await results(page["songs"], source)
+        logger.info(
+            "Streaming search by %s: '%s' - %d results (%s)", current_user["username"], q, len(sent), source,
+            extra={"sample": "search", "user_id": current_user["_id"], "query": q,
+                   "results": len(sent), "source": source}
+        )
+        yield encode_search_event("done", {"total": len(sent), "next_cursor": page["next_cursor"]}, stream_format)
+
+    return StreamingResponse(
+        events(),
+        media_type=SEARCH_STREAM_MEDIA_TYPES[stream_format],
+        # Disable proxy buffering so the first event reaches the client immediately
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.get("/api/search/suggest", response_model=SearchSuggestions)
+async def search_suggest(q: str, limit: int = 10, current_user: dict = Depends(get_current_user)):
+    # Typeahead is served from the local index only and never calls upstream
+    limit = max(1, min(limit, 20))
+    suggestions = local_search.suggest(q, limit) if q.strip() else []
+    return FastJSONResponse({"query": q, "suggestions": suggestions})
+
+@app.get("/api/search/local/stats")
+async def local_search_stats(admin_user: dict = Depends(get_admin_user)):
+    return local_search.stats()
+
+@app.get("/api/admin/rate-limits")
+async def rate_limit_stats(admin_user: dict = Depends(get_admin_user)):
+    return {
+        "enabled": RATE_LIMIT_ENABLED,
+        "limiters": {
+            limiter.name: limiter.stats()
+            for limiter in (search_user_limiter, search_ip_limiter, auth_ip_limiter)
+        },
+        "quota": quota_budget.stats(),
+    }
+
+@app.get("/api/admin/prefetch")
+async def prefetch_stats(admin_user: dict = Depends(get_admin_user)):
+    return {"enabled": SEARCH_PREFETCH_ENABLED, **prefetcher.stats()}
+
+@app.get("/api/admin/diagnostics")
+async def diagnostics(admin_user: dict = Depends(get_admin_user)):
+    return {"enabled": DIAGNOSTICS_ENABLED, **loop_watchdog.stats(), "profiles_run": profiler.runs}
+
+@app.post("/api/admin/diagnostics/profile")
+async def run_profiler(seconds: float = 10, hz: int = 100, threads: str = "loop",
+                       admin_user: dict = Depends(get_admin_user)):
+    # Returns collapsed stacks for flamegraph.pl / speedscope
+    if threads not in ("loop", "all"):
+        raise HTTPException(status_code=400, detail="threads must be 'loop' or 'all'")
+    thread_ids = [threading.get_ident()] if threads == "loop" else None
+    logger.info(f"Profiler started by {admin_user['username']} for {seconds}s at {hz} Hz ({threads})")
+    try:
+        folded = await profiler.profile(seconds, hz, thread_ids)
+    except ProfilerBusy as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    return Response(content=folded, media_type="text/plain")
+
+@app.get("/api/admin/logging")
+async def logging_stats(admin_user: dict = Depends(get_admin_user)):
+    return log_pipeline.stats()
+
+@app.get("/api/search/cache/stats")
+async def search_cache_stats(admin_user: dict = Depends(get_admin_user)):
+    return search_cache.stats()
+
+@app.get("/api/auth/password-pool/stats")
+async def password_pool_stats(admin_user: dict = Depends(get_admin_user)):
+    return password_hasher.stats()
+
+@app.get("/api/chat/writer/stats")
+async def chat_writer_stats(admin_user: dict = Depends(get_admin_user)):
+    return chat_writer.stats()
+
+@app.get("/api/chat/connections/stats")
+async def chat_connection_stats(admin_user: dict = Depends(get_admin_user)):
+    return {
+        "connections": manager.stats(),
+        "pubsub": chat_bus.stats(),
+        "sequence": chat_sequencer.stats(),
+        "buffer": chat_buffer.stats()
+    }
+
+@app.get("/api/admin/indexes")
+async def index_report(admin_user: dict = Depends(get_admin_user)):
+    return {"check_mode": index_manager.check_mode, **index_manager.report}
+
+@app.get("/api/songs/history/ingest/stats")
+async def history_ingest_stats(admin_user: dict = Depends(get_admin_user)):
+    return history_ingestor.stats()
+
+@app.get("/api/catalog/stats")
+async def catalog_stats(admin_user: dict = Depends(get_admin_user)):
+    return catalog.stats()
+
+@app.get("/api/upstream/stats")
+async def upstream_stats(admin_user: dict = Depends(get_admin_user)):
+    return {"youtube": youtube_client.stats()}
+
+# Liked songs and listening history
+def library_limit(limit: int) -> int:
+    return max(1, min(limit, 100))
+
+async def hydrate_songs(docs: List[dict]) -> Dict[str, dict]:
+    return await catalog.hydrate(doc["song_id"] for doc in docs)
+
+def serialize_library_entry(doc: dict, time_field: str, songs: Dict[str, dict]) -> dict:
+    # Entries written before the catalog existed carry their own snapshot
+    song = songs.get(doc["song_id"]) or doc.get("song") or {"id": doc["song_id"]}
+    return {
+        "id": doc["_id"] if time_field == "played_at" else doc["song_id"],
+        "song": song,
+        time_field: doc[time_field]
+    }
+
+@app.post("/api/songs/{song_id}/like")
+async def like_song(song_id: str, song: Optional[SongInfo] = None, current_user: dict = Depends(get_current_user)):
+    try:
+        if song:
+            await catalog.upsert_many([{**song.dict(), "id": song_id}], authoritative=False)
+        created = await library.like(current_user["_id"], song_id)
+        return {"song_id": song_id, "liked": True, "created": created}
+    except Exception as e:
+        logger.error(f"Like song error: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to like song"
+        )
+
+@app.delete("/api/songs/{song_id}/like")
+async def unlike_song(song_id: str, current_user: dict = Depends(get_current_user)):
+    try:
+        removed = await library.unlike(current_user["_id"], song_id)
+        return {"song_id": song_id, "liked": False, "removed": removed}
+    except Exception as e:
+        logger.error(f"Unlike song error: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to unlike song"
+        )
+
+@app.get("/api/songs/liked", response_model=LikedSongsPage)
+async def get_liked_songs(limit: int = 50, before: Optional[str] = None, current_user: dict = Depends(get_current_user)):
+    try:
+        docs, has_more = await library.liked_page(current_user["_id"], library_limit(limit), before)
+        songs_by_id = await hydrate_songs(docs)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Cursor song not found")
+    except Exception as e:
+        logger.error(f"Get liked songs error: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to retrieve liked songs"
+        )
+    songs = [serialize_library_entry(doc, "liked_at", songs_by_id) for doc in docs]
+    return FastJSONResponse({
+        "songs": songs,
+        "total": len(songs),
+        "has_more": has_more,
+        "before": songs[-1]["id"] if songs else None
+    })
+
+def play_event_doc(event: PlayEvent) -> dict:
+    played_at = event.played_at
+    if played_at is not None:
+        # Clients send aware timestamps; store naive UTC like everything else
+        if played_at.tzinfo is not None:
+            played_at = played_at.astimezone(timezone.utc).replace(tzinfo=None)
+        played_at = min(played_at, datetime.utcnow())
+    return {
+        "song_id": event.song.id,
+        "played_at": played_at,
+        "idempotency_key": event.idempotency_key
+    }
+
+@app.post("/api/songs/history")
+async def add_to_history(
+    song: SongInfo,
+    idempotency_key: Optional[str] = Header(None),
+    current_user: dict = Depends(get_current_user)
+):
+    try:
+        event = PlayEvent(song=song, idempotency_key=idempotency_key)
+    except ValidationError:
+        raise HTTPException(status_code=400, detail="Invalid Idempotency-Key header")
+    try:
+        await catalog.upsert_many([song.dict()], authoritative=False)
+        ids = await history_ingestor.submit(current_user["_id"], [play_event_doc(event)])
+        return {"id": ids[0], "recorded": True}
+    except Exception as e:
+        logger.error(f"Add to history error: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to record play"
+        )
+
+@app.post("/api/songs/history/batch")
+async def add_history_batch(batch: PlayEventBatch, current_user: dict = Depends(get_current_user)):
+    try:
+        await catalog.upsert_many((event.song.dict() for event in batch.events), authoritative=False)
+        ids = await history_ingestor.submit(
+            current_user["_id"], [play_event_doc(event) for event in batch.events]
+        )
+        return {"ids": ids, "accepted": len(ids)}
+    except Exception as e:
+        logger.error(f"Add history batch error: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to record plays"
+        )
+
+@app.get("/api/songs/top")
+async def get_top_played(limit: int = 20, current_user: dict = Depends(get_current_user)):
+    try:
+        docs = await history_ingestor.top_for_user(current_user["_id"], library_limit(limit))
+        songs_by_id = await hydrate_songs(docs)
+    except Exception as e:
+        logger.error(f"Get top played error: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to retrieve top played songs"
+        )
+    songs = [
+        {
+            "song": songs_by_id.get(doc["song_id"]) or doc.get("song") or {"id": doc["song_id"]},
+            "plays": doc["count"],
+            "last_played_at": doc["last_played_at"]
+        }
+        for doc in docs
+    ]
+    return FastJSONResponse({"songs": songs, "total": len(songs)})
+
+@app.get("/api/songs/trending")
+async def get_trending_songs(limit: int = 20, current_user: dict = Depends(get_current_user)):
+    try:
+        docs = await history_ingestor.top_songs(library_limit(limit))
+        songs_by_id = await catalog.hydrate(doc["_id"] for doc in docs)
+    except Exception as e:
+        logger.error(f"Get trending songs error: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to retrieve trending songs"
+        )
+    songs = [
+        {
+            "song": songs_by_id.get(doc["_id"]) or {"id": doc["_id"]},
+            "plays": doc["count"],
+            "last_played_at": doc["last_played_at"]
+        }
+        for doc in docs
+    ]
+    return FastJSONResponse({"songs": songs, "total": len(songs)})
+
+@app.get("/api/songs/history", response_model=HistoryPage)
+async def get_history(limit: int = 50, before: Optional[str] = None, current_user: dict = Depends(get_current_user)):
+    try:
+        docs, has_more = await library.history_page(current_user["_id"], library_limit(limit), before)
+        songs_by_id = await hydrate_songs(docs)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Cursor entry not found")
+    except Exception as e:
+        logger.error(f"Get history error: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to retrieve listening history"
+        )
+    history = [serialize_library_entry(doc, "played_at", songs_by_id) for doc in docs]
+    return FastJSONResponse({
+        "history": history,
+        "total": len(history),
+        "has_more": has_more,
+        "before": history[-1]["id"] if history else None
+    })
+
+# Playlists
+def serialize_playlist(doc: dict) -> dict:
+    return {
+        "id": doc["_id"],
+        "owner_id": doc["owner_id"],
+        "name": doc["name"],
+        "description": doc.get("description", ""),
+        "track_count": doc["track_count"],
+        "version": doc["version"],
+        "created_at": doc["created_at"],
+        "updated_at": doc["updated_at"]
+    }
+
+def serialize_track(doc: dict, songs: Dict[str, dict]) -> dict:
+    return {
+        "id": doc["_id"],
+        "song": songs.get(doc["song_id"]) or {"id": doc["song_id"]},
+        "position": doc["position"],
+        "added_at": doc["added_at"]
+    }
+
+def playlist_etag(doc: dict) -> str:
+    # Covers the playlist and its track list; song metadata is not versioned
+    return f'W/"{doc["_id"]}:{doc["version"]}"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # Weak comparison, as RFC 9110 requires for If-None-Match
+    return etag.removeprefix("W/") in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+
+def versioned_response(content: Any, doc: dict) -> FastJSONResponse:
+    return FastJSONResponse(content, headers={"ETag": playlist_etag(doc), "Cache-Control": "private, no-cache"})
+
+async def get_playlist_for(playlist_id: str, user: dict) -> dict:
+    playlist = await playlists.get(playlist_id)
+    if playlist is None:
+        raise HTTPException(status_code=404, detail="Playlist not found")
+    if playlist["owner_id"] != user["_id"] and user.get("role") != "admin":
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not your playlist")
+    return playlist
+
+@app.post("/api/playlists", response_model=PlaylistOut)
+async def create_playlist(playlist: PlaylistCreate, current_user: dict = Depends(get_current_user)):
+    try:
+        doc = await playlists.create(current_user["_id"], playlist.name, playlist.description)
+    except Exception as e:
+        logger.error(f"Create playlist error: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to create playlist"
+        )
+    return versioned_response(serialize_playlist(doc), doc)
+
+@app.get("/api/playlists")
+async def list_playlists(current_user: dict = Depends(get_current_user)):
+    try:
+        docs = await playlists.list_for_owner(current_user["_id"])
+    except Exception as e:
+        logger.error(f"List playlists error: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to retrieve playlists"
+        )
+    return FastJSONResponse({"playlists": [serialize_playlist(doc) for doc in docs], "total": len(docs)})
+
+@app.get("/api/playlists/{playlist_id}", response_model=PlaylistOut)
+async def get_playlist(playlist_id: str, if_none_match: Optional[str] = Header(None),
+                       current_user: dict = Depends(get_current_user)):
+    playlist = await get_playlist_for(playlist_id, current_user)
+    if etag_matches(if_none_match, playlist_etag(playlist)):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": playlist_etag(playlist)})
+    return versioned_response(serialize_playlist(playlist), playlist)
+
+@app.put("/api/playlists/{playlist_id}", response_model=PlaylistOut)
+async def update_playlist(playlist_id: str, update: PlaylistUpdate, current_user: dict = Depends(get_current_user)):
+    await get_playlist_for(playlist_id, current_user)
+    fields = {key: value for key, value in update.dict().items() if value is not None}
+    playlist = await playlists.update(playlist_id, fields)
+    if playlist is None:
+        raise HTTPException(status_code=404, detail="Playlist not found")
+    return versioned_response(serialize_playlist(playlist), playlist)
+
+@app.delete("/api/playlists/{playlist_id}")
+async def delete_playlist(playlist_id: str, current_user: dict = Depends(get_current_user)):
+    await get_playlist_for(playlist_id, current_user)
+    deleted = await playlists.delete(playlist_id)
+    return {"id": playlist_id, "deleted": deleted}
+
+@app.get("/api/playlists/{playlist_id}/tracks", response_model=PlaylistTracksPage)
+async def get_playlist_tracks(playlist_id: str, limit: int = 100, after: Optional[str] = None,
+                              if_none_match: Optional[str] = Header(None),
+                              current_user: dict = Depends(get_current_user)):
+    # The version is read before the tracks, so a page is never newer-labelled than its content
+    playlist = await get_playlist_for(playlist_id, current_user)
+    if etag_matches(if_none_match, playlist_etag(playlist)):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": playlist_etag(playlist)})
+    try:
+        docs, has_more = await playlists.tracks_page(playlist_id, max(1, min(limit, 200)), after)
+        songs_by_id = await hydrate_songs(docs)
+    except Exception as e:
+        logger.error(f"Get playlist tracks error: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to retrieve playlist tracks"
+        )
+    tracks = [serialize_track(doc, songs_by_id) for doc in docs]
+    return versioned_response({
+        "tracks": tracks,
+        "total": len(tracks),
+        "has_more": has_more,
+        "after": tracks[-1]["position"] if tracks else None,
+        "version": playlist["version"]
+    }, playlist)
+
+@app.post("/api/playlists/{playlist_id}/tracks")
+async def add_playlist_tracks(playlist_id: str, body: PlaylistTracksAdd, current_user: dict = Depends(get_current_user)):
+    await get_playlist_for(playlist_id, current_user)
+    try:
+        await catalog.upsert_many((song.dict() for song in body.songs), authoritative=False)
+        added, playlist = await playlists.add_tracks(
+            playlist_id, [song.id for song in body.songs], current_user["_id"], body.after, body.before
+        )
+    except PlaylistFull as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Anchor track not found")
+    except Exception as e:
+        logger.error(f"Add playlist tracks error: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to add tracks"
+        )
+    if playlist is None:
+        raise HTTPException(status_code=404, detail="Playlist not found")
+    songs_by_id = {song.id: song.dict() for song in body.songs}
+    return versioned_response({
+        "tracks": [serialize_track(doc, songs_by_id) for doc in added],
+        "added": len(added),
+        "track_count": playlist["track_count"],
+        "version": playlist["version"]
+    }, playlist)
+
+@app.post("/api/playlists/{playlist_id}/tracks/remove")
+async def remove_playlist_tracks(playlist_id: str, body: PlaylistTracksRemove,
+                                 current_user: dict = Depends(get_current_user)):
+    await get_playlist_for(playlist_id, current_user)
+    try:
+        removed, playlist = await playlists.remove_tracks(playlist_id, body.track_ids)
+    except Exception as e:
+        logger.error(f"Remove playlist tracks error: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to remove tracks"
+        )
+    if playlist is None:
+        raise HTTPException(status_code=404, detail="Playlist not found")
+    return versioned_response({
+        "removed": removed,
+        "track_count": playlist["track_count"],
+        "version": playlist["version"]
+    }, playlist)
+
+@app.post("/api/playlists/{playlist_id}/tracks/{track_id}/move")
+async def move_playlist_track(playlist_id: str, track_id: str, anchor: TrackAnchor,
+                              current_user: dict = Depends(get_current_user)):
+    # Rewrites only the moved track's position key
+    await get_playlist_for(playlist_id, current_user)
+    try:
+        track, playlist = await playlists.move_track(playlist_id, track_id, anchor.after, anchor.before)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Track not found")
+    except Exception as e:
+        logger.error(f"Move playlist track error: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to move track"
+        )
+    if playlist is None:
+        raise HTTPException(status_code=404, detail="Playlist not found")
+    return versioned_response({
+        "id": track["_id"],
+        "position": track["position"],
+        "version": playlist["version"]
+    }, playlist)
+
 # WebSocket endpoint for chat with enhanced error handling
+def parse_rooms(rooms: Optional[str]) -> List[str]:
+    names = [name.strip() for name in (rooms or "").split(",") if name.strip()]
+    return [name for name in names if len(name) <= 50 and "\n" not in name][:20] or [DEFAULT_ROOM]
+
+def room_filter(rooms: List[str]) -> Dict[str, Any]:
+    # Messages written before rooms existed have no room field and are global
+    names = list(rooms) + ([None] if DEFAULT_ROOM in rooms else [])
+    return {"$in": names}
+
+async def load_chat_replay(rooms: List[str], last_seq: int) -> Optional[List[str]]:
+    # Frames after last_seq from Mongo, or None if there are too many to replay
+    docs = await db.chat_messages.find(
+        {"seq": {"$gt": last_seq}, "deleted": False, "room": room_filter(rooms)},
+        sort=[("seq", 1)],
+        limit=CHAT_REPLAY_MAX + 1
+    ).to_list(length=CHAT_REPLAY_MAX + 1)
+    if len(docs) > CHAT_REPLAY_MAX:
+        return None
+    profiles = await profile_cache.get_many(doc["user_id"] for doc in docs)
+    return [dumps_text(serialize_chat_message(doc, profiles.get(doc["user_id"]))) for doc in docs]
+
 @app.websocket("/api/chat/ws/{user_id}")
-async def websocket_endpoint(websocket: WebSocket, user_id: str):
-    await manager.connect(websocket, user_id)
+async def websocket_endpoint(websocket: WebSocket, user_id: str, rooms: Optional[str] = None,
+                             last_seq: Optional[int] = None, binary: bool = False):
+    # binary=true: frames arrive as UTF-8 JSON in binary messages, encoded
+    # once per broadcast instead of once per socket
+    room_names = parse_rooms(rooms)
+    replay: Optional[List[str]] = []
+    floor = last_seq
+    if last_seq is not None and not chat_buffer.covers(last_seq):
+        # Deep gap: read what the buffer no longer holds before registering
+        replay = await load_chat_replay(room_names, last_seq)
+        if replay:
+            floor = loads(replay[-1])["seq"]
+
+    connection = await manager.connect(websocket, user_id, room_names, binary)
+    if last_seq is not None:
+        # No await between registering and this snapshot, so every frame is
+        # either in the snapshot or delivered live (clients drop duplicate seqs)
+        if replay is None:
+            connection.enqueue(dumps_text({"type": "replay_truncated", "last_seq": last_seq}))
+        else:
+            replay += [frame for _, frame in chat_buffer.since(floor, connection.rooms)]
+            if len(replay) > CHAT_REPLAY_MAX:
+                connection.enqueue(dumps_text({"type": "replay_truncated", "last_seq": last_seq}))
+            else:
+                for frame in replay:
+                    connection.enqueue(frame)
     try:
+        # Resolve the sender once; every message embeds this profile
+        sender = await profile_cache.get(user_id)
+        if sender is None:
+            logger.error(f"Chat connection for unknown user {user_id}")
+            manager.disconnect(connection)
+            await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+            return
+
         while True:
             data = await websocket.receive_text()
+            connection.touch()
             try:
-                message_data = json.loads(data)
+                message_data = loads(data)
+                
+                # Heartbeat replies only refresh last_seen
+                if message_data.get("type") == "pong":
+                    continue
                 
                 # Validate message
                 if not message_data.get("message", "").strip():
                     continue
                 
-                # Save message to database
+                room = message_data.get("room") or DEFAULT_ROOM
+                if room not in connection.rooms:
+                    continue
+                
                 message_doc = {
                     "_id": str(uuid.uuid4()),
+                    "seq": await chat_sequencer.next(),
                     "user_id": user_id,
+                    "username": sender["username"],
+                    "avatar": sender.get("avatar"),
+                    "room": room,
                     "message": message_data["message"].strip(),
                     "timestamp": datetime.utcnow(),
                     "deleted": False
                 }
-                await db.chat_messages.insert_one(message_doc)
+                frame = dumps_text(serialize_chat_message(message_doc, sender))
                 
-                # Get user info for broadcast
-                user = await db.users.find_one({"_id": user_id})
-                if user:
-                    broadcast_message = {
-                        "id": message_doc["_id"],
-                        "user_id": user_id,
-                        "username": user["username"],
-                        "avatar": user.get("avatar"),
-                        "message": message_data["message"].strip(),
-                        "timestamp": message_doc["timestamp"].isoformat()
-                    }
-                    
-                    await manager.broadcast(json.dumps(broadcast_message))
+                if chat_writer.mode == "sync":
+                    await chat_writer.write(message_doc)
+                    await chat_bus.publish(frame, room)
+                else:
+                    await chat_bus.publish(frame, room)
+                    await chat_writer.write(message_doc)
                     
             except json.JSONDecodeError:
                 logger.error(f"Invalid JSON from user {user_id}")
@@ -465,38 +1848,114 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
                 continue
                 
     except WebSocketDisconnect:
-        manager.disconnect(websocket, user_id)
+        manager.disconnect(connection)
     except Exception as e:
         logger.error(f"WebSocket error for user {user_id}: {e}")
-        manager.disconnect(websocket, user_id)
+        manager.disconnect(connection)
+
+def serialize_chat_message(msg: dict, profile: Optional[dict]) -> dict:
+    # Prefer the live profile; fall back to the copy embedded at write time
+    profile = profile or msg
+    return {
+        "id": msg["_id"],
+        "user_id": msg["user_id"],
+        "username": profile.get("username") or "Unknown User",
+        "avatar": profile.get("avatar"),
+        "room": msg.get("room", DEFAULT_ROOM),
+        "message": msg["message"],
+        "timestamp": msg["timestamp"],
+        "seq": msg.get("seq")
+    }
+
+@app.get("/api/chat/messages", response_model=ChatMessagesPage)
+async def get_chat_messages(
+    limit: int = 50,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    room: str = DEFAULT_ROOM,
+    current_user: dict = Depends(get_current_user)
+):
+    if before and after:
+        raise HTTPException(status_code=400, detail="Use either 'before' or 'after', not both")
 
-@app.get("/api/chat/messages")
-async def get_chat_messages(limit: int = 50, current_user: dict = Depends(get_current_user)):
     try:
         if limit > 100:
             limit = 100
-            
-        messages = await db.chat_messages.find(
-            {"deleted": False},
-            sort=[("timestamp", -1)],
-            limit=limit
-        ).to_list(length=limit)
-        
-        # Get user info for each message
-        enriched_messages = []
-        for msg in reversed(messages):  # Reverse to get chronological order
-            user = await db.users.find_one({"_id": msg["user_id"]})
-            enriched_messages.append({
-                "id": msg["_id"],
-                "user_id": msg["user_id"],
-                "username": user["username"] if user else "Unknown User",
-                "avatar": user.get("avatar") if user else None,
-                "message": msg["message"],
-                "timestamp": msg["timestamp"].isoformat()
+        if limit < 1:
+            limit = 1
+
+        # Recent pages come from this worker's buffer; Mongo only for scroll-back
+        buffered = chat_buffer.page(room, limit, before, after)
+        if buffered is not None:
+            messages, has_more = buffered
+            profiles = await profile_cache.get_many(msg["user_id"] for msg in messages)
+            enriched_messages = []
+            for msg in messages:
+                # Deleted users are cached as None; keep the name stored on the message
+                profile = profiles.get(msg["user_id"])
+                if profile:
+                    msg = {**msg, "username": profile["username"], "avatar": profile.get("avatar")}
+                enriched_messages.append(msg)
+            return FastJSONResponse({
+                "messages": enriched_messages,
+                "total": len(enriched_messages),
+                "has_more": has_more,
+                "before": enriched_messages[0]["id"] if enriched_messages else None,
+                "after": enriched_messages[-1]["id"] if enriched_messages else None,
+                "source": "buffer"
             })
-        
-        return {"messages": enriched_messages, "total": len(enriched_messages)}
-        
+
+        query: Dict[str, Any] = {"deleted": False}
+        query["room"] = room_filter([room])
+        newest_first = after is None
+        cursor_id = before or after
+        sort_keys = ["timestamp", "_id"]
+        if cursor_id:
+            anchor = await db.chat_messages.find_one({"_id": cursor_id}, {"timestamp": 1, "seq": 1})
+            if anchor is None:
+                raise HTTPException(status_code=404, detail="Cursor message not found")
+            op = "$lt" if before else "$gt"
+            if anchor.get("seq") is not None:
+                # Sequenced messages page by seq; older unsequenced ones sort after them
+                sort_keys = ["seq", "timestamp", "_id"]
+                query["$or"] = [{"seq": {op: anchor["seq"]}}]
+                if before:
+                    query["$or"].append({"seq": {"$exists": False}})
+            else:
+                # Keyset pagination on (timestamp, _id) so equal timestamps are not skipped
+                query["$or"] = [
+                    {"timestamp": {op: anchor["timestamp"]}},
+                    {"timestamp": anchor["timestamp"], "_id": {op: cursor_id}}
+                ]
+
+        direction = -1 if newest_first else 1
+        messages = await db.chat_messages.find(
+            query,
+            sort=[(key, direction) for key in sort_keys],
+            limit=limit + 1
+        ).to_list(length=limit + 1)
+
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+        if newest_first:
+            messages.reverse()  # Reverse to get chronological order
+
+        profiles = await profile_cache.get_many(msg["user_id"] for msg in messages)
+        enriched_messages = [
+            serialize_chat_message(msg, profiles.get(msg["user_id"])) for msg in messages
+        ]
+
+        return FastJSONResponse({
+            "messages": enriched_messages,
+            "total": len(enriched_messages),
+            "has_more": has_more,
+            "before": enriched_messages[0]["id"] if enriched_messages else None,
+            "after": enriched_messages[-1]["id"] if enriched_messages else None,
+            "source": "database"
+        })
+
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Get chat messages error: {e}")
         raise HTTPException(
@@ -504,27 +1963,56 @@ async def get_chat_messages(limit: int = 50, current_user: dict = Depends(get_cu
             detail="Failed to retrieve chat messages"
         )
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics_endpoint(authorization: Optional[str] = Header(None)):
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Metrics are disabled")
+    if METRICS_TOKEN and authorization != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid metrics token")
+    # Set as a header: a text/* media_type would get a second charset appended
+    return Response(content=metrics.render(), headers={"Content-Type": CONTENT_TYPE})
+
 # Health check endpoint
 @app.get("/api/health")
 async def health_check():
-    try:
-        # Test database connection
-        result = await client.admin.command('ping')
+    # Served from the background pinger's last result; probes never hit the database
+    if mongo_health.ok:
         return {
             "status": "healthy",
             "timestamp": datetime.utcnow().isoformat(),
             "database": "connected",
             "api": "operational"
         }
-    except Exception as e:
-        logger.error(f"Health check failed: {e}")
-        return {
-            "status": "unhealthy",
-            "timestamp": datetime.utcnow().isoformat(),
-            "database": "disconnected",
-            "api": "operational",
-            "error": str(e)
-        }
+    return {
+        "status": "unhealthy",
+        "timestamp": datetime.utcnow().isoformat(),
+        "database": "disconnected",
+        "api": "operational",
+        "error": mongo_health.last_error
+    }
+
+@app.get("/livez", include_in_schema=False)
+async def liveness():
+    # The process is up and its event loop answers; dependencies are /readyz's job
+    return {"status": "alive"}
+
+@app.get("/readyz", include_in_schema=False)
+async def readiness():
+    stats = mongo_health.stats()
+    if not mongo_health.ready:
+        return FastJSONResponse(
+            {"status": "not_ready", "database": stats}, status_code=status.HTTP_503_SERVICE_UNAVAILABLE
+        )
+    return {"status": "ready", "database": stats}
+
+@app.get("/api/admin/database")
+async def database_stats(admin_user: dict = Depends(get_admin_user)):
+    return {
+        "health": mongo_health.stats(),
+        "read_preferences": {name: pref.mongos_mode for name, pref in MONGO_READ_PREFERENCES.items()},
+        "pool": MONGO_POOL_OPTIONS,
+        "warm_connections": MONGO_WARM_CONNECTIONS,
+    }
 
 if __name__ == "__main__":
     import uvicorn
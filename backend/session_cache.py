@@ -0,0 +1,93 @@
+"""
+Bounded in-memory cache of authenticated sessions.
+
+Entries are keyed by a hash of the bearer token (raw tokens are never kept)
+and expire at the token's own ``exp``, or earlier when ``max_ttl_seconds``
+elapses.
+
+A user change drops that user's entries on the worker that made it at
+once, and on the others when the invalidation published on the control
+bus arrives (see ``update_user_fields``). The in-process bus reaches only
+its own worker, and a Mongo or Redis bus can lose a message across a
+reconnect; in both cases other workers serve the stale session for at most
+``max_ttl_seconds``.
+"""
+
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Set, Tuple
+
+
+class SessionCache:
+    def __init__(self, max_entries: int = 10000, max_ttl_seconds: float = 300):
+        self.max_entries = max_entries
+        self.max_ttl_seconds = max_ttl_seconds
+        self._entries: "OrderedDict[str, Tuple[float, dict]]" = OrderedDict()
+        self._keys_by_user: Dict[str, Set[str]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def token_key(token: str) -> str:
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def get(self, token: str) -> Optional[dict]:
+        key = self.token_key(token)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, user = entry
+        if expires_at <= time.time():
+            self._remove(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return user
+
+    def set(self, token: str, user: dict, token_exp: Optional[float] = None):
+        expires_at = time.time() + self.max_ttl_seconds
+        if token_exp is not None:
+            expires_at = min(expires_at, float(token_exp))
+        key = self.token_key(token)
+        self._remove(key)
+        self._entries[key] = (expires_at, user)
+        self._keys_by_user.setdefault(user["_id"], set()).add(key)
+        while len(self._entries) > self.max_entries:
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        user_id = entry[1]["_id"]
+        keys = self._keys_by_user.get(user_id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_user[user_id]
+
+    def invalidate_user(self, user_id: str):
+        for key in list(self._keys_by_user.get(user_id, ())):
+            self._remove(key)
+        self.invalidations += 1
+
+    def clear(self):
+        self._entries.clear()
+        self._keys_by_user.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "users": len(self._keys_by_user),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+        }
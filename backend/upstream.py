@@ -0,0 +1,230 @@
+"""
+Application-scoped HTTP client for upstream music providers.
+
+One pooled ``httpx.AsyncClient`` is created at startup and closed at shutdown
+so connections (and their TLS sessions) are reused across requests. Calls are
+retried with jittered exponential backoff on 429/5xx and transport errors, and
+a circuit breaker fails fast while the provider is down.
+"""
+
+import asyncio
+import logging
+import random
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class UpstreamError(Exception):
+    pass
+
+
+class CircuitOpenError(UpstreamError):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int = 5, reset_seconds: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.half_open_probe = False
+        self.times_opened = 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_seconds:
+            return "half_open"
+        return "open"
+
+    def before_call(self):
+        state = self.state
+        if state == "open":
+            raise CircuitOpenError("Upstream circuit is open")
+        if state == "half_open":
+            # Let exactly one probe through until it resolves
+            if self.half_open_probe:
+                raise CircuitOpenError("Upstream circuit is half-open, probe in flight")
+            self.half_open_probe = True
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.half_open_probe = False
+
+    def release_probe(self):
+        # The probe ended without telling us anything about the provider
+        # (the caller was cancelled); let the next call probe instead
+        self.half_open_probe = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.half_open_probe or self.failures >= self.failure_threshold:
+            if self.opened_at is None or self.half_open_probe:
+                self.times_opened += 1
+            self.opened_at = time.monotonic()
+            self.half_open_probe = False
+
+
+class UpstreamClient:
+    def __init__(
+        self,
+        name: str,
+        base_url: str,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        keepalive_expiry: float = 30.0,
+        connect_timeout: float = 2.0,
+        read_timeout: float = 5.0,
+        max_retries: int = 2,
+        backoff_base: float = 0.1,
+        backoff_max: float = 2.0,
+        breaker_threshold: int = 5,
+        breaker_reset_seconds: float = 30.0,
+    ):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.timeout = httpx.Timeout(
+            connect=connect_timeout, read=read_timeout, write=read_timeout, pool=connect_timeout
+        )
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_reset_seconds)
+        self._client: Optional[httpx.AsyncClient] = None
+        self._observers: List[Callable[[str, str, float], None]] = []
+        self._attempt_hooks: List[Callable[[str], Awaitable[None]]] = []
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.rejected = 0
+
+    async def start(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url, limits=self.limits, timeout=self.timeout
+            )
+            logger.info(f"Upstream client '{self.name}' started for {self.base_url}")
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+            logger.info(f"Upstream client '{self.name}' closed")
+
+    def add_observer(self, observer: Callable[[str, str, float], None]):
+        # Called as observer(path, status, seconds) after every attempt;
+        # status is the HTTP code, or "error" for transport failures
+        self._observers.append(observer)
+
+    def add_attempt_hook(self, hook: Callable[[str], Awaitable[None]]):
+        # Awaited as hook(path) before every attempt, retries included, so
+        # per-call costs such as API quota can be charged for each one
+        self._attempt_hooks.append(hook)
+
+    async def _before_attempt(self, path: str):
+        for hook in self._attempt_hooks:
+            try:
+                await hook(path)
+            except Exception as e:
+                logger.error(f"Upstream '{self.name}' attempt hook failed: {e}")
+
+    def _observe(self, path: str, status: str, started: float):
+        elapsed = time.perf_counter() - started
+        for observer in self._observers:
+            observer(path, status, elapsed)
+
+    def _backoff(self, attempt: int, response: Optional[httpx.Response] = None) -> float:
+        if response is not None and response.status_code == 429:
+            retry_after = response.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                return min(float(retry_after), self.backoff_max)
+        # Full jitter: uniform over [0, base * 2^attempt], capped
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    async def get(self, path: str, params: Optional[Dict[str, Any]] = None) -> httpx.Response:
+        if self._client is None:
+            raise UpstreamError(f"Upstream client '{self.name}' is not started")
+
+        try:
+            self.breaker.before_call()
+        except CircuitOpenError:
+            self.rejected += 1
+            raise
+
+        # Every way out of the attempts must resolve a half-open probe, or the
+        # breaker would reject all calls with a probe forever "in flight"
+        try:
+            return await self._get_with_retries(path, params)
+        except asyncio.CancelledError:
+            self.breaker.release_probe()
+            raise
+        except UpstreamError:
+            raise
+        except Exception:
+            self.failures += 1
+            self.breaker.record_failure()
+            raise
+
+    async def _get_with_retries(self, path: str, params: Optional[Dict[str, Any]]) -> httpx.Response:
+        attempt = 0
+        while True:
+            await self._before_attempt(path)
+            self.requests += 1
+            response = None
+            started = time.perf_counter()
+            try:
+                response = await self._client.get(path, params=params)
+                self._observe(path, str(response.status_code), started)
+                if response.status_code not in RETRYABLE_STATUS_CODES:
+                    # 4xx other than 429 is the caller's problem, not an outage
+                    self.breaker.record_success()
+                    return response
+                error: Exception = UpstreamError(
+                    f"{self.name} returned {response.status_code}"
+                )
+            except httpx.TransportError as e:
+                self._observe(path, "error", started)
+                error = e
+
+            if attempt >= self.max_retries:
+                self.failures += 1
+                self.breaker.record_failure()
+                if response is not None:
+                    return response
+                raise UpstreamError(f"{self.name} request failed: {error}") from error
+
+            delay = self._backoff(attempt, response)
+            attempt += 1
+            self.retries += 1
+            logger.warning(
+                f"Upstream '{self.name}' {path} attempt {attempt} failed ({error}), "
+                f"retrying in {delay:.2f}s"
+            )
+            await asyncio.sleep(delay)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "base_url": self.base_url,
+            "started": self._client is not None,
+            "circuit_state": self.breaker.state,
+            "circuit_opened": self.breaker.times_opened,
+            "requests": self.requests,
+            "retries": self.retries,
+            "failures": self.failures,
+            "rejected": self.rejected,
+        }
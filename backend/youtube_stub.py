@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the YouTube Data API v3.
+
+Serves deterministic /search and /videos responses so the backend can be
+benchmarked and load-tested without spending real quota. Point the backend
+at it with YOUTUBE_API_BASE_URL=http://127.0.0.1:8002/youtube/v3
+"""
+
+import argparse
+import asyncio
+import hashlib
+import random
+
+from fastapi import FastAPI, Query
+from fastapi.responses import JSONResponse
+
+app = FastAPI(title="YouTube API stub")
+
+# Tunables, overridable from the command line
+settings = {"latency_ms": 0.0, "error_rate": 0.0}
+
+
+def _video_id(q: str, index: int) -> str:
+    return hashlib.sha1(f"{q}:{index}".encode()).hexdigest()[:11]
+
+
+async def _simulate():
+    if settings["latency_ms"]:
+        await asyncio.sleep(settings["latency_ms"] / 1000)
+    if settings["error_rate"] and random.random() < settings["error_rate"]:
+        return JSONResponse({"error": {"code": 503, "message": "stub failure"}}, status_code=503)
+    return None
+
+
+@app.get("/youtube/v3/search")
+async def search(q: str = "", maxResults: int = 5, pageToken: str = ""):
+    failure = await _simulate()
+    if failure:
+        return failure
+    offset = int(pageToken) if pageToken.isdigit() else 0
+    items = []
+    for i in range(offset, offset + maxResults):
+        items.append({
+            "id": {"kind": "youtube#video", "videoId": _video_id(q, i)},
+            "snippet": {
+                "title": f"{q.title()} #{i + 1}",
+                "channelTitle": f"Stub Artist {i % 7}",
+                "publishedAt": "2024-01-01T00:00:00Z",
+                "thumbnails": {"medium": {"url": f"https://i.ytimg.com/vi/{_video_id(q, i)}/mqdefault.jpg"}},
+            },
+        })
+    return {"items": items, "nextPageToken": str(offset + maxResults)}
+
+
+@app.get("/youtube/v3/videos")
+async def videos(id: str = Query(""), part: str = "contentDetails"):
+    failure = await _simulate()
+    if failure:
+        return failure
+    items = []
+    for video_id in filter(None, id.split(",")):
+        seconds = int(video_id.encode().hex(), 16) % 420 + 60
+        items.append({
+            "id": video_id,
+            "contentDetails": {"duration": f"PT{seconds // 60}M{seconds % 60}S"},
+        })
+    return {"items": items}
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8002)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    settings["latency_ms"] = args.latency_ms
+    settings["error_rate"] = args.error_rate
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
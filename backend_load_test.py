@@ -0,0 +1,472 @@
+#!/usr/bin/env python3
+"""
+Foxenfy Backend Load Testing Suite
+Replays realistic traffic mixes against the backend and reports throughput
+and p50/p95/p99 latency per route.
+
+Meant to run against a local backend that talks to the YouTube stub and a
+local mongod, never against production:
+
+    python backend_load_test.py --spawn --scenario mixed --duration 60
+
+--spawn starts backend/youtube_stub.py and the backend (uvicorn) itself, with
+rate limiting off so the harness measures the server rather than the
+limiter. Without it, point --base-url at a backend you started the same way.
+
+Scenarios: login (bcrypt-bound login burst), search (search storm over a
+Zipf-distributed query set), history (play history writes and reads), chat
+(thousands of WebSocket clients, measuring fan-out delivery latency) and
+mixed (a weighted blend of the HTTP routes).
+
+Results are written as JSON with --output. With --baseline the run compares
+each route to the stored results and exits 1 when p95/p99 latency, throughput
+or error rate regresses past --tolerance; --save-baseline stores this run as
+the new baseline.
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+import uuid
+from collections import Counter, defaultdict
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+import httpx
+import websockets
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.join(ROOT, "backend")
+
+GENRES = ["lofi", "jazz", "rock", "indie", "techno", "house", "ambient", "metal", "soul", "funk",
+          "piano", "classical", "hip hop", "synthwave", "reggae", "blues", "kpop", "punk", "disco", "folk"]
+MODIFIERS = ["", "live", "remix", "acoustic", "playlist", "mix 2024", "study", "workout", "chill", "covers"]
+
+# Weights per action; "login" is kept low outside the login burst because a
+# real client logs in once per session
+MIXES: Dict[str, Dict[str, int]] = {
+    "login": {"login": 1},
+    "search": {"search": 8, "suggest": 2},
+    "history": {"write_history": 6, "write_history_batch": 1, "read_history": 3, "like": 1, "read_liked": 1},
+    "mixed": {
+        "search": 35, "suggest": 15, "write_history": 15, "read_history": 8,
+        "like": 4, "read_liked": 6, "chat_messages": 12, "login": 5,
+    },
+}
+
+
+def percentile(ordered: List[float], fraction: float) -> float:
+    # Nearest-rank on an already sorted list
+    if not ordered:
+        return 0.0
+    return ordered[max(0, min(len(ordered) - 1, math.ceil(fraction * len(ordered)) - 1))]
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.statuses: Dict[str, Counter] = defaultdict(Counter)
+
+    def record(self, route: str, elapsed: float, ok: bool, status: Any):
+        self.latencies[route].append(elapsed)
+        self.statuses[route][str(status)] += 1
+        if not ok:
+            self.errors[route] += 1
+
+    def summary(self, duration: float) -> Dict[str, Dict[str, Any]]:
+        routes = {}
+        for route, samples in sorted(self.latencies.items()):
+            ordered = sorted(samples)
+            routes[route] = {
+                "count": len(ordered),
+                "errors": self.errors[route],
+                "error_rate": round(self.errors[route] / len(ordered), 4),
+                "rps": round(len(ordered) / duration, 2),
+                "p50_ms": round(percentile(ordered, 0.50) * 1000, 2),
+                "p95_ms": round(percentile(ordered, 0.95) * 1000, 2),
+                "p99_ms": round(percentile(ordered, 0.99) * 1000, 2),
+                "max_ms": round(ordered[-1] * 1000, 2),
+                "statuses": dict(self.statuses[route]),
+            }
+        return routes
+
+
+class FoxenfyLoadTester:
+    def __init__(self, base_url: str, args: argparse.Namespace):
+        self.base_url = base_url.rstrip('/')
+        self.args = args
+        self.recorder = Recorder()
+        self.users: List[Dict[str, Any]] = []
+        self.run_id = uuid.uuid4().hex[:6]
+        self.queries = [f"{genre} {modifier}".strip() for genre in GENRES for modifier in MODIFIERS]
+        # Zipf-like popularity so the cache sees a realistic hit ratio
+        self.query_weights = [1 / (rank + 1) for rank in range(len(self.queries))]
+        self.seen_songs: List[Dict[str, Any]] = []
+        self.chat_stats: Dict[str, int] = {}
+
+    async def call(self, client: httpx.AsyncClient, method: str, route: str, url: str,
+                   expected: tuple = (200,), **kwargs) -> Optional[httpx.Response]:
+        """Time one request and record it under its route template"""
+        started = time.perf_counter()
+        response = None
+        try:
+            response = await client.request(method, url, **kwargs)
+            status = response.status_code
+        except httpx.HTTPError as e:
+            status = type(e).__name__
+        self.recorder.record(route, time.perf_counter() - started, status in expected, status)
+        return response
+
+    async def setup_users(self, client: httpx.AsyncClient):
+        """Register the virtual users every scenario acts as"""
+        semaphore = asyncio.Semaphore(8)
+
+        async def register(i: int):
+            user = {
+                "username": f"lt{self.run_id}{i}",
+                "email": f"lt{self.run_id}{i}@loadtest.foxenfy.com",
+                "password": "LoadTest123!",
+            }
+            async with semaphore:
+                response = await client.post("/api/auth/register", json=user)
+            if response.status_code != 200:
+                raise RuntimeError(f"Registering {user['username']} failed: {response.status_code} {response.text}")
+            data = response.json()
+            user.update(token=data["access_token"], id=data["user"]["id"])
+            return user
+
+        self.users = await asyncio.gather(*(register(i) for i in range(self.args.users)))
+        print(f"👥 Registered {len(self.users)} load test users")
+
+    def auth(self, user: Dict[str, Any]) -> Dict[str, str]:
+        return {"Authorization": f"Bearer {user['token']}"}
+
+    def pick_query(self) -> str:
+        return random.choices(self.queries, weights=self.query_weights)[0]
+
+    def pick_song(self) -> Dict[str, Any]:
+        if self.seen_songs:
+            return random.choice(self.seen_songs)
+        song_id = uuid.uuid4().hex[:11]
+        return {"id": song_id, "title": f"Load Test Track {song_id}", "artist": "Load Test"}
+
+    # Actions, one request each
+    async def login(self, client, user):
+        await self.call(client, "POST", "POST /api/auth/login", "/api/auth/login",
+                        json={"email": user["email"], "password": user["password"]})
+
+    async def search(self, client, user):
+        response = await self.call(client, "GET", "GET /api/search", "/api/search",
+                                   params={"q": self.pick_query(), "max_results": 20}, headers=self.auth(user))
+        if response is not None and response.status_code == 200 and len(self.seen_songs) < 5000:
+            for song in response.json().get("songs", [])[:5]:
+                self.seen_songs.append({key: song.get(key) for key in ("id", "title", "artist", "thumbnail")})
+
+    async def suggest(self, client, user):
+        query = self.pick_query()
+        prefix = query[:random.randint(2, max(2, len(query)))]
+        await self.call(client, "GET", "GET /api/search/suggest", "/api/search/suggest",
+                        params={"q": prefix}, headers=self.auth(user))
+
+    async def write_history(self, client, user):
+        await self.call(client, "POST", "POST /api/songs/history", "/api/songs/history",
+                        json=self.pick_song(), headers=self.auth(user))
+
+    async def write_history_batch(self, client, user):
+        events = [{"song": self.pick_song()} for _ in range(10)]
+        await self.call(client, "POST", "POST /api/songs/history/batch", "/api/songs/history/batch",
+                        json={"events": events}, headers=self.auth(user))
+
+    async def read_history(self, client, user):
+        await self.call(client, "GET", "GET /api/songs/history", "/api/songs/history",
+                        params={"limit": 50}, headers=self.auth(user))
+
+    async def like(self, client, user):
+        song = self.pick_song()
+        await self.call(client, "POST", "POST /api/songs/{song_id}/like", f"/api/songs/{song['id']}/like",
+                        json=song, headers=self.auth(user))
+
+    async def read_liked(self, client, user):
+        await self.call(client, "GET", "GET /api/songs/liked", "/api/songs/liked",
+                        params={"limit": 50}, headers=self.auth(user))
+
+    async def chat_messages(self, client, user):
+        await self.call(client, "GET", "GET /api/chat/messages", "/api/chat/messages",
+                        params={"limit": 50}, headers=self.auth(user))
+
+    async def run_mix(self, client: httpx.AsyncClient, mix: Dict[str, int], duration: float):
+        """Closed-loop workers, each picking weighted actions until the time is up"""
+        actions: List[Callable] = [getattr(self, name) for name in mix]
+        weights = list(mix.values())
+        deadline = time.monotonic() + duration
+
+        async def worker():
+            while time.monotonic() < deadline:
+                action = random.choices(actions, weights=weights)[0]
+                await action(client, random.choice(self.users))
+                if self.args.think_ms:
+                    await asyncio.sleep(random.uniform(0, 2 * self.args.think_ms) / 1000)
+
+        await asyncio.gather(*(worker() for _ in range(self.args.concurrency)))
+
+    async def run_chat(self, duration: float):
+        """Many WebSocket clients in one room; a few of them send, everyone receives"""
+        ws_base = self.base_url.replace("http://", "ws://").replace("https://", "wss://")
+        sent_at: Dict[str, float] = {}
+        connections = []
+        delivered = 0
+        semaphore = asyncio.Semaphore(200)
+
+        async def connect(i: int):
+            user = self.users[i % len(self.users)]
+            started = time.perf_counter()
+            try:
+                async with semaphore:
+                    ws = await websockets.connect(
+                        f"{ws_base}/api/chat/ws/{user['id']}?binary=true", max_queue=None, open_timeout=30
+                    )
+            except Exception as e:
+                self.recorder.record("WS /api/chat/ws connect", time.perf_counter() - started, False, type(e).__name__)
+                return
+            self.recorder.record("WS /api/chat/ws connect", time.perf_counter() - started, True, 101)
+            connections.append(ws)
+
+        async def receive(ws):
+            nonlocal delivered
+            try:
+                async for frame in ws:
+                    received = time.perf_counter()
+                    message = json.loads(frame)
+                    if message.get("type") == "ping":
+                        await ws.send(json.dumps({"type": "pong"}))
+                        continue
+                    sent = sent_at.get(message.get("message", ""))
+                    if sent is not None:
+                        delivered += 1
+                        self.recorder.record("WS chat delivery", received - sent, True, "delivered")
+            except websockets.ConnectionClosed:
+                pass
+
+        async def send(ws, deadline: float):
+            while time.monotonic() < deadline:
+                body = f"load test {uuid.uuid4().hex}"
+                sent_at[body] = time.perf_counter()
+                await ws.send(json.dumps({"message": body}))
+                await asyncio.sleep(self.args.chat_interval)
+
+        await asyncio.gather(*(connect(i) for i in range(self.args.ws_clients)))
+        print(f"🔌 {len(connections)}/{self.args.ws_clients} WebSocket clients connected")
+        receivers = [asyncio.create_task(receive(ws)) for ws in connections]
+        deadline = time.monotonic() + duration
+        await asyncio.gather(*(send(ws, deadline) for ws in connections[:self.args.chat_senders]))
+        # Let the last broadcasts drain before counting what arrived
+        await asyncio.sleep(self.args.drain_seconds)
+        for ws in connections:
+            await ws.close()
+        await asyncio.gather(*receivers, return_exceptions=True)
+
+        expected = len(sent_at) * len(connections)
+        self.chat_stats = {
+            "clients": len(connections),
+            "sent": len(sent_at),
+            "expected_deliveries": expected,
+            "delivered": delivered,
+            "delivery_ratio": round(delivered / expected, 4) if expected else 0.0,
+        }
+
+    async def run(self) -> Dict[str, Any]:
+        """Set up users, warm up, then run the scenario and summarize it"""
+        limits = httpx.Limits(max_connections=self.args.concurrency, max_keepalive_connections=self.args.concurrency)
+        async with httpx.AsyncClient(base_url=self.base_url, limits=limits, timeout=self.args.timeout) as client:
+            await self.setup_users(client)
+            if self.args.warmup > 0 and self.args.scenario != "chat":
+                await self.run_mix(client, MIXES[self.args.scenario], self.args.warmup)
+                self.recorder = Recorder()
+
+            print(f"🚀 Running '{self.args.scenario}' for {self.args.duration:.0f}s")
+            started = time.perf_counter()
+            if self.args.scenario == "chat":
+                await self.run_chat(self.args.duration)
+            else:
+                await self.run_mix(client, MIXES[self.args.scenario], self.args.duration)
+            elapsed = time.perf_counter() - started
+
+        results = {
+            "scenario": self.args.scenario,
+            "started_at": datetime.now().isoformat(),
+            "duration_seconds": round(elapsed, 2),
+            "config": {
+                "concurrency": self.args.concurrency,
+                "users": self.args.users,
+                "think_ms": self.args.think_ms,
+                "ws_clients": self.args.ws_clients,
+                "chat_senders": self.args.chat_senders,
+                "chat_interval": self.args.chat_interval,
+            },
+            "routes": self.recorder.summary(elapsed),
+        }
+        if self.chat_stats:
+            results["chat"] = self.chat_stats
+        return results
+
+
+def print_report(results: Dict[str, Any]):
+    print("\n" + "=" * 96)
+    print(f"{'route':36} {'count':>7} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8} {'err %':>6}")
+    for route, stats in results["routes"].items():
+        print(
+            f"{route:36} {stats['count']:7d} {stats['rps']:8.1f} {stats['p50_ms']:8.1f} {stats['p95_ms']:8.1f} "
+            f"{stats['p99_ms']:8.1f} {stats['max_ms']:8.1f} {stats['error_rate'] * 100:6.2f}"
+        )
+    if "chat" in results:
+        chat = results["chat"]
+        print(f"\n💬 {chat['delivered']}/{chat['expected_deliveries']} chat deliveries "
+              f"({chat['delivery_ratio'] * 100:.1f}%) to {chat['clients']} clients")
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float,
+            min_delta_ms: float) -> List[str]:
+    """Routes that got slower, slower to serve or less reliable than the baseline"""
+    if baseline.get("scenario") != results["scenario"] or baseline.get("config") != results["config"]:
+        print("⚠️  Baseline was recorded with a different scenario or configuration")
+    regressions = []
+    for route, current in results["routes"].items():
+        base = baseline.get("routes", {}).get(route)
+        if base is None:
+            continue
+        for metric in ("p95_ms", "p99_ms"):
+            # Ignore tiny absolute changes on fast routes; they are noise
+            if current[metric] > base[metric] * (1 + tolerance) and current[metric] - base[metric] > min_delta_ms:
+                regressions.append(f"{route}: {metric} {base[metric]} -> {current[metric]}")
+        if route.startswith(("GET", "POST")) and current["rps"] < base["rps"] * (1 - tolerance):
+            regressions.append(f"{route}: rps {base['rps']} -> {current['rps']}")
+        if current["error_rate"] > base["error_rate"] + 0.01:
+            regressions.append(f"{route}: error_rate {base['error_rate']} -> {current['error_rate']}")
+    if "chat" in results and "chat" in baseline:
+        if results["chat"]["delivery_ratio"] < baseline["chat"]["delivery_ratio"] - 0.01:
+            regressions.append(
+                f"chat: delivery_ratio {baseline['chat']['delivery_ratio']} -> {results['chat']['delivery_ratio']}"
+            )
+    return regressions
+
+
+def raise_fd_limit():
+    # Every WebSocket client holds a socket
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+async def wait_until_ready(base_url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base_url, timeout=2) as client:
+        while time.monotonic() < deadline:
+            try:
+                if (await client.get("/readyz")).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.5)
+    raise RuntimeError(f"Backend at {base_url} did not become ready within {timeout:.0f}s")
+
+
+def spawn_servers(args: argparse.Namespace) -> List[subprocess.Popen]:
+    """Start the YouTube stub and the backend against the local mongod"""
+    stub = subprocess.Popen(
+        [sys.executable, "youtube_stub.py", "--port", str(args.stub_port), "--latency-ms", str(args.stub_latency_ms)],
+        cwd=BACKEND_DIR,
+    )
+    env = {
+        **os.environ,
+        "MONGO_URL": args.mongo_url,
+        "YOUTUBE_API_BASE_URL": f"http://127.0.0.1:{args.stub_port}/youtube/v3",
+        "YOUTUBE_API_KEY": os.environ.get("YOUTUBE_API_KEY", "stub"),
+        "JWT_SECRET_KEY": os.environ.get("JWT_SECRET_KEY", "load-test-secret"),
+        "JWT_ALGORITHM": os.environ.get("JWT_ALGORITHM", "HS256"),
+        "RATE_LIMIT_ENABLED": "false",
+        "WEB_CONCURRENCY": str(args.workers),
+        "LOG_LEVEL": os.environ.get("LOG_LEVEL", "WARNING"),
+    }
+    port = args.base_url.rsplit(":", 1)[-1].strip("/")
+    backend = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "server:app", "--port", port, "--workers", str(args.workers)],
+        cwd=BACKEND_DIR, env=env,
+    )
+    return [stub, backend]
+
+
+async def main_async(args: argparse.Namespace) -> int:
+    print("🦊 Starting Foxenfy Backend Load Test")
+    print(f"🔗 Target: {args.base_url}")
+    await wait_until_ready(args.base_url)
+    results = await FoxenfyLoadTester(args.base_url, args).run()
+    print_report(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\n💾 Results saved to {args.output}")
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"📌 Baseline saved to {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance, args.min_delta_ms)
+        if regressions:
+            print(f"\n❌ {len(regressions)} performance regressions against {args.baseline}:")
+            for regression in regressions:
+                print(f"   - {regression}")
+            return 1
+        print(f"\n✅ No regressions against {args.baseline}")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default="http://localhost:8001")
+    parser.add_argument("--scenario", choices=sorted(list(MIXES) + ["chat"]), default="mixed")
+    parser.add_argument("--duration", type=float, default=30, help="seconds of measured load")
+    parser.add_argument("--warmup", type=float, default=5, help="seconds of unmeasured load first")
+    parser.add_argument("--concurrency", type=int, default=50, help="concurrent HTTP workers")
+    parser.add_argument("--users", type=int, default=50, help="virtual users to register")
+    parser.add_argument("--think-ms", type=float, default=0, help="mean pause between a worker's requests")
+    parser.add_argument("--timeout", type=float, default=10)
+    parser.add_argument("--ws-clients", type=int, default=2000)
+    parser.add_argument("--chat-senders", type=int, default=10)
+    parser.add_argument("--chat-interval", type=float, default=0.5, help="seconds between a sender's messages")
+    parser.add_argument("--drain-seconds", type=float, default=3)
+    parser.add_argument("--output", help="write results JSON here")
+    parser.add_argument("--baseline", help="fail on regressions against this results JSON")
+    parser.add_argument("--save-baseline", help="also write results here as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression")
+    parser.add_argument("--min-delta-ms", type=float, default=5, help="ignore latency regressions smaller than this")
+    parser.add_argument("--spawn", action="store_true", help="start the YouTube stub and the backend")
+    parser.add_argument("--workers", type=int, default=1, help="backend workers with --spawn")
+    parser.add_argument("--mongo-url", default="mongodb://localhost:27017")
+    parser.add_argument("--stub-port", type=int, default=8002)
+    parser.add_argument("--stub-latency-ms", type=float, default=50)
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    processes = spawn_servers(args) if args.spawn else []
+    try:
+        return asyncio.run(main_async(args))
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait(timeout=10)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
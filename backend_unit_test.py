@@ -0,0 +1,2141 @@
+#!/usr/bin/env python3
+"""
+Foxenfy Backend Unit Tests
+Tests the backend's pure logic in-process, without a running server or MongoDB
+
+    python backend_unit_test.py    (or: python -m pytest backend_unit_test.py)
+"""
+
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import unittest
+from datetime import datetime, timedelta
+from typing import Optional
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+
+import httpx  # noqa: E402
+from backend_load_test import Recorder, compare  # noqa: E402
+from backend_load_test import percentile as nearest_rank  # noqa: E402
+from bson import ObjectId, Timestamp  # noqa: E402
+from pydantic import BaseModel  # noqa: E402
+from pymongo import IndexModel, UpdateOne  # noqa: E402
+from pymongo.errors import BulkWriteError, CollectionInvalid, DuplicateKeyError, PyMongoError  # noqa: E402
+
+from catalog import SongCatalog  # noqa: E402
+from chat_history import LOCAL, ChatSequencer, RecentMessages  # noqa: E402
+from chat_writer import SYNC, WRITE_BEHIND, ChatWriter  # noqa: E402
+from connection_manager import DISCONNECT, DROP_OLDEST, PING_FRAME, ConnectionManager  # noqa: E402
+from database import MongoHealth, parse_read_preferences  # noqa: E402
+from diagnostics import LoopWatchdog, ProfilerBusy, SamplingProfiler, percentile  # noqa: E402
+from history_ingest import ROLLUP_PENDING, HistoryIngestor  # noqa: E402
+from indexes import CHECK_OFF, CHECK_STRICT, CHECK_WARN, HotQuery, IndexCheckError, IndexManager, find_stages  # noqa: E402
+from local_search import LocalSearchIndex  # noqa: E402
+from log_pipeline import JsonFormatter, LogPipeline, parse_sample_rates, request_id_var  # noqa: E402
+from metrics import CONTENT_TYPE, Registry  # noqa: E402
+from migrate_library import build_ops  # noqa: E402
+from password_hasher import PasswordHasher, PasswordPoolSaturated  # noqa: E402
+from playlist_store import PlaylistStore, key_between, keys_between  # noqa: E402
+from prefetch import QueryPrefetcher  # noqa: E402
+from profile_cache import ProfileCache  # noqa: E402
+from pubsub import MongoCappedPubSub, create_pubsub  # noqa: E402
+from rate_limit import MemoryBucketStore, QuotaBudget, RateLimiter, RateLimitExceeded  # noqa: E402
+from search_cache import SearchCache  # noqa: E402
+from serialization import FastJSONResponse, dumps, dumps_text, loads  # noqa: E402
+from upstream import CircuitBreaker, CircuitOpenError, UpstreamClient  # noqa: E402
+
+
+def load_server():
+    # server reads its settings at import time; motor connects lazily, so the
+    # app can be imported and driven through TestClient without a database
+    os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+    os.environ.setdefault("JWT_SECRET_KEY", "unit-test-secret")
+    import server
+    return server
+
+
+def api_client(server):
+    from fastapi.testclient import TestClient
+
+    server.app.dependency_overrides = {
+        server.get_current_user: lambda: {"_id": "user-1", "username": "tester", "role": "user"},
+        server.search_rate_limit: lambda: None,
+    }
+    # Not used as a context manager, so the lifespan (Mongo setup) never runs
+    return TestClient(server.app)
+
+
+class SearchCacheTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.cache = SearchCache()
+        self.calls = 0
+        self.release = asyncio.Event()
+
+    async def fetch(self):
+        self.calls += 1
+        await self.release.wait()
+        return {"songs": [self.calls]}
+
+    async def test_concurrent_misses_share_one_fetch(self):
+        waiters = [asyncio.create_task(self.cache.get_or_fetch("Lo-Fi  Beats", 10, self.fetch)) for _ in range(5)]
+        await asyncio.sleep(0)
+        self.release.set()
+        results = await asyncio.gather(*waiters)
+        self.assertEqual(self.calls, 1)
+        self.assertTrue(all(result == {"songs": [1]} for result in results))
+        self.assertEqual(self.cache.stats()["coalesced"], 4)
+        self.assertEqual(self.cache.stats()["inflight"], 0)
+
+    async def test_hit_after_miss_is_local(self):
+        self.release.set()
+        await self.cache.get_or_fetch("lofi beats", 10, self.fetch)
+        await self.cache.get_or_fetch("LOFI   beats", 10, self.fetch)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.cache.stats()["local_hits"], 1)
+
+    async def test_cancelled_leader_does_not_cancel_waiters(self):
+        leader = asyncio.create_task(self.cache.get_or_fetch("lofi", 10, self.fetch))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(self.cache.get_or_fetch("lofi", 10, self.fetch))
+        await asyncio.sleep(0)
+        leader.cancel()
+        await asyncio.sleep(0)
+        self.release.set()
+        self.assertEqual(await follower, {"songs": [1]})
+        self.assertTrue(leader.cancelled())
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.cache.stats()["upstream_errors"], 0)
+
+    async def test_load_finishes_after_every_requester_left(self):
+        leader = asyncio.create_task(self.cache.get_or_fetch("lofi", 10, self.fetch))
+        await asyncio.sleep(0)
+        leader.cancel()
+        self.release.set()
+        await asyncio.sleep(0.01)
+        self.assertEqual(self.cache.peek("lofi", 10), {"songs": [1]})
+
+    async def test_fetch_error_reaches_every_waiter_and_is_counted_once(self):
+        async def failing():
+            await self.release.wait()
+            raise RuntimeError("quota exceeded")
+
+        waiters = [asyncio.create_task(self.cache.get_or_fetch("lofi", 10, failing)) for _ in range(3)]
+        await asyncio.sleep(0)
+        self.release.set()
+        results = await asyncio.gather(*waiters, return_exceptions=True)
+        self.assertTrue(all(isinstance(result, RuntimeError) for result in results))
+        self.assertEqual(self.cache.stats()["upstream_errors"], 1)
+        self.assertEqual(self.cache.stats()["inflight"], 0)
+
+    async def test_refresh_joins_an_inflight_miss(self):
+        miss = asyncio.create_task(self.cache.get_or_fetch("lofi", 10, self.fetch))
+        await asyncio.sleep(0)
+        refresh = asyncio.create_task(self.cache.refresh("lofi", 10, self.fetch))
+        await asyncio.sleep(0)
+        self.release.set()
+        self.assertEqual(await refresh, "upstream")
+        self.assertEqual(await miss, {"songs": [1]})
+        self.assertEqual(self.calls, 1)
+
+    async def test_miss_joins_an_inflight_refresh(self):
+        refresh = asyncio.create_task(self.cache.refresh("lofi", 10, self.fetch))
+        await asyncio.sleep(0)
+        miss = asyncio.create_task(self.cache.get_or_fetch("lofi", 10, self.fetch))
+        await asyncio.sleep(0)
+        self.release.set()
+        await refresh
+        self.assertEqual(await miss, {"songs": [1]})
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.cache.stats()["coalesced"], 1)
+
+    async def test_refresh_without_upstream_budget_fetches_nothing(self):
+        self.assertIsNone(await self.cache.refresh("lofi", 10, self.fetch, allow_upstream=False))
+        self.assertEqual(self.calls, 0)
+
+
+class FakeSharedCache:
+    def __init__(self):
+        self.docs = {}
+        self.reads = 0
+
+    def put(self, key, value, ttl_seconds=3600):
+        self.docs[key] = {"_id": key, "value": value,
+                          "expires_at": datetime.utcnow() + timedelta(seconds=ttl_seconds)}
+
+    async def find_one(self, query):
+        self.reads += 1
+        doc = self.docs.get(query["_id"])
+        if doc is None or doc["expires_at"] <= query["expires_at"]["$gt"]:
+            return None
+        return doc
+
+
+class SharedTierReadTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.shared = FakeSharedCache()
+        self.cache = SearchCache(collection=self.shared)
+
+    async def test_local_miss_reads_the_shared_tier(self):
+        self.shared.put(SearchCache.make_key("lofi", 10), {"songs": ["a"]})
+        self.assertIsNone(self.cache.peek("lofi", 10))
+        self.assertEqual(await self.cache.get_cached("Lofi", 10), {"songs": ["a"]})
+        self.assertEqual(self.cache.stats()["shared_hits"], 1)
+        # Promoted to the local tier
+        self.assertEqual(await self.cache.get_cached("lofi", 10), {"songs": ["a"]})
+        self.assertEqual(self.shared.reads, 1)
+
+    async def test_expired_shared_entry_is_a_miss(self):
+        self.shared.put(SearchCache.make_key("lofi", 10), {"songs": ["a"]}, ttl_seconds=-1)
+        self.assertIsNone(await self.cache.get_cached("lofi", 10))
+        self.assertEqual(self.cache.stats()["misses"], 0)
+
+
+class ExhaustedQuotaSearchTest(unittest.TestCase):
+    def setUp(self):
+        self.server = load_server()
+        self.shared = FakeSharedCache()
+        patches = [
+            mock.patch.object(self.server, "search_cache", SearchCache(collection=self.shared)),
+            mock.patch.object(self.server.quota_budget, "mode",
+                              mock.AsyncMock(return_value=self.server.QUOTA_EXHAUSTED)),
+            mock.patch.object(self.server, "fetch_youtube_page",
+                              mock.AsyncMock(side_effect=AssertionError("upstream called"))),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.client = api_client(self.server)
+        self.addCleanup(self.server.app.dependency_overrides.clear)
+
+    def share(self, q):
+        song = {"id": "vid-1", "title": "Lofi Beats", "artist": "Someone", "thumbnail": "",
+                "duration": "PT3M", "published_at": "2023-01-01T00:00:00Z"}
+        self.shared.put(SearchCache.make_key(q, 20), {"songs": [song], "next_cursor": "page-2"})
+
+    def test_search_is_served_from_the_shared_tier(self):
+        self.share("zz shared only")
+        response = self.client.get("/api/search", params={"q": "zz shared only"})
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual([song["id"] for song in body["songs"]], ["vid-1"])
+        self.assertEqual(body["next_cursor"], "page-2")
+        self.assertTrue(body["degraded"])
+
+    def test_search_without_any_cached_page_is_refused(self):
+        response = self.client.get("/api/search", params={"q": "zz nothing cached"})
+        self.assertEqual(response.status_code, 503)
+
+    def test_stream_is_served_from_the_shared_tier(self):
+        self.share("zz shared stream")
+        response = self.client.get("/api/search/stream", params={"q": "zz shared stream"})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('"vid-1"', response.text)
+        self.assertNotIn('"error"', response.text)
+
+
+def stream_song(song_id, title="Lofi Beats"):
+    return {"id": song_id, "title": title, "artist": "Someone", "thumbnail": "",
+            "duration": "PT3M", "published_at": "2023-01-01T00:00:00Z"}
+
+
+class SearchStreamTest(unittest.TestCase):
+    def setUp(self):
+        self.server = load_server()
+        self.index = LocalSearchIndex()
+        self.index.add(stream_song("local-1"))
+        self.fetch = mock.AsyncMock(return_value={
+            "songs": [stream_song("local-1"), stream_song("remote-1")], "next_cursor": "page-2"
+        })
+        patches = [
+            mock.patch.object(self.server, "search_cache", SearchCache()),
+            mock.patch.object(self.server, "local_search", self.index),
+            mock.patch.object(self.server, "fetch_youtube_page", self.fetch),
+            mock.patch.object(self.server.quota_budget, "mode",
+                              mock.AsyncMock(return_value=self.server.QUOTA_NORMAL)),
+            mock.patch.object(self.server.catalog, "durations", mock.AsyncMock(return_value={})),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.client = api_client(self.server)
+        self.addCleanup(self.server.app.dependency_overrides.clear)
+
+    def stream(self, **params):
+        return self.client.get("/api/search/stream", params={"q": "lofi", **params})
+
+    def test_ndjson_sends_local_results_then_only_new_upstream_ones(self):
+        response = self.stream()
+        self.assertEqual(response.headers["content-type"], "application/x-ndjson")
+        events = [self.server.loads(line) for line in response.text.splitlines()]
+        self.assertEqual([event["type"] for event in events], ["results", "results", "done"])
+        self.assertEqual(events[0]["source"], "local")
+        self.assertEqual([song["id"] for song in events[0]["songs"]], ["local-1"])
+        self.assertEqual(events[1]["source"], "upstream")
+        self.assertEqual([song["id"] for song in events[1]["songs"]], ["remote-1"])
+        self.assertEqual(events[2], {"type": "done", "total": 2, "next_cursor": "page-2"})
+
+    def test_sse_frames_events_by_name(self):
+        response = self.stream(format="sse")
+        self.assertTrue(response.headers["content-type"].startswith("text/event-stream"))
+        self.assertEqual(response.headers["x-accel-buffering"], "no")
+        frames = [frame for frame in response.text.split("\n\n") if frame]
+        self.assertEqual([frame.splitlines()[0] for frame in frames],
+                         ["event: results", "event: results", "event: done"])
+        done = self.server.loads(frames[-1].splitlines()[1][len("data: "):])
+        self.assertEqual(done["next_cursor"], "page-2")
+
+    def test_cursor_page_skips_the_local_index(self):
+        events = [self.server.loads(line) for line in self.stream(cursor="page-2").text.splitlines()]
+        self.assertEqual([event.get("source") for event in events], ["upstream", None])
+        self.assertEqual(self.fetch.call_args.args, ("lofi", 20, "page-2"))
+
+    def test_second_request_is_served_from_the_cache(self):
+        self.stream(cursor="page-2")
+        events = [self.server.loads(line) for line in self.stream(cursor="page-2").text.splitlines()]
+        self.assertEqual(events[0]["source"], "cache")
+        self.assertEqual(self.fetch.await_count, 1)
+
+    def test_upstream_failure_ends_the_stream_cleanly(self):
+        self.fetch.side_effect = RuntimeError("boom")
+        events = [self.server.loads(line) for line in self.stream().text.splitlines()]
+        self.assertEqual([event["type"] for event in events], ["results", "error", "done"])
+        self.assertEqual(events[1]["status"], 500)
+        self.assertIsNone(events[2]["next_cursor"])
+
+    def test_unknown_format_is_rejected(self):
+        self.assertEqual(self.stream(format="xml").status_code, 400)
+
+
+class QueryPrefetcherTest(unittest.TestCase):
+    def setUp(self):
+        db = mock.Mock()
+        self.prefetcher = QueryPrefetcher(db, SearchCache(), fetch=None, allow_upstream=lambda: True,
+                                          top_n=3, min_score=2, max_tracked=100)
+
+    def test_queries_are_normalized(self):
+        for q in ("Lo-Fi Beats", "lo-fi   beats", " LO-FI BEATS "):
+            self.prefetcher.record(q, 10)
+        self.prefetcher.record("", 10)
+        self.assertEqual(self.prefetcher.top_queries(), [("lo-fi beats", 10)])
+
+    def test_top_queries_by_score_above_minimum(self):
+        for q, hits in (("a", 5), ("b", 1), ("c", 3), ("d", 4), ("e", 2)):
+            for _ in range(hits):
+                self.prefetcher.record(q, 10)
+        self.assertEqual(self.prefetcher.top_queries(), [("a", 10), ("d", 10), ("c", 10)])
+
+    def test_tracked_queries_stay_bounded_and_keep_the_popular_ones(self):
+        for _ in range(5):
+            self.prefetcher.record("popular", 10)
+        for i in range(1000):
+            self.prefetcher.record(f"once {i}", 10)
+        self.assertLessEqual(len(self.prefetcher._scores), 2 * self.prefetcher.max_tracked)
+        self.prefetcher._prune()
+        self.assertEqual(len(self.prefetcher._scores), self.prefetcher.max_tracked)
+        self.assertEqual(self.prefetcher.top_queries(), [("popular", 10)])
+
+
+def chat_message(seq: int, room: str = "global") -> dict:
+    return {"id": f"msg-{seq}", "seq": seq, "room": room, "message": f"message {seq}"}
+
+
+class RecentMessagesTest(unittest.TestCase):
+    def setUp(self):
+        self.buffer = RecentMessages(capacity=5)
+
+    def fill(self, seqs, room="global"):
+        for seq in seqs:
+            message = chat_message(seq, room)
+            self.buffer.add(message, f"frame {seq}")
+
+    def ids(self, messages):
+        return [message["seq"] for message in messages]
+
+    def test_out_of_order_and_duplicate_frames(self):
+        self.fill([1, 3, 2, 3])
+        self.assertEqual(self.ids(message for message, _ in self.buffer.since(0, ["global"])), [1, 2, 3])
+
+    def test_capacity_evicts_oldest_and_clears_complete(self):
+        self.buffer.complete = True
+        self.fill(range(1, 8))
+        self.assertEqual(len(self.buffer), 5)
+        self.assertEqual(self.buffer.oldest_seq, 3)
+        self.assertFalse(self.buffer.complete)
+
+    def test_covers(self):
+        self.assertFalse(self.buffer.covers(0))
+        self.fill(range(3, 8))
+        self.assertTrue(self.buffer.covers(2))
+        self.assertTrue(self.buffer.covers(6))
+        self.assertFalse(self.buffer.covers(1))
+        self.buffer.complete = True
+        self.assertTrue(self.buffer.covers(0))
+
+    def test_since_filters_rooms(self):
+        self.fill([1, 2])
+        self.fill([3], room="rock")
+        self.fill([4])
+        replay = self.buffer.since(1, ["global"])
+        self.assertEqual(self.ids(message for message, _ in replay), [2, 4])
+        self.assertEqual([frame for _, frame in replay], ["frame 2", "frame 4"])
+
+    def test_latest_page(self):
+        self.fill(range(1, 6))
+        self.assertEqual(self.buffer.page("global", 2), ([chat_message(4), chat_message(5)], True))
+
+    def test_page_before_and_after(self):
+        self.fill(range(1, 6))
+        messages, has_more = self.buffer.page("global", 2, before="msg-4")
+        self.assertEqual((self.ids(messages), has_more), ([2, 3], True))
+        messages, has_more = self.buffer.page("global", 2, after="msg-3")
+        self.assertEqual((self.ids(messages), has_more), ([4, 5], False))
+
+    def test_page_falls_back_to_mongo_when_older_messages_may_exist(self):
+        self.fill(range(1, 6))
+        self.assertIsNone(self.buffer.page("global", 10))
+        self.assertIsNone(self.buffer.page("global", 2, before="msg-404"))
+        self.buffer.complete = True
+        self.assertEqual(self.buffer.page("global", 10), ([chat_message(seq) for seq in range(1, 6)], False))
+
+    def test_page_filters_rooms(self):
+        self.buffer.complete = True
+        self.fill([1, 2])
+        self.fill([3], room="rock")
+        messages, has_more = self.buffer.page("rock", 10)
+        self.assertEqual((self.ids(messages), has_more), ([3], False))
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = list(docs)
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for doc in self.docs:
+            yield doc
+
+    async def to_list(self, length=None):
+        return self.docs[:length]
+
+
+class FakeSongs:
+    def __init__(self, docs=()):
+        self.docs = {doc["_id"]: dict(doc) for doc in docs}
+        self.finds = 0
+
+    def find(self, query, projection=None, limit=0):
+        self.finds += 1
+        ids = query["_id"]["$in"]
+        return FakeCursor(self.docs[song_id] for song_id in ids if song_id in self.docs)
+
+    async def bulk_write(self, ops, ordered=True):
+        for op in ops:
+            self.docs.setdefault(op._filter["_id"], {"_id": op._filter["_id"]}).update(op._doc["$set"])
+
+
+class CatalogDurationTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.songs = FakeSongs([
+            {"_id": "known", "duration_seconds": 215},
+            {"_id": "pending", "duration_seconds": None},
+        ])
+        self.catalog = SongCatalog(mock.Mock(songs=self.songs), unknown_recheck_seconds=10)
+        self.now = 1000.0
+        patch = mock.patch("catalog.time.monotonic", lambda: self.now)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    async def test_repeated_lookup_does_no_io(self):
+        self.assertEqual(await self.catalog.durations(["known", "pending"]), {"known": "3:35"})
+        self.assertEqual(await self.catalog.durations(["known", "pending"]), {"known": "3:35"})
+        self.assertEqual(self.songs.finds, 1)
+        self.assertEqual(self.catalog.stats()["duration_cache_hits"], 2)
+
+    async def test_unresolved_ids_are_rechecked_after_the_interval(self):
+        await self.catalog.durations(["pending"])
+        self.songs.docs["pending"]["duration_seconds"] = 61
+        self.now += 9
+        self.assertEqual(await self.catalog.durations(["pending"]), {})
+        self.now += 1
+        self.assertEqual(await self.catalog.durations(["pending"]), {"pending": "1:01"})
+        self.assertEqual(self.songs.finds, 2)
+        # Known now, so it is never looked up again
+        self.now += 3600
+        await self.catalog.durations(["pending"])
+        self.assertEqual(self.songs.finds, 2)
+
+    async def test_enrichment_fills_the_map(self):
+        async def fetch_videos(ids):
+            return {"pending": "PT4M5S"}
+
+        await self.catalog.durations(["pending"])
+        self.catalog.fetch_videos = fetch_videos
+        self.catalog._pending["pending"] = None
+        self.assertEqual(await self.catalog.enrich_once(), 1)
+        self.assertEqual(await self.catalog.durations(["pending"]), {"pending": "4:05"})
+        self.assertEqual(self.songs.finds, 1)
+
+    async def test_map_is_bounded(self):
+        self.catalog.duration_cache_size = 1
+        await self.catalog.durations(["known"])
+        await self.catalog.durations(["pending"])
+        self.assertEqual(self.catalog.stats()["duration_cache_entries"], 1)
+        await self.catalog.durations(["known"])
+        self.assertEqual(self.songs.finds, 3)
+
+
+def matches(doc, query):
+    for field, condition in query.items():
+        if isinstance(condition, dict) and "$in" in condition:
+            if doc.get(field) not in condition["$in"]:
+                return False
+        elif doc.get(field) != condition:
+            return False
+    return True
+
+
+class FakeHistory:
+    def __init__(self):
+        self.docs = {}
+        # Set to make the next bulk_write raise after (or instead of) writing
+        self.fail_after_write = None
+        self.fail_before_write = None
+
+    async def bulk_write(self, ops, ordered=True):
+        if self.fail_before_write:
+            error, self.fail_before_write = self.fail_before_write, None
+            raise error
+        errors = []
+        for index, op in enumerate(ops):
+            doc = op._doc
+            if doc["_id"] in self.docs:
+                errors.append({"index": index, "code": 11000, "errmsg": "duplicate key"})
+            else:
+                self.docs[doc["_id"]] = dict(doc)
+        if self.fail_after_write:
+            error, self.fail_after_write = self.fail_after_write, None
+            raise error
+        if errors:
+            raise BulkWriteError({"writeErrors": errors})
+
+    async def update_many(self, query, update):
+        modified = 0
+        for doc in self.docs.values():
+            if matches(doc, query):
+                doc.update(update.get("$set", {}))
+                for field in update.get("$unset", {}):
+                    doc.pop(field, None)
+                modified += 1
+        return mock.Mock(modified_count=modified)
+
+    def find(self, query, projection=None, limit=0):
+        docs = [dict(doc) for doc in self.docs.values() if matches(doc, query)]
+        return FakeCursor(docs[:limit] if limit else docs)
+
+
+class FakeCounts:
+    def __init__(self):
+        self.docs = {}
+        self.failures = 0
+
+    async def bulk_write(self, ops, ordered=True):
+        if self.failures:
+            self.failures -= 1
+            raise PyMongoError("counts unavailable")
+        for op in ops:
+            doc = self.docs.setdefault(op._filter["_id"], {"count": 0})
+            doc["count"] += op._doc["$inc"]["count"]
+
+
+class HistoryRollupTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.db = mock.Mock(listening_history=FakeHistory(), play_counts_user=FakeCounts(),
+                            play_counts_song=FakeCounts())
+        self.ingestor = HistoryIngestor(self.db, mock.Mock(trim_probability=0))
+
+    def plays(self, *keys, song="song-1"):
+        return [{"song_id": song, "played_at": datetime(2024, 1, 1), "idempotency_key": key} for key in keys]
+
+    def song_count(self, song="song-1"):
+        return self.db.play_counts_song.docs.get(song, {"count": 0})["count"]
+
+    def assert_reconciled(self):
+        history = self.db.listening_history.docs.values()
+        self.assertEqual(self.song_count(), len(history))
+        self.assertFalse(any("rollup" in doc for doc in history))
+
+    async def test_retried_key_is_stored_and_counted_once(self):
+        first = await self.ingestor.submit("user-1", self.plays("k1"))
+        again = await self.ingestor.submit("user-1", self.plays("k1"))
+        self.assertEqual(first, again)
+        self.assertEqual(len(self.db.listening_history.docs), 1)
+        self.assertEqual(self.ingestor.stats()["duplicates"], 1)
+        self.assertEqual(self.db.play_counts_user.docs["user-1:song-1"]["count"], 1)
+        self.assert_reconciled()
+
+    async def test_plays_without_a_key_are_all_counted(self):
+        await self.ingestor.submit("user-1", self.plays(None, None))
+        self.assertEqual(self.song_count(), 2)
+        self.assert_reconciled()
+
+    async def test_failed_rollup_is_recovered_by_the_sweep(self):
+        self.db.play_counts_user.failures = 1
+        await self.ingestor.submit("user-1", self.plays("k1", "k2"))
+        self.assertEqual(self.song_count(), 0)
+        self.assertEqual(self.ingestor.stats()["rollup_failures"], 1)
+        self.assertTrue(all(doc["rollup"] == ROLLUP_PENDING
+                            for doc in self.db.listening_history.docs.values()))
+        self.assertEqual(await self.ingestor.sweep(), 2)
+        self.assert_reconciled()
+
+    async def test_insert_that_landed_before_an_error_is_counted_on_retry(self):
+        self.db.listening_history.fail_after_write = PyMongoError("connection reset")
+        await self.ingestor.submit("user-1", self.plays("k1"))
+        self.assertEqual(self.ingestor.stats()["buffered"], 1)
+        self.assertEqual(self.song_count(), 0)
+        await self.ingestor.flush()
+        self.assertEqual(self.ingestor.stats()["duplicates"], 1)
+        self.assert_reconciled()
+
+    async def test_sweep_skips_rows_already_counted(self):
+        await self.ingestor.submit("user-1", self.plays("k1"))
+        self.assertEqual(await self.ingestor.sweep(), 0)
+        self.assertEqual(self.song_count(), 1)
+
+    async def test_failed_insert_is_retried_from_the_buffer(self):
+        self.db.listening_history.fail_before_write = PyMongoError("not primary")
+        await self.ingestor.submit("user-1", self.plays("k1"))
+        self.assertEqual(self.db.listening_history.docs, {})
+        await self.ingestor.flush()
+        self.assert_reconciled()
+        self.assertEqual(self.song_count(), 1)
+
+
+class HistoryEndpointTest(unittest.TestCase):
+    def setUp(self):
+        self.server = load_server()
+        self.submit = mock.AsyncMock(return_value=["user-1:k1"])
+        patches = [
+            mock.patch.object(self.server.history_ingestor, "submit", self.submit),
+            mock.patch.object(self.server.catalog, "upsert_many", mock.AsyncMock()),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.client = api_client(self.server)
+        self.addCleanup(self.server.app.dependency_overrides.clear)
+
+    def record(self, key):
+        return self.client.post("/api/songs/history", json={"id": "song-1", "title": "Song"},
+                                headers={"Idempotency-Key": key})
+
+    def test_key_is_passed_to_the_ingestor(self):
+        response = self.record("k1")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"id": "user-1:k1", "recorded": True})
+        self.assertEqual(self.submit.call_args.args[1][0]["idempotency_key"], "k1")
+
+    def test_blank_key_is_a_bad_request(self):
+        self.assertEqual(self.record("   ").status_code, 400)
+        self.submit.assert_not_called()
+
+    def test_oversized_key_is_a_bad_request(self):
+        self.assertEqual(self.record("k" * 101).status_code, 400)
+        self.submit.assert_not_called()
+
+
+class LocalSearchTest(unittest.TestCase):
+    def setUp(self):
+        self.index = LocalSearchIndex()
+        # Far more weak matches than any ranking window
+        self.index.add_many({"id": f"mix-{i}", "title": f"Lofi mix {i} extended live session",
+                             "artist": "Various"} for i in range(3000))
+        self.index.add({"id": "best", "title": "Lofi", "artist": "Chillhop"})
+
+    def test_best_match_wins_among_thousands(self):
+        self.assertEqual([song["id"] for song in self.index.search("lofi", 1)], ["best"])
+        self.assertEqual(self.index.search("lof", 3)[0]["id"], "best")
+
+    def test_ties_are_broken_stably(self):
+        first = [song["id"] for song in self.index.search("lofi mix", 5)]
+        self.assertEqual(first, [song["id"] for song in self.index.search("lofi mix", 5)])
+        self.assertEqual(first, sorted(first))
+
+    def test_suggestions_skip_repeated_titles(self):
+        self.index.add_many({"id": f"cover-{i}", "title": "Lofi", "artist": f"Cover {i}"} for i in range(50))
+        suggestions = self.index.suggest("lofi", 3)
+        self.assertEqual(len(suggestions), 3)
+        self.assertEqual(len({suggestion["text"] for suggestion in suggestions}), 3)
+        self.assertEqual(suggestions[0]["text"], "Lofi")
+
+
+class CatalogListenerTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.songs = mock.Mock()
+        self.songs.bulk_write = mock.AsyncMock(return_value=mock.Mock(upserted_ids={1: "new"}))
+        self.catalog = SongCatalog(mock.Mock(songs=self.songs))
+        self.index = LocalSearchIndex()
+        self.catalog.add_listener(self.index.add_many)
+
+    async def test_client_supplied_songs_are_indexed_when_new(self):
+        await self.catalog.upsert_many([{"id": "known", "title": "Known Song"},
+                                        {"id": "new", "title": "Liked Song"}], authoritative=False)
+        self.assertEqual([song["id"] for song in self.index.search("liked")], ["new"])
+        self.assertEqual(self.index.search("known"), [])
+
+    async def test_authoritative_songs_are_always_indexed(self):
+        await self.catalog.upsert_many([{"id": "known", "title": "Known Song"}])
+        self.assertEqual([song["id"] for song in self.index.search("known")], ["known"])
+
+
+class ProfileCacheTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.users = FakeSongs([
+            {"_id": "u1", "username": "ana", "avatar": "a.png", "password_hash": "x"},
+            {"_id": "u2", "username": "bo"},
+        ])
+        self.profiles = ProfileCache(self.users, ttl_seconds=60)
+
+    async def test_one_query_for_every_missing_sender(self):
+        profiles = await self.profiles.get_many(["u1", "u2", "u1", "ghost"])
+        self.assertEqual(self.users.finds, 1)
+        self.assertEqual(profiles["u1"], {"username": "ana", "avatar": "a.png"})
+        self.assertEqual(profiles["u2"], {"username": "bo", "avatar": None})
+        self.assertIsNone(profiles["ghost"])
+
+        # Unknown senders are cached as well, so a repeat page costs nothing
+        await self.profiles.get_many(["u1", "u2", "ghost"])
+        self.assertEqual(self.users.finds, 1)
+        self.assertEqual(self.profiles.stats()["hits"], 3)
+
+    async def test_only_misses_are_queried(self):
+        await self.profiles.get("u1")
+        self.users.find = mock.Mock(wraps=self.users.find)
+        await self.profiles.get_many(["u1", "u2"])
+        self.assertEqual(self.users.find.call_args.args[0], {"_id": {"$in": ["u2"]}})
+
+    async def test_expired_and_invalidated_entries_are_reloaded(self):
+        now = [1000.0]
+        with mock.patch("profile_cache.time", mock.Mock(monotonic=lambda: now[0])):
+            await self.profiles.get("u1")
+            now[0] += 61
+            await self.profiles.get("u1")
+            self.assertEqual(self.users.finds, 2)
+            self.users.docs["u1"]["username"] = "ana2"
+            self.profiles.invalidate("u1")
+            self.assertEqual((await self.profiles.get("u1"))["username"], "ana2")
+
+    async def test_size_is_bounded(self):
+        profiles = ProfileCache(self.users, max_entries=1)
+        await profiles.get_many(["u1", "u2"])
+        self.assertEqual(profiles.stats()["entries"], 1)
+
+
+class FakeChatCollection:
+    """Enforces unique _id and seq like the chat_messages indexes."""
+
+    def __init__(self):
+        self.docs = {}
+
+    def _error(self, doc):
+        for field in ("_id", "seq"):
+            if any(existing[field] == doc[field] for existing in self.docs.values()):
+                return {"code": 11000, "keyPattern": {field: 1}, "errmsg": "E11000 duplicate key error"}
+        return None
+
+    async def insert_one(self, doc):
+        error = self._error(doc)
+        if error:
+            raise DuplicateKeyError(error["errmsg"], 11000, error)
+        self.docs[doc["_id"]] = dict(doc)
+
+    async def insert_many(self, docs, ordered=False):
+        errors = []
+        for index, doc in enumerate(docs):
+            error = self._error(doc)
+            if error:
+                errors.append({**error, "index": index})
+            else:
+                self.docs[doc["_id"]] = dict(doc)
+        if errors:
+            raise BulkWriteError({"writeErrors": errors})
+
+
+class ChatWriterSequenceTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.collection = FakeChatCollection()
+        self.next_seq = 100
+
+    async def resequence(self):
+        self.next_seq += 1
+        return self.next_seq
+
+    async def test_write_behind_keeps_a_message_whose_seq_was_taken(self):
+        await self.collection.insert_one({"_id": "other-worker", "seq": 1})
+        writer = ChatWriter(self.collection, mode=WRITE_BEHIND, resequence=self.resequence)
+        writer._buffer = [{"_id": "a", "seq": 1}, {"_id": "b", "seq": 2}]
+        await writer.flush()
+        self.assertEqual(self.collection.docs["a"]["seq"], 101)
+        self.assertEqual(self.collection.docs["b"]["seq"], 2)
+        self.assertEqual(writer.stats()["written"], 2)
+        self.assertEqual(writer.stats()["resequenced"], 1)
+        self.assertEqual(writer.stats()["failed"], 0)
+
+    async def test_write_behind_treats_a_duplicate_id_as_persisted(self):
+        await self.collection.insert_one({"_id": "a", "seq": 1})
+        writer = ChatWriter(self.collection, mode=WRITE_BEHIND, resequence=self.resequence)
+        writer._buffer = [{"_id": "a", "seq": 1}]
+        await writer.flush()
+        self.assertEqual(len(self.collection.docs), 1)
+        self.assertEqual(writer.stats()["resequenced"], 0)
+
+    async def test_sync_write_keeps_a_message_whose_seq_was_taken(self):
+        await self.collection.insert_one({"_id": "other-worker", "seq": 101})
+        writer = ChatWriter(self.collection, mode=SYNC, resequence=self.resequence)
+        await writer.write({"_id": "a", "seq": 101})
+        # 101 is taken too, so it takes a second reassignment
+        self.assertEqual(self.collection.docs["a"]["seq"], 102)
+        self.assertEqual(writer.stats()["resequenced"], 2)
+
+    async def test_seq_conflict_without_resequence_is_reported(self):
+        await self.collection.insert_one({"_id": "other-worker", "seq": 1})
+        writer = ChatWriter(self.collection, mode=WRITE_BEHIND)
+        writer._buffer = [{"_id": "a", "seq": 1}]
+        with self.assertLogs("chat_writer", level="ERROR"):
+            await writer.flush()
+        self.assertEqual(writer.stats()["failed"], 1)
+
+    def test_local_sequence_refuses_several_workers(self):
+        with self.assertRaises(ValueError):
+            ChatSequencer(mock.MagicMock(), mode=LOCAL, workers=4)
+        self.assertEqual(ChatSequencer(mock.MagicMock(), mode=LOCAL, workers=1).mode, LOCAL)
+
+
+class ChatWriteBehindTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.collection = FakeChatCollection()
+        self.collection.insert_many = mock.AsyncMock(wraps=self.collection.insert_many)
+
+    async def test_write_returns_before_the_insert(self):
+        writer = ChatWriter(self.collection, flush_interval_ms=10_000, max_batch=100)
+        await writer.start()
+        self.addAsyncCleanup(writer.stop)
+        await writer.write({"_id": "a", "seq": 1})
+        self.assertEqual(writer.stats()["buffered"], 1)
+        self.assertEqual(self.collection.docs, {})
+
+    async def test_a_full_batch_flushes_without_waiting_for_the_interval(self):
+        writer = ChatWriter(self.collection, flush_interval_ms=10_000, max_batch=3)
+        await writer.start()
+        self.addAsyncCleanup(writer.stop)
+        for seq in range(1, 4):
+            await writer.write({"_id": f"m{seq}", "seq": seq})
+        for _ in range(5):
+            await asyncio.sleep(0)
+        self.assertEqual(self.collection.insert_many.await_count, 1)
+        self.assertEqual(sorted(self.collection.docs), ["m1", "m2", "m3"])
+        await writer.write({"_id": "m4", "seq": 4})
+        await asyncio.sleep(0)
+        self.assertEqual(writer.stats()["buffered"], 1)
+
+    async def test_interval_flushes_a_partial_batch(self):
+        writer = ChatWriter(self.collection, flush_interval_ms=5, max_batch=100)
+        await writer.start()
+        self.addAsyncCleanup(writer.stop)
+        await writer.write({"_id": "a", "seq": 1})
+        await asyncio.sleep(0.05)
+        self.assertIn("a", self.collection.docs)
+
+    async def test_failed_flush_keeps_the_batch_in_order(self):
+        writer = ChatWriter(self.collection, mode=WRITE_BEHIND)
+        writer._buffer = [{"_id": "a", "seq": 1}, {"_id": "b", "seq": 2}]
+        self.collection.insert_many.side_effect = [PyMongoError("not primary"), None]
+        with self.assertLogs("chat_writer", level="ERROR"):
+            await writer.flush()
+        self.assertEqual([doc["_id"] for doc in writer._buffer], ["a", "b"])
+        await writer.flush()
+        self.assertEqual(writer.stats()["buffered"], 0)
+        self.assertEqual(writer.stats()["written"], 2)
+
+    async def test_stop_flushes_and_falls_back_to_direct_inserts(self):
+        writer = ChatWriter(self.collection, flush_interval_ms=10_000)
+        await writer.start()
+        await writer.write({"_id": "a", "seq": 1})
+        await writer.stop()
+        self.assertIn("a", self.collection.docs)
+        self.assertFalse(writer.running)
+        await writer.write({"_id": "b", "seq": 2})
+        self.assertIn("b", self.collection.docs)
+
+    async def test_full_queue_flushes_before_buffering(self):
+        writer = ChatWriter(self.collection, flush_interval_ms=10_000, max_batch=100, max_queue=2)
+        await writer.start()
+        self.addAsyncCleanup(writer.stop)
+        for seq in range(1, 4):
+            await writer.write({"_id": f"m{seq}", "seq": seq})
+        self.assertEqual(sorted(self.collection.docs), ["m1", "m2"])
+        self.assertEqual(writer.stats()["buffered"], 1)
+
+
+class FakeCounters:
+    def __init__(self):
+        self.value = 0
+        self.updates = 0
+        self.gate = asyncio.Event()
+        self.gate.set()
+        self.error = None
+
+    async def find_one_and_update(self, query, update, upsert=False, return_document=None):
+        self.updates += 1
+        await self.gate.wait()
+        if self.error:
+            error, self.error = self.error, None
+            raise error
+        self.value += update["$inc"]["value"]
+        return {"_id": query["_id"], "value": self.value}
+
+
+class SharedSequenceTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.counters = FakeCounters()
+        self.sequencer = ChatSequencer(mock.MagicMock(counters=self.counters))
+
+    async def test_senders_waiting_on_a_round_trip_share_the_next(self):
+        self.counters.gate.clear()
+        first = asyncio.create_task(self.sequencer.next())
+        await asyncio.sleep(0)
+        queued = [asyncio.create_task(self.sequencer.next()) for _ in range(4)]
+        await asyncio.sleep(0)
+        self.counters.gate.set()
+        self.assertEqual(await first, 1)
+        self.assertEqual(await asyncio.gather(*queued), [2, 3, 4, 5])
+        self.assertEqual(self.counters.updates, 2)
+        self.assertEqual(self.sequencer.stats()["allocated"], 5)
+
+    async def test_idle_sender_gets_its_own_update(self):
+        self.assertEqual(await self.sequencer.next(), 1)
+        self.assertEqual(await self.sequencer.next(), 2)
+        self.assertEqual(self.counters.updates, 2)
+
+    async def test_failed_update_fails_its_batch_only(self):
+        self.counters.error = PyMongoError("not primary")
+        with self.assertRaises(PyMongoError):
+            await self.sequencer.next()
+        self.assertEqual(await self.sequencer.next(), 1)
+
+    async def test_cancelled_sender_leaves_a_gap(self):
+        self.counters.gate.clear()
+        first = asyncio.create_task(self.sequencer.next())
+        await asyncio.sleep(0)
+        gone = asyncio.create_task(self.sequencer.next())
+        kept = asyncio.create_task(self.sequencer.next())
+        await asyncio.sleep(0)
+        gone.cancel()
+        self.counters.gate.set()
+        self.assertEqual(await first, 1)
+        self.assertEqual(await kept, 3)
+
+
+class FakeTailCursor:
+    # Returns what is visible when it is read, then dies, as a tailable
+    # cursor does when it falls off the end of a capped collection
+    def __init__(self, docs):
+        self.docs = docs
+        self.alive = True
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for doc in self.docs:
+            yield doc
+        self.alive = False
+
+
+class FakeCappedCollection:
+    def __init__(self):
+        self.docs = []
+        self.server_time = 1000
+        self.increment = 0
+
+    def stamp(self):
+        self.increment += 1
+        return Timestamp(self.server_time, self.increment)
+
+    def append(self, ts, payload, _id=None):
+        # Lands in natural order now, whatever its timestamp
+        self.docs.append({"_id": _id or ObjectId(), "channel": "chat", "room": "global",
+                          "payload": payload, "ts": ts})
+
+    async def insert_one(self, doc):
+        doc = {"_id": ObjectId(), **doc}
+        if doc.get("ts") == Timestamp(0, 0):
+            doc["ts"] = self.stamp()
+        self.docs.append(doc)
+
+    async def find_one(self, query, sort=None):
+        stamped = [doc for doc in self.docs if "ts" in doc]
+        return stamped[-1] if stamped else None
+
+    def find(self, query, cursor_type=None):
+        bound = query["ts"]
+
+        def after(ts):
+            return ts > bound["$gt"] if "$gt" in bound else ts >= bound["$gte"]
+
+        return FakeTailCursor([doc for doc in self.docs
+                               if doc["channel"] == query["channel"] and after(doc["ts"])])
+
+
+class FakeCappedDb:
+    def __init__(self, collection):
+        self.collection = collection
+
+    def __getitem__(self, name):
+        return self.collection
+
+    async def create_collection(self, name, **options):
+        raise CollectionInvalid("collection already exists")
+
+
+class MongoCappedPubSubTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.events = FakeCappedCollection()
+        self.events.append(self.events.stamp(), "before start")
+        self.bus = MongoCappedPubSub(FakeCappedDb(self.events), reopen_delay=0)
+        self.received = []
+
+        async def handler(message, room):
+            self.received.append(message)
+
+        await self.bus.start(handler)
+        self.addAsyncCleanup(self.bus.stop)
+
+    async def settle(self):
+        for _ in range(20):
+            await asyncio.sleep(0)
+
+    async def test_published_events_are_delivered_once_across_reopens(self):
+        for i in range(3):
+            await self.bus.publish(f"frame-{i}")
+            await self.settle()
+        self.assertEqual(self.received, ["frame-0", "frame-1", "frame-2"])
+        self.assertGreater(self.bus.stats()["reopens"], 3)
+
+    async def test_late_insert_with_a_lower_id_is_not_skipped(self):
+        # Worker A stamped its frame first but it became visible after
+        # worker B's; A's ObjectId also sorts below B's
+        early_id, late_id = ObjectId.from_datetime(datetime(2024, 1, 1)), ObjectId()
+        a_ts, b_ts = self.events.stamp(), self.events.stamp()
+        self.events.append(b_ts, "from worker B", late_id)
+        await self.settle()
+        self.events.append(a_ts, "from worker A", early_id)
+        await self.settle()
+        self.assertEqual(self.received, ["from worker B", "from worker A"])
+        self.assertGreater(self.bus.stats()["replayed"], 0)
+
+    async def test_events_older_than_the_overlap_are_forgotten(self):
+        await self.bus.publish("old")
+        await self.settle()
+        self.events.server_time += 60
+        await self.bus.publish("new")
+        await self.settle()
+        self.assertEqual(self.received, ["old", "new"])
+        self.assertEqual(len(self.bus._recent_ids), 1)
+
+
+class SessionInvalidationTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.server = load_server()
+        self.publish = mock.AsyncMock()
+        self.users = mock.Mock()
+        self.users.find_one_and_update = mock.AsyncMock(return_value={"_id": "user-2", "role": "admin"})
+        patches = [
+            mock.patch.object(self.server.control_bus, "publish", self.publish),
+            mock.patch.object(self.server, "db", mock.Mock(users=self.users)),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.server.session_cache.set("token-2", {"_id": "user-2", "role": "user"})
+        self.addCleanup(self.server.session_cache.invalidate_user, "user-2")
+
+    async def test_update_invalidates_here_and_tells_other_workers(self):
+        await self.server.update_user_fields("user-2", {"role": "admin"})
+        self.assertIsNone(self.server.session_cache.get("token-2"))
+        message = self.server.loads(self.publish.call_args.args[0])
+        self.assertEqual(message, {"type": "invalidate_user", "user_id": "user-2"})
+
+    async def test_invalidation_from_another_worker_drops_the_session(self):
+        await self.server.handle_control_message(
+            self.server.dumps_text({"type": "invalidate_user", "user_id": "user-2"}), "global"
+        )
+        self.assertIsNone(self.server.session_cache.get("token-2"))
+
+    async def test_lost_bus_does_not_fail_the_update(self):
+        self.publish.side_effect = PyMongoError("bus down")
+        self.assertEqual(await self.server.update_user_fields("user-2", {"role": "admin"}),
+                         {"_id": "user-2", "role": "admin"})
+        self.assertIsNone(self.server.session_cache.get("token-2"))
+
+    def test_control_bus_uses_its_own_channel(self):
+        bus = create_pubsub("mongo", db=FakeCappedDb(FakeCappedCollection()), channel="control")
+        self.assertEqual(bus.channel, "control")
+
+
+class FakeWebSocket:
+    def __init__(self, stalled=False):
+        self.sent = []
+        self.closed = False
+        self.unblocked = asyncio.Event()
+        if not stalled:
+            self.unblocked.set()
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, frame):
+        await self.unblocked.wait()
+        self.sent.append(frame)
+
+    async def send_bytes(self, frame):
+        await self.unblocked.wait()
+        self.sent.append(frame)
+
+    async def close(self):
+        self.closed = True
+
+
+async def settle():
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+class BroadcastBackpressureTest(unittest.IsolatedAsyncioTestCase):
+    async def connect(self, manager, stalled=False, **options):
+        websocket = FakeWebSocket(stalled)
+        return await manager.connect(websocket, options.pop("user_id", f"user-{id(websocket)}"), **options), websocket
+
+    async def broadcast(self, manager, count):
+        # Let writers run between frames, as separate senders would
+        for i in range(count):
+            await manager.broadcast(f"frame-{i}")
+            await settle()
+
+    async def test_stalled_client_does_not_hold_up_the_others(self):
+        manager = ConnectionManager(max_queue=4)
+        _, fast = await self.connect(manager)
+        _, stalled = await self.connect(manager, stalled=True)
+        await self.broadcast(manager, 3)
+        self.assertEqual(fast.sent, ["frame-0", "frame-1", "frame-2"])
+        self.assertEqual(stalled.sent, [])
+
+    async def test_drop_oldest_keeps_the_newest_frames(self):
+        manager = ConnectionManager(max_queue=3, slow_consumer_policy=DROP_OLDEST)
+        connection, stalled = await self.connect(manager, stalled=True)
+        await self.broadcast(manager, 6)
+        # The writer holds frame-0 mid-send; frames 1 and 2 made way for 3, 4 and 5
+        self.assertEqual(list(connection.queue), ["frame-3", "frame-4", "frame-5"])
+        self.assertEqual(manager.stats()["dropped_frames"], 2)
+        stalled.unblocked.set()
+        await settle()
+        self.assertEqual(stalled.sent, ["frame-0", "frame-3", "frame-4", "frame-5"])
+        self.assertFalse(stalled.closed)
+
+    async def test_disconnect_policy_drops_a_full_client(self):
+        manager = ConnectionManager(max_queue=3, slow_consumer_policy=DISCONNECT)
+        _, fast = await self.connect(manager)
+        connection, stalled = await self.connect(manager, stalled=True)
+        await self.broadcast(manager, 5)
+        self.assertTrue(stalled.closed)
+        self.assertNotIn(connection.id, manager.connections)
+        self.assertEqual(manager.stats()["slow_disconnects"], 1)
+        self.assertEqual(len(fast.sent), 5)
+
+    async def test_send_timeout_drops_the_connection(self):
+        manager = ConnectionManager(send_timeout=0.01)
+        connection, stalled = await self.connect(manager, stalled=True)
+        await manager.broadcast("frame")
+        await asyncio.sleep(0.05)
+        self.assertTrue(stalled.closed)
+        self.assertEqual(manager.stats()["send_failures"], 1)
+        self.assertEqual(manager.stats()["connections"], 0)
+
+    async def test_binary_clients_share_one_encoding(self):
+        manager = ConnectionManager()
+        _, first = await self.connect(manager, binary=True)
+        _, second = await self.connect(manager, binary=True)
+        _, text = await self.connect(manager)
+        await self.broadcast(manager, 1)
+        self.assertEqual(first.sent, [b"frame-0"])
+        self.assertIs(first.sent[0], second.sent[0])
+        self.assertEqual(text.sent, ["frame-0"])
+
+
+class ConnectionRegistryTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.manager = ConnectionManager(heartbeat_interval=0.01, idle_timeout=30)
+
+    async def test_user_sockets_are_tracked_independently(self):
+        first = await self.manager.connect(FakeWebSocket(), "user-1")
+        second_socket = FakeWebSocket()
+        await self.manager.connect(second_socket, "user-1")
+        await self.manager.send_personal_message("hello", "user-1")
+        await settle()
+        self.assertEqual(first.websocket.sent, ["hello"])
+        self.assertEqual(second_socket.sent, ["hello"])
+        self.manager.disconnect(first)
+        self.assertEqual(len(self.manager.user_connections["user-1"]), 1)
+        self.assertTrue(first.closed)
+
+    async def test_last_socket_removes_the_user_and_its_rooms(self):
+        connection = await self.manager.connect(FakeWebSocket(), "user-1", rooms=["global", "lofi"])
+        self.manager.disconnect(connection)
+        self.manager.disconnect(connection)
+        self.assertEqual(self.manager.user_connections, {})
+        self.assertEqual(self.manager.rooms, {})
+
+    async def test_broadcast_reaches_room_members_only(self):
+        member = FakeWebSocket()
+        outsider = FakeWebSocket()
+        await self.manager.connect(member, "user-1", rooms=["global", "lofi"])
+        await self.manager.connect(outsider, "user-2")
+        await self.manager.broadcast("in lofi", "lofi")
+        await settle()
+        self.assertEqual(member.sent, ["in lofi"])
+        self.assertEqual(outsider.sent, [])
+
+    async def test_heartbeat_pings_idle_sockets_and_reaps_silent_ones(self):
+        self.now = 1000.0
+        # Only this module's clock: the event loop still needs the real one
+        clock = mock.Mock(monotonic=lambda: self.now, perf_counter=time.perf_counter)
+        patch = mock.patch("connection_manager.time", clock)
+        patch.start()
+        self.addCleanup(patch.stop)
+        quiet = await self.manager.connect(FakeWebSocket(), "user-1")
+        active = await self.manager.connect(FakeWebSocket(), "user-2")
+        await self.manager.start()
+        self.addAsyncCleanup(self.manager.stop)
+
+        self.now += 10
+        active.touch()
+        await asyncio.sleep(0.05)
+        self.assertIn(PING_FRAME, quiet.websocket.sent)
+        self.assertNotIn(PING_FRAME, active.websocket.sent)
+
+        self.now += 25
+        await asyncio.sleep(0.05)
+        self.assertTrue(quiet.websocket.closed)
+        self.assertNotIn(quiet.id, self.manager.connections)
+        self.assertIn(active.id, self.manager.connections)
+        self.assertEqual(self.manager.stats()["reaped"], 1)
+
+
+class PositionKeyTest(unittest.TestCase):
+    def assertBetween(self, key, a, b):
+        if a is not None:
+            self.assertLess(a, key)
+        if b is not None:
+            self.assertLess(key, b)
+
+    def test_first_key(self):
+        self.assertEqual(key_between(None, None), "a0")
+
+    def test_appending_keeps_keys_short(self):
+        keys = [key_between(None, None)]
+        for _ in range(1000):
+            keys.append(key_between(keys[-1], None))
+        self.assertEqual(keys, sorted(keys))
+        self.assertEqual(len(set(keys)), len(keys))
+        self.assertLessEqual(max(len(key) for key in keys), 3)
+
+    def test_prepending(self):
+        keys = [key_between(None, None)]
+        for _ in range(1000):
+            keys.insert(0, key_between(None, keys[0]))
+        self.assertEqual(keys, sorted(keys))
+        self.assertEqual(len(set(keys)), len(keys))
+
+    def test_repeated_inserts_between_the_same_neighbours(self):
+        low = key_between(None, None)
+        high = key_between(low, None)
+        for _ in range(200):
+            middle = key_between(low, high)
+            self.assertBetween(middle, low, high)
+            high = middle
+        for _ in range(200):
+            middle = key_between(low, high)
+            self.assertBetween(middle, low, high)
+            low = middle
+
+    def test_out_of_order_neighbours_are_rejected(self):
+        with self.assertRaises(ValueError):
+            key_between("a1", "a0")
+        with self.assertRaises(ValueError):
+            key_between("a0", "a0")
+
+    def test_keys_between_are_ordered_and_inside_the_gap(self):
+        for a, b in ((None, None), ("a0", None), (None, "a0"), ("a0", "a1"), ("a0V", "a0W")):
+            keys = keys_between(a, b, 25)
+            self.assertEqual(len(keys), 25)
+            self.assertEqual(keys, sorted(set(keys)))
+            self.assertBetween(keys[0], a, b)
+            self.assertBetween(keys[-1], a, b)
+        self.assertEqual(keys_between("a0", "a1", 0), [])
+
+    def test_bulk_keys_stay_short(self):
+        keys = keys_between("a0", "a1", 1000)
+        self.assertLessEqual(max(len(key) for key in keys), 5)
+
+
+class AddTracksReservationTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        db = mock.Mock()
+        db.playlists.find_one_and_update = mock.AsyncMock()
+        db.playlist_tracks.bulk_write = mock.AsyncMock()
+        db.playlist_tracks.delete_many = mock.AsyncMock()
+        self.playlists = db.playlists
+        self.tracks = db.playlist_tracks
+        self.store = PlaylistStore(db)
+        patch = mock.patch.object(self.store, "_gap", mock.AsyncMock(return_value=(None, None)))
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def touch_delta(self):
+        return self.playlists.find_one_and_update.call_args.args[1]["$inc"]["track_count"]
+
+    async def test_insert_error_survives_a_failed_release(self):
+        self.playlists.find_one_and_update.side_effect = [{"_id": "p1"}, PyMongoError("release failed")]
+        self.tracks.bulk_write.side_effect = PyMongoError("insert failed")
+        with self.assertRaisesRegex(PyMongoError, "insert failed"):
+            await self.store.add_tracks("p1", ["a", "b"], "user-1")
+        self.assertEqual(self.touch_delta(), -2)
+
+    async def test_cancelled_add_gives_back_the_reservation(self):
+        self.playlists.find_one_and_update.side_effect = [{"_id": "p1"}, {"_id": "p1"}]
+        self.tracks.bulk_write.side_effect = asyncio.CancelledError()
+        with self.assertRaises(asyncio.CancelledError):
+            await self.store.add_tracks("p1", ["a", "b"], "user-1")
+        self.assertEqual(self.touch_delta(), -2)
+
+    async def test_playlist_deleted_during_the_add(self):
+        self.playlists.find_one_and_update.side_effect = [{"_id": "p1"}, None]
+        inserted, playlist = await self.store.add_tracks("p1", ["a", "b"], "user-1")
+        self.assertIsNone(playlist)
+        self.assertEqual(self.touch_delta(), 0)
+        orphans = self.tracks.delete_many.call_args.args[0]["_id"]["$in"]
+        self.assertEqual(orphans, [doc["_id"] for doc in inserted])
+
+    def test_endpoint_reports_a_deleted_playlist_as_not_found(self):
+        server = load_server()
+        patches = [
+            mock.patch.object(server, "get_playlist_for", mock.AsyncMock()),
+            mock.patch.object(server.catalog, "upsert_many", mock.AsyncMock()),
+            mock.patch.object(server.playlists, "add_tracks", mock.AsyncMock(return_value=([], None))),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        client = api_client(server)
+        self.addCleanup(server.app.dependency_overrides.clear)
+        response = client.post("/api/playlists/p1/tracks", json={"songs": [{"id": "a", "title": "A"}]})
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json()["detail"], "Playlist not found")
+
+
+class PasswordPoolPendingTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.hasher = PasswordHasher(rounds=4, max_workers=1, max_pending=2)
+        self.release = threading.Event()
+        self.addCleanup(self.hasher.shutdown)
+        self.addCleanup(self.release.set)
+
+    def blocked(self):
+        self.release.wait(5)
+        return "done"
+
+    async def settle(self):
+        for _ in range(10):
+            await asyncio.sleep(0.01)
+
+    async def test_cancelled_caller_keeps_a_running_job_counted(self):
+        running = asyncio.create_task(self.hasher._run(self.blocked))
+        await self.settle()
+        running.cancel()
+        await self.settle()
+        self.assertEqual(self.hasher.stats()["pending"], 1)
+        self.release.set()
+        await self.settle()
+        self.assertEqual(self.hasher.stats()["pending"], 0)
+
+    async def test_cancelled_queued_job_leaves_the_count(self):
+        running = asyncio.create_task(self.hasher._run(self.blocked))
+        queued = asyncio.create_task(self.hasher._run(self.blocked))
+        await self.settle()
+        self.assertEqual(self.hasher.stats()["pending"], 2)
+        queued.cancel()
+        await self.settle()
+        self.assertEqual(self.hasher.stats()["pending"], 1)
+        self.release.set()
+        self.assertEqual(await running, "done")
+
+    async def test_running_jobs_of_gone_callers_still_saturate(self):
+        callers = [asyncio.create_task(self.hasher._run(self.blocked)) for _ in range(2)]
+        await self.settle()
+        callers[0].cancel()
+        await self.settle()
+        with self.assertRaises(PasswordPoolSaturated):
+            await self.hasher._run(self.blocked)
+
+
+SAMPLE_LINE = re.compile(r'^[a-zA-Z_:][a-zA-Z0-9_:]*(\{([a-zA-Z_][a-zA-Z0-9_]*="([^"\\]|\\.)*",?)*\})? \S+$')
+
+
+class MetricsExpositionTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter_and_gauge_samples(self):
+        requests = self.registry.counter("requests_total", "Requests", ["route"])
+        requests.inc(route="/a")
+        requests.inc(2, route='/b "quoted"\nline')
+        self.registry.gauge("queue_depth", "Depth", ["queue"], callback=lambda: {("chat",): 3})
+        self.assertEqual(self.registry.render(), "\n".join([
+            "# HELP requests_total Requests",
+            "# TYPE requests_total counter",
+            'requests_total{route="/a"} 1.0',
+            'requests_total{route="/b \\"quoted\\"\\nline"} 2.0',
+            "# HELP queue_depth Depth",
+            "# TYPE queue_depth gauge",
+            'queue_depth{queue="chat"} 3.0',
+        ]) + "\n")
+
+    def test_histogram_buckets_are_cumulative(self):
+        latency = self.registry.histogram("latency_seconds", "Latency", ["route"], buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 0.7, 3.0):
+            latency.observe(value, route="/a")
+        lines = self.registry.render().splitlines()
+        self.assertEqual(lines[2:], [
+            'latency_seconds_bucket{route="/a",le="0.1"} 1',
+            'latency_seconds_bucket{route="/a",le="1.0"} 3',
+            'latency_seconds_bucket{route="/a",le="+Inf"} 4',
+            'latency_seconds_sum{route="/a"} 4.25',
+            'latency_seconds_count{route="/a"} 4',
+        ])
+
+    def test_failing_gauge_callback_renders_no_samples(self):
+        def broken():
+            raise RuntimeError("stats unavailable")
+
+        self.registry.gauge("broken", "Broken", callback=broken)
+        self.assertEqual(self.registry.render(), "# HELP broken Broken\n# TYPE broken gauge\n")
+
+    def test_names_are_unique(self):
+        self.registry.counter("requests_total", "Requests")
+        with self.assertRaises(ValueError):
+            self.registry.gauge("requests_total", "Again")
+
+
+class MetricsEndpointTest(unittest.TestCase):
+    def setUp(self):
+        self.server = load_server()
+        self.client = api_client(self.server)
+        self.addCleanup(self.server.app.dependency_overrides.clear)
+
+    def test_scrape_is_valid_exposition_text(self):
+        self.client.get("/api/search/suggest", params={"q": "lo"})
+        self.client.get("/api/no-such-route")
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["content-type"], CONTENT_TYPE)
+        for line in response.text.splitlines():
+            if not line.startswith("#"):
+                self.assertRegex(line, SAMPLE_LINE)
+        self.assertIn('http_request_duration_seconds_count{method="GET",route="/api/search/suggest",'
+                      'status="200"}', response.text)
+        self.assertIn('route="unmatched",status="404"', response.text)
+        self.assertNotIn('route="/metrics"', response.text)
+
+    def test_token_is_required_when_configured(self):
+        with mock.patch.object(self.server, "METRICS_TOKEN", "scrape-secret"):
+            self.assertEqual(self.client.get("/metrics").status_code, 401)
+            authorized = self.client.get("/metrics", headers={"Authorization": "Bearer scrape-secret"})
+            self.assertEqual(authorized.status_code, 200)
+
+
+def block_the_loop(seconds):
+    time.sleep(seconds)
+
+
+def spin_until(stop):
+    while not stop.is_set():
+        pass
+
+
+class LoopWatchdogTest(unittest.IsolatedAsyncioTestCase):
+    async def test_stall_is_attributed_to_the_blocking_code(self):
+        watchdog = LoopWatchdog(threshold_ms=50, interval_ms=10)
+        await watchdog.start()
+        self.addAsyncCleanup(watchdog.stop)
+        await asyncio.sleep(0.05)
+        with self.assertLogs("diagnostics", level="WARNING"):
+            block_the_loop(0.3)
+        await asyncio.sleep(0.05)
+
+        stats = watchdog.stats()
+        self.assertEqual(stats["stalls"], 1)
+        event = stats["slow_events"][0]
+        self.assertIn("block_the_loop", event["stack"][-1])
+        # Closed by the next heartbeat with the full length of the stall
+        self.assertGreaterEqual(event["blocked_ms"], 250)
+        self.assertGreaterEqual(stats["lag_ms"]["max"], 250)
+
+    async def test_an_idle_loop_has_no_stalls(self):
+        watchdog = LoopWatchdog(threshold_ms=200, interval_ms=10)
+        await watchdog.start()
+        await asyncio.sleep(0.1)
+        await watchdog.stop()
+        stats = watchdog.stats()
+        self.assertFalse(stats["running"])
+        self.assertEqual(stats["stalls"], 0)
+        self.assertGreater(stats["lag_ms"]["samples"], 0)
+
+    def test_percentile(self):
+        self.assertEqual(percentile([], 0.99), 0.0)
+        self.assertEqual(percentile([3, 1, 2], 0.5), 2)
+        self.assertEqual(percentile(list(range(100)), 0.99), 99)
+
+
+class SamplingProfilerTest(unittest.IsolatedAsyncioTestCase):
+    async def test_collapsed_stacks_of_one_thread(self):
+        stop = threading.Event()
+        thread = threading.Thread(target=spin_until, args=(stop,))
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(stop.set)
+
+        folded = await SamplingProfiler().profile(0.2, hz=200, thread_ids=[thread.ident])
+        lines = folded.splitlines()
+        self.assertTrue(lines)
+        for line in lines:
+            stack, count = line.rsplit(" ", 1)
+            self.assertGreater(int(count), 0)
+        # Root first: the thread bootstrap, then the spinning function above it
+        frames = lines[0].rsplit(" ", 1)[0].split(";")
+        self.assertIn("_bootstrap", frames[0])
+        self.assertTrue(any("spin_until" in frame for frame in frames[1:]))
+
+    async def test_one_profile_at_a_time(self):
+        profiler = SamplingProfiler()
+        running = asyncio.create_task(profiler.profile(0.2, hz=10))
+        await asyncio.sleep(0.05)
+        with self.assertRaises(ProfilerBusy):
+            await profiler.profile(0.1)
+        await running
+        self.assertEqual(profiler.runs, 1)
+
+
+class LogPipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.pipeline = LogPipeline(sample_rates={"search": 0.0, "connect": 1.0}, queue_size=2)
+        self.logger = logging.getLogger(f"pipeline-test.{self.id()}")
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.logger.addHandler(self.pipeline.handler)
+        self.addCleanup(self.logger.removeHandler, self.pipeline.handler)
+
+    def queued(self):
+        records = []
+        while not self.pipeline.queue.empty():
+            records.append(self.pipeline.queue.get_nowait())
+        return records
+
+    def test_sample_rates_are_parsed(self):
+        self.assertEqual(parse_sample_rates("search=0.1, chat_connect=0.05,"), {"search": 0.1, "chat_connect": 0.05})
+        self.assertEqual(parse_sample_rates(""), {})
+
+    def test_records_are_rendered_as_json_with_the_request_id(self):
+        token = request_id_var.set("req-1")
+        try:
+            self.logger.info("played %s", "song-1", extra={"user_id": "u1"})
+            try:
+                raise ValueError("boom")
+            except ValueError:
+                self.logger.exception("failed")
+        finally:
+            request_id_var.reset(token)
+
+        played, failed = [json.loads(JsonFormatter().format(record)) for record in self.queued()]
+        self.assertEqual(played["message"], "played song-1")
+        self.assertEqual(played["request_id"], "req-1")
+        self.assertEqual(played["user_id"], "u1")
+        self.assertEqual(played["level"], "INFO")
+        self.assertIn("ValueError: boom", failed["exception"])
+
+    def test_sampled_lines_are_counted_not_queued(self):
+        self.logger.info("searching", extra={"sample": "search"})
+        self.logger.info("connected", extra={"sample": "connect"})
+        records = self.queued()
+        self.assertEqual([record.getMessage() for record in records], ["connected"])
+        self.assertEqual(records[0].sample_rate, 1.0)
+        self.assertEqual(self.pipeline.stats()["sampled_out"], {"search": 1})
+
+    def test_a_full_queue_drops_instead_of_blocking(self):
+        for n in range(5):
+            self.logger.info("line %d", n)
+        self.assertEqual(self.pipeline.stats()["dropped"], 3)
+        self.assertEqual([record.getMessage() for record in self.queued()], ["line 0", "line 1"])
+
+
+class RequestIdMiddlewareTest(unittest.TestCase):
+    def setUp(self):
+        server = load_server()
+        self.client = api_client(server)
+        self.addCleanup(server.app.dependency_overrides.clear)
+
+    def test_request_id_is_echoed(self):
+        response = self.client.get("/livez", headers={"X-Request-ID": "abc-123"})
+        self.assertEqual(response.headers["x-request-id"], "abc-123")
+
+    def test_request_id_is_generated_and_bounded(self):
+        generated = self.client.get("/livez").headers["x-request-id"]
+        self.assertRegex(generated, r"^[0-9a-f]{32}$")
+        long_id = self.client.get("/livez", headers={"X-Request-ID": "x" * 100}).headers["x-request-id"]
+        self.assertEqual(len(long_id), 64)
+
+
+class SampleSong(BaseModel):
+    id: str
+    duration: Optional[int] = None
+
+
+class SerializationTest(unittest.TestCase):
+    value = {
+        "song": SampleSong(id="abc"),
+        "at": datetime(2024, 5, 1, 12, 30, 0, 250000),
+        "day": datetime(2024, 5, 1).date(),
+        "tags": {"rock"},
+        "title": "Café ♫",
+        "counts": {404: 2},
+    }
+
+    def test_app_types_are_encoded_compactly(self):
+        self.assertEqual(loads(dumps(self.value)), {
+            "song": {"id": "abc", "duration": None},
+            "at": "2024-05-01T12:30:00.250000",
+            "day": "2024-05-01",
+            "tags": ["rock"],
+            "title": "Café ♫",
+            "counts": {"404": 2},
+        })
+        self.assertNotIn(b" ", dumps({"a": [1, 2]}))
+
+    def test_stdlib_fallback_matches(self):
+        fast = dumps(self.value)
+        with mock.patch("serialization.orjson", None):
+            self.assertEqual(dumps(self.value), fast)
+            self.assertEqual(loads(fast), loads(dumps_text(self.value)))
+
+    def test_unknown_types_are_refused(self):
+        for patched in (False, True):
+            with mock.patch("serialization.orjson", None) if patched else contextlib.nullcontext():
+                with self.assertRaises(TypeError):
+                    dumps({"value": object()})
+
+    def test_response_renders_with_the_fast_encoder(self):
+        response = FastJSONResponse({"at": datetime(2024, 5, 1)})
+        self.assertEqual(response.body, b'{"at":"2024-05-01T00:00:00"}')
+        self.assertEqual(response.headers["content-type"], "application/json")
+
+
+class FakeExplainCursor:
+    def __init__(self, stages):
+        self.stages = stages
+
+    def sort(self, sort):
+        return self
+
+    def limit(self, limit):
+        return self
+
+    async def explain(self):
+        plan = {}
+        for stage in reversed(self.stages):
+            plan = {"stage": stage, "inputStage": plan} if plan else {"stage": stage}
+        return {"queryPlanner": {"winningPlan": plan}}
+
+
+class FakeIndexCollection:
+    def __init__(self, stages=("FETCH", "IXSCAN"), create_error=None):
+        self.stages = list(stages)
+        self.create_error = create_error
+        self.created = []
+
+    async def create_indexes(self, indexes):
+        if self.create_error:
+            raise self.create_error
+        names = [index.document["name"] for index in indexes]
+        self.created.extend(names)
+        return names
+
+    def find(self, filter):
+        return FakeExplainCursor(self.stages)
+
+
+class IndexManagerTest(unittest.IsolatedAsyncioTestCase):
+    def manager(self, check_mode, **collections):
+        manager = IndexManager(collections, check_mode=check_mode)
+        for name in collections:
+            manager.register(name, IndexModel([("key", 1)], name=f"{name}_key"))
+            manager.register_query(HotQuery(f"{name}.by_key", name, {"key": 1}, sort=[("key", 1)], limit=5))
+        return manager
+
+    def test_stages_are_found_at_any_depth(self):
+        plan = {"stage": "LIMIT", "inputStage": {"stage": "OR", "inputStages": [
+            {"stage": "IXSCAN"}, {"stage": "FETCH", "inputStage": {"stage": "COLLSCAN"}},
+        ]}}
+        self.assertEqual(find_stages(plan), ["LIMIT", "OR", "IXSCAN", "FETCH", "COLLSCAN"])
+
+    def test_unknown_check_mode_is_rejected(self):
+        with self.assertRaises(ValueError):
+            IndexManager({}, check_mode="loud")
+
+    async def test_indexes_are_created_and_plans_recorded(self):
+        users = FakeIndexCollection()
+        manager = self.manager(CHECK_STRICT, users=users)
+        await manager.bootstrap()
+        self.assertEqual(users.created, ["users_key"])
+        self.assertEqual(manager.report["plans"], {"users.by_key": ["FETCH", "IXSCAN"]})
+        self.assertEqual(manager.report["errors"], [])
+
+    async def test_warn_mode_logs_collection_scans(self):
+        manager = self.manager(CHECK_WARN, songs=FakeIndexCollection(stages=["COLLSCAN"]))
+        with self.assertLogs("indexes", level="WARNING") as logs:
+            await manager.bootstrap()
+        self.assertIn("songs.by_key", logs.output[0])
+
+    async def test_strict_mode_aborts_on_collection_scans_and_index_errors(self):
+        with self.assertRaises(IndexCheckError):
+            await self.manager(CHECK_STRICT, songs=FakeIndexCollection(stages=["COLLSCAN"])).bootstrap()
+        duplicate = FakeIndexCollection(create_error=PyMongoError("E11000 duplicate key"))
+        with self.assertLogs("indexes", level="ERROR"), self.assertRaises(IndexCheckError):
+            await self.manager(CHECK_STRICT, users=duplicate).ensure()
+
+    async def test_off_mode_records_errors_and_skips_explain(self):
+        duplicate = FakeIndexCollection(stages=["COLLSCAN"], create_error=PyMongoError("E11000 duplicate key"))
+        manager = self.manager(CHECK_OFF, users=duplicate)
+        with self.assertLogs("indexes", level="ERROR"):
+            await manager.bootstrap()
+        self.assertEqual(len(manager.report["errors"]), 1)
+        self.assertEqual(manager.report["plans"], {})
+
+
+class MongoHealthTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.ping = mock.AsyncMock(return_value={"ok": 1})
+        self.health = MongoHealth(mock.Mock(admin=mock.Mock(command=self.ping)),
+                                  interval_seconds=5, timeout_seconds=2, failure_threshold=2)
+        self.now = 1000.0
+        clock = mock.Mock(monotonic=lambda: self.now, perf_counter=time.perf_counter)
+        patch = mock.patch("database.time", clock)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    async def test_ready_only_after_a_successful_warm_up(self):
+        self.assertFalse(self.health.ready)
+        self.assertTrue(await self.health.warm_up(4))
+        self.assertEqual(self.ping.await_count, 4)
+        self.assertEqual(self.health.stats()["warm_connections"], 4)
+        self.assertTrue(self.health.ready)
+
+    async def test_failed_warm_up_is_not_ready(self):
+        self.ping.side_effect = [{"ok": 1}, PyMongoError("auth failed")]
+        self.assertFalse(await self.health.warm_up(2))
+        self.assertEqual(self.health.warm_connections, 1)
+        self.assertFalse(self.health.ready)
+
+    async def test_one_lost_ping_is_not_an_outage(self):
+        await self.health.check()
+        self.ping.side_effect = PyMongoError("timeout")
+        await self.health.check()
+        self.assertTrue(self.health.ready)
+        await self.health.check()
+        self.assertFalse(self.health.ready)
+        self.ping.side_effect = None
+        await self.health.check()
+        self.assertTrue(self.health.ready)
+        self.assertEqual(self.health.consecutive_failures, 0)
+
+    async def test_stale_result_is_not_ready(self):
+        await self.health.check()
+        self.now += 5 * 3 + 2
+        self.assertTrue(self.health.ok)
+        self.assertFalse(self.health.ready)
+
+    async def test_draining_is_not_ready(self):
+        await self.health.check()
+        await self.health.start()
+        await self.health.stop()
+        self.assertTrue(self.health.ok)
+        self.assertTrue(self.health.draining)
+        self.assertFalse(self.health.ready)
+
+    def test_read_preferences_are_parsed_per_collection(self):
+        preferences = parse_read_preferences("chat_messages=secondaryPreferred, songs=primary", 90)
+        self.assertEqual(preferences["chat_messages"].mongos_mode, "secondaryPreferred")
+        self.assertEqual(preferences["chat_messages"].max_staleness, 90)
+        self.assertEqual(preferences["songs"].mongos_mode, "primary")
+        with self.assertRaises(ValueError):
+            parse_read_preferences("songs=fastest")
+
+
+class ProbeEndpointTest(unittest.TestCase):
+    def setUp(self):
+        self.server = load_server()
+        self.health = MongoHealth(mock.Mock())
+        patch = mock.patch.object(self.server, "mongo_health", self.health)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.client = api_client(self.server)
+        self.addCleanup(self.server.app.dependency_overrides.clear)
+
+    def test_readiness_follows_the_cached_check(self):
+        self.assertEqual(self.client.get("/readyz").status_code, 503)
+        self.health._record_success(1.0)
+        response = self.client.get("/readyz")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["status"], "ready")
+        self.health.draining = True
+        self.assertEqual(self.client.get("/readyz").json()["status"], "not_ready")
+
+    def test_liveness_ignores_the_database(self):
+        self.assertEqual(self.client.get("/livez").status_code, 200)
+        self.health.client.admin.command.assert_not_called()
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch("upstream.time.monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = CircuitBreaker(failure_threshold=3, reset_seconds=30)
+
+    def test_opens_after_threshold_failures(self):
+        for _ in range(2):
+            self.breaker.before_call()
+            self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, "closed")
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, "open")
+        self.assertEqual(self.breaker.times_opened, 1)
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.before_call()
+
+    def test_success_resets_failure_count(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, "closed")
+
+    def test_half_open_lets_one_probe_through(self):
+        for _ in range(3):
+            self.breaker.record_failure()
+        self.now += 30
+        self.assertEqual(self.breaker.state, "half_open")
+        self.breaker.before_call()
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.before_call()
+
+    def test_successful_probe_closes(self):
+        for _ in range(3):
+            self.breaker.record_failure()
+        self.now += 30
+        self.breaker.before_call()
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, "closed")
+        self.breaker.before_call()
+
+    def test_failed_probe_reopens(self):
+        for _ in range(3):
+            self.breaker.record_failure()
+        self.now += 30
+        self.breaker.before_call()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, "open")
+        self.assertEqual(self.breaker.times_opened, 2)
+        self.assertFalse(self.breaker.half_open_probe)
+
+    def test_released_probe_lets_the_next_call_probe(self):
+        for _ in range(3):
+            self.breaker.record_failure()
+        self.now += 30
+        self.breaker.before_call()
+        self.breaker.release_probe()
+        self.assertEqual(self.breaker.state, "half_open")
+        self.breaker.before_call()
+
+
+class UpstreamClientProbeTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.client = UpstreamClient("test", "http://upstream.test", max_retries=0,
+                                     breaker_threshold=1, breaker_reset_seconds=0)
+        self.addAsyncCleanup(self.client.close)
+
+    def respond_with(self, handler):
+        self.client._client = httpx.AsyncClient(base_url="http://upstream.test",
+                                                transport=httpx.MockTransport(handler))
+
+    async def open_breaker(self):
+        self.respond_with(lambda request: httpx.Response(503))
+        await self.client.get("/search")
+        self.assertEqual(self.client.breaker.state, "half_open")
+
+    async def test_cancelled_probe_does_not_wedge_the_breaker(self):
+        await self.open_breaker()
+        stalled = asyncio.Event()
+
+        async def hang(request):
+            await stalled.wait()
+
+        self.respond_with(hang)
+        probe = asyncio.create_task(self.client.get("/search"))
+        await asyncio.sleep(0.01)
+        probe.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await probe
+        self.assertFalse(self.client.breaker.half_open_probe)
+        self.respond_with(lambda request: httpx.Response(200))
+        self.assertEqual((await self.client.get("/search")).status_code, 200)
+        self.assertEqual(self.client.breaker.state, "closed")
+
+    async def test_unexpected_probe_error_counts_as_failure(self):
+        await self.open_breaker()
+
+        def broken(request):
+            raise ValueError("malformed response")
+
+        self.respond_with(broken)
+        with self.assertRaises(ValueError):
+            await self.client.get("/search")
+        self.assertFalse(self.client.breaker.half_open_probe)
+        self.assertEqual(self.client.breaker.times_opened, 2)
+
+
+class UpstreamAttemptHookTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.client = UpstreamClient("test", "http://upstream.test", max_retries=3,
+                                     backoff_base=0, breaker_threshold=10)
+        self.addAsyncCleanup(self.client.close)
+        self.server = load_server()
+        self.budget = QuotaBudget(daily_limit=10000)
+        patch = mock.patch.object(self.server, "quota_budget", self.budget)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.client.add_attempt_hook(self.server.charge_youtube_quota)
+
+    def fail_times(self, failures, error=None):
+        calls = []
+
+        def handler(request):
+            calls.append(request.url.path)
+            if len(calls) <= failures:
+                if error is not None:
+                    raise error
+                return httpx.Response(503)
+            return httpx.Response(200)
+
+        self.client._client = httpx.AsyncClient(base_url="http://upstream.test",
+                                                transport=httpx.MockTransport(handler))
+        return calls
+
+    async def test_every_retry_is_charged(self):
+        calls = self.fail_times(2)
+        self.assertEqual((await self.client.get("/search")).status_code, 200)
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(self.budget.used, 3 * self.server.SEARCH_QUOTA_COST)
+
+    async def test_transport_errors_are_charged(self):
+        self.fail_times(1, httpx.ConnectError("refused"))
+        await self.client.get("/videos")
+        self.assertEqual(self.budget.used, 2)
+
+    async def test_exhausted_retries_charge_every_attempt(self):
+        self.fail_times(10)
+        self.assertEqual((await self.client.get("/search")).status_code, 503)
+        self.assertEqual(self.budget.used, 4 * self.server.SEARCH_QUOTA_COST)
+
+    async def test_unpriced_paths_are_free(self):
+        self.fail_times(0)
+        await self.client.get("/channels")
+        self.assertEqual(self.budget.used, 0)
+
+
+def route_stats(p95=10.0, p99=20.0, rps=100.0, error_rate=0.0):
+    return {"p95_ms": p95, "p99_ms": p99, "rps": rps, "error_rate": error_rate}
+
+
+class LoadTestReportTest(unittest.TestCase):
+    def run_results(self, routes, chat=None):
+        results = {"scenario": "mixed", "config": {"workers": 1}, "routes": routes}
+        if chat is not None:
+            results["chat"] = {"delivery_ratio": chat}
+        return results
+
+    def test_nearest_rank_percentile(self):
+        ordered = [float(n) for n in range(1, 101)]
+        self.assertEqual(nearest_rank(ordered, 0.95), 95.0)
+        self.assertEqual(nearest_rank(ordered, 0.99), 99.0)
+        self.assertEqual(nearest_rank([7.0], 0.5), 7.0)
+        self.assertEqual(nearest_rank([], 0.5), 0.0)
+
+    def test_summary_per_route(self):
+        recorder = Recorder()
+        for n in range(1, 11):
+            recorder.record("GET /api/search", n / 1000, ok=n != 10, status=200 if n != 10 else 503)
+        summary = recorder.summary(duration=2.0)["GET /api/search"]
+        self.assertEqual(summary["count"], 10)
+        self.assertEqual(summary["rps"], 5.0)
+        self.assertEqual(summary["p50_ms"], 5.0)
+        self.assertEqual(summary["max_ms"], 10.0)
+        self.assertEqual(summary["error_rate"], 0.1)
+        self.assertEqual(summary["statuses"], {"200": 9, "503": 1})
+
+    def test_latency_regressions_past_tolerance_and_noise_floor(self):
+        baseline = self.run_results({"GET /a": route_stats(p95=10.0, p99=20.0), "GET /b": route_stats(p95=1.0)})
+        current = self.run_results({
+            "GET /a": route_stats(p95=14.0, p99=21.0),
+            # 3x slower, but by less than the noise floor
+            "GET /b": route_stats(p95=3.0),
+            "GET /new": route_stats(p95=500.0),
+        })
+        self.assertEqual(compare(current, baseline, tolerance=0.2, min_delta_ms=2), ["GET /a: p95_ms 10.0 -> 14.0"])
+
+    def test_throughput_errors_and_chat_delivery(self):
+        baseline = self.run_results(
+            {"GET /a": route_stats(), "ws deliver": route_stats(rps=1000.0)}, chat=0.99
+        )
+        current = self.run_results(
+            {"GET /a": route_stats(rps=70.0, error_rate=0.05), "ws deliver": route_stats(rps=10.0)}, chat=0.9
+        )
+        self.assertEqual(compare(current, baseline, tolerance=0.2, min_delta_ms=2), [
+            "GET /a: rps 100.0 -> 70.0",
+            "GET /a: error_rate 0.0 -> 0.05",
+            "chat: delivery_ratio 0.99 -> 0.9",
+        ])
+
+    def test_mismatched_baseline_is_flagged(self):
+        baseline = self.run_results({})
+        baseline["scenario"] = "search"
+        with mock.patch("builtins.print") as printed:
+            self.assertEqual(compare(self.run_results({}), baseline, tolerance=0.2, min_delta_ms=2), [])
+        self.assertIn("different scenario", printed.call_args.args[0])
+
+
+class MigrateLibraryTest(unittest.TestCase):
+    def setUp(self):
+        self.user = {
+            "_id": "user-1",
+            "created_at": datetime(2023, 1, 1),
+            "liked_songs": [
+                "song-a",
+                {"id": "song-b", "title": "B", "artist": "Artist", "liked_at": datetime(2023, 2, 1)},
+                {"title": "no id"},
+            ],
+            "listening_history": [
+                {"song": {"id": "song-a", "title": "A"}, "played_at": datetime(2023, 3, 1)},
+                "song-b",
+                "song-a",
+            ],
+        }
+
+    def test_rerun_builds_identical_upserts(self):
+        # An interrupted run is retried with the same embedded arrays
+        self.assertEqual(build_ops(self.user), build_ops(self.user))
+
+    def test_every_row_is_an_upsert_keyed_by_a_stable_id(self):
+        liked_ops, history_ops, _ = build_ops(self.user)
+        for op in liked_ops + history_ops:
+            self.assertIsInstance(op, UpdateOne)
+        history_ids = [op._filter["_id"] for op in history_ops]
+        self.assertEqual(len(history_ids), 3)
+        self.assertEqual(len(set(history_ids)), 3)
+        self.assertEqual([op._filter["_id"] for op in liked_ops], ["user-1:song-a", "user-1:song-b"])
+
+    def test_repeated_plays_are_kept(self):
+        _, history_ops, _ = build_ops(self.user)
+        played = [op._doc["$setOnInsert"]["song_id"] for op in history_ops]
+        self.assertEqual(played, ["song-a", "song-b", "song-a"])
+
+    def test_song_metadata_is_collected(self):
+        _, _, songs = build_ops(self.user)
+        self.assertIn({"id": "song-b", "title": "B", "artist": "Artist"}, songs)
+        self.assertIn({"id": "song-a", "title": "A"}, songs)
+
+
+class TokenBucketTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch("rate_limit.time.monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # 3 tokens, refilled at one per second
+        self.limiter = RateLimiter("search", capacity=3, per_minute=60)
+
+    async def test_burst_up_to_capacity_then_limited(self):
+        for _ in range(3):
+            await self.limiter.hit("user-1")
+        with self.assertRaises(RateLimitExceeded) as raised:
+            await self.limiter.hit("user-1")
+        self.assertAlmostEqual(raised.exception.retry_after, 1.0)
+        self.assertEqual((self.limiter.allowed, self.limiter.limited), (3, 1))
+
+    async def test_refills_over_time_up_to_capacity(self):
+        for _ in range(3):
+            await self.limiter.hit("user-1")
+        self.now += 1.5
+        await self.limiter.hit("user-1")
+        with self.assertRaises(RateLimitExceeded) as raised:
+            await self.limiter.hit("user-1")
+        self.assertAlmostEqual(raised.exception.retry_after, 0.5)
+        self.now += 3600
+        for _ in range(3):
+            await self.limiter.hit("user-1")
+        with self.assertRaises(RateLimitExceeded):
+            await self.limiter.hit("user-1")
+
+    async def test_keys_have_separate_buckets(self):
+        for _ in range(3):
+            await self.limiter.hit("user-1")
+        await self.limiter.hit("user-2")
+
+    async def test_cost_larger_than_balance_is_refused_without_spending(self):
+        await self.limiter.hit("user-1", cost=2)
+        with self.assertRaises(RateLimitExceeded):
+            await self.limiter.hit("user-1", cost=2)
+        await self.limiter.hit("user-1")
+
+    async def test_memory_store_evicts_least_recently_used(self):
+        store = MemoryBucketStore(max_keys=2)
+        await store.take("a", 3, 1, 1)
+        await store.take("b", 3, 1, 1)
+        await store.take("a", 3, 1, 1)
+        await store.take("c", 3, 1, 1)
+        self.assertEqual(len(store), 2)
+        # "b" was evicted, so it starts over from a full bucket
+        self.assertEqual(await store.take("b", 3, 1, 1), (True, 2))
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -8,6 +8,19 @@ const Chatroom = ({ user }) => {
   const [ws, setWs] = useState(null);
   const [loading, setLoading] = useState(true);
   const messagesEndRef = useRef(null);
+  const lastSeqRef = useRef(null);
+
+  // Replayed and live frames can overlap; keep one copy, ordered by seq
+  const mergeMessages = (prev, incoming) => {
+    const known = new Set(prev.map((msg) => msg.id));
+    const merged = [...prev, ...incoming.filter((msg) => !known.has(msg.id))];
+    merged.forEach((msg) => {
+      if (msg.seq != null && (lastSeqRef.current == null || msg.seq > lastSeqRef.current)) {
+        lastSeqRef.current = msg.seq;
+      }
+    });
+    return merged.sort((a, b) => (a.seq != null && b.seq != null ? a.seq - b.seq : 0));
+  };
 
   useEffect(() => {
     loadMessages();
@@ -27,7 +40,7 @@ const Chatroom = ({ user }) => {
   const loadMessages = async () => {
     try {
       const response = await chatService.getMessages();
-      setMessages(response.messages || []);
+      setMessages(prev => mergeMessages([], [...(response.messages || []), ...prev]));
     } catch (error) {
       console.error('Failed to load messages:', error);
     } finally {
@@ -37,8 +50,13 @@ const Chatroom = ({ user }) => {
 
   const connectWebSocket = () => {
     const websocket = chatService.connectWebSocket(user.id, (message) => {
-      setMessages(prev => [...prev, message]);
-    });
+      if (message.type === 'replay_truncated') {
+        // Too much was missed to replay; reload the latest page instead
+        loadMessages();
+        return;
+      }
+      setMessages(prev => mergeMessages(prev, [message]));
+    }, lastSeqRef.current);
 
     setWs(websocket);
 
@@ -7,17 +7,29 @@ const Search = ({ user, onPlaySong }) => {
   const [results, setResults] = useState([]);
   const [loading, setLoading] = useState(false);
   const [error, setError] = useState('');
+  const [nextCursor, setNextCursor] = useState(null);
+  const [searchedQuery, setSearchedQuery] = useState('');
 
-  const handleSearch = async (e) => {
-    e.preventDefault();
-    if (!query.trim()) return;
-
+  const runSearch = async (searchQuery, cursor = null) => {
     setLoading(true);
     setError('');
+    if (!cursor) {
+      setResults([]);
+      setSearchedQuery(searchQuery);
+    }
 
     try {
-      const response = await musicService.searchSongs(query);
-      setResults(response.songs || []);
+      // Render each batch as it streams in instead of waiting for the whole page
+      const done = await musicService.searchSongsStream(searchQuery, {
+        cursor,
+        onResults: (songs) => {
+          setResults((previous) => {
+            const seen = new Set(previous.map((song) => song.id));
+            return [...previous, ...songs.filter((song) => !seen.has(song.id))];
+          });
+        },
+      });
+      setNextCursor(done.next_cursor);
     } catch (error) {
       setError('Search failed. Please try again.');
       console.error('Search error:', error);
@@ -26,6 +38,12 @@ const Search = ({ user, onPlaySong }) => {
     }
   };
 
+  const handleSearch = async (e) => {
+    e.preventDefault();
+    if (!query.trim()) return;
+    await runSearch(query);
+  };
+
   const formatDuration = (duration) => {
     if (duration === 'Unknown') return duration;
     // Add duration formatting logic here
@@ -61,14 +79,14 @@ const Search = ({ user, onPlaySong }) => {
       )}
 
       {/* Loading State */}
-      {loading && (
+      {loading && results.length === 0 && (
         <div className="flex items-center justify-center py-12">
           <div className="animate-spin rounded-full h-12 w-12 border-b-2 border-spotify-green"></div>
         </div>
       )}
 
       {/* Search Results */}
-      {results.length > 0 && !loading && (
+      {results.length > 0 && (
         <div>
           <h2 className="text-xl font-bold text-white mb-4">Search Results</h2>
           <div className="space-y-2">
@@ -121,6 +139,19 @@ const Search = ({ user, onPlaySong }) => {
               </div>
             ))}
           </div>
+
+          {/* Next Page */}
+          {nextCursor && (
+            <div className="flex justify-center mt-6">
+              <button
+                onClick={() => runSearch(searchedQuery, nextCursor)}
+                disabled={loading}
+                className="px-6 py-2 border border-spotify-gray rounded-full text-white hover:border-white transition-colors duration-200 disabled:opacity-50"
+              >
+                {loading ? 'Loading...' : 'Load more'}
+              </button>
+            </div>
+          )}
         </div>
       )}
 
@@ -1,17 +1,31 @@
 import api from './authService';
 
+const frameDecoder = new TextDecoder();
+
 export const chatService = {
-  getMessages: async (limit = 50) => {
-    const response = await api.get(`/api/chat/messages?limit=${limit}`);
+  getMessages: async (limit = 50, before = null) => {
+    const cursor = before ? `&before=${encodeURIComponent(before)}` : '';
+    const response = await api.get(`/api/chat/messages?limit=${limit}${cursor}`);
     return response.data;
   },
 
-  connectWebSocket: (userId, onMessage) => {
-    const wsUrl = `ws://localhost:8001/api/chat/ws/${userId}`;
+  // Pass the last seen sequence number to be sent only the missed messages.
+  // Frames are requested as binary: the server encodes each broadcast once
+  // for every binary socket instead of once per socket.
+  connectWebSocket: (userId, onMessage, lastSeq = null) => {
+    const query = lastSeq != null ? `&last_seq=${lastSeq}` : '';
+    const wsUrl = `ws://localhost:8001/api/chat/ws/${userId}?binary=true${query}`;
     const ws = new WebSocket(wsUrl);
+    ws.binaryType = 'arraybuffer';
 
     ws.onmessage = (event) => {
-      const message = JSON.parse(event.data);
+      const text = typeof event.data === 'string' ? event.data : frameDecoder.decode(event.data);
+      const message = JSON.parse(text);
+      // Answer server heartbeats so the connection is not reaped as idle
+      if (message.type === 'ping') {
+        ws.send(JSON.stringify({ type: 'pong' }));
+        return;
+      }
       onMessage(message);
     };
 
@@ -6,6 +6,48 @@ export const musicService = {
     return response.data;
   },
 
+  // Stream search results as NDJSON: cached/local results arrive first,
+  // upstream results are appended when YouTube answers
+  searchSongsStream: async (query, { maxResults = 20, cursor = null, onResults } = {}) => {
+    const params = new URLSearchParams({ q: query, max_results: maxResults });
+    if (cursor) params.set('cursor', cursor);
+    const token = localStorage.getItem('token');
+    const response = await fetch(`${api.defaults.baseURL}/api/search/stream?${params}`, {
+      headers: token ? { Authorization: `Bearer ${token}` } : {},
+    });
+    if (!response.ok) {
+      throw new Error(`Search failed with status ${response.status}`);
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let done = { total: 0, next_cursor: null };
+    let error = null;
+    for (;;) {
+      const { value, done: finished } = await reader.read();
+      if (finished) break;
+      buffer += decoder.decode(value, { stream: true });
+      const lines = buffer.split('\n');
+      buffer = lines.pop();
+      for (const line of lines) {
+        if (!line.trim()) continue;
+        const event = JSON.parse(line);
+        if (event.type === 'results' && onResults) {
+          onResults(event.songs, event.source);
+        } else if (event.type === 'error') {
+          error = event;
+        } else if (event.type === 'done') {
+          done = event;
+        }
+      }
+    }
+    if (error && done.total === 0) {
+      throw new Error(error.detail);
+    }
+    return done;
+  },
+
   // Add song to liked songs
   likeSong: async (songId) => {
     const response = await api.post(`/api/songs/${songId}/like`);